@@ -0,0 +1,254 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as paj
+
+from chat_template import ChatTemplate, user_token, assistant_token
+
+# Arrow ingestion backend for the dataset readers. JSONL is parsed by pyarrow's multi-threaded
+# native reader and prompts/contexts/responses are assembled with Arrow compute kernels, so the
+# resulting tables go into datasets.Dataset without a round trip through Python objects.
+
+
+sft_schema = pa.schema([
+    ("prompt", pa.string()),
+    ("context", pa.string()),
+    ("response", pa.string()),
+])
+
+
+def read_jsonl_table(path, schema=None):
+    # larger blocks than the 1MB default, a single JSONL line must fit in one block
+    read_options = paj.ReadOptions(use_threads=True, block_size=1 << 24)
+    if schema is not None:
+        parse_options = paj.ParseOptions(explicit_schema=schema, unexpected_field_behavior="ignore")
+    else:
+        parse_options = paj.ParseOptions()
+    return paj.read_json(path, read_options=read_options, parse_options=parse_options)
+
+
+def string_schema(columns):
+    return pa.schema([(col, pa.string()) for col in columns])
+
+
+def join_strings(*parts):
+    return pc.binary_join_element_wise(*parts, "")
+
+
+def is_blank(col):
+    # same as `not s or s.isspace()`
+    return pc.or_(pc.equal(pc.utf8_length(col), 0), pc.utf8_is_space(col)).fill_null(True)
+
+
+def format_turn(col, role, chatml_format=False, sep=" "):
+    prefix, suffix = ChatTemplate(chatml_format, sep).affixes(role)
+    return join_strings(prefix, col, suffix)
+
+
+def format_user(col, chatml_format=False, sep=" "):
+    return format_turn(col, "user", chatml_format, sep)
+
+
+def format_assistant(col, chatml_format=False, sep=" "):
+    return format_turn(col, "assistant", chatml_format, sep)
+
+
+def empty_strings(n):
+    return pa.array([""] * n, pa.string())
+
+
+def sft_table(prompt, context, response):
+    columns = [col if isinstance(col, pa.ChunkedArray) else pa.chunked_array([col]) for col in (prompt, context, response)]
+    return pa.Table.from_arrays(columns, schema=sft_schema)
+
+
+def join_context(context, prompt):
+    # prompt alone when the context is blank, context + "\n" + prompt otherwise
+    return pc.if_else(is_blank(context), prompt, join_strings(context, "\n", prompt))
+
+
+def sft_text(table, separator, end_of_text):
+    # training text for a batch of prompt/context/response rows, built column-wise
+    return join_strings(join_context(table["context"], table["prompt"]), separator, table["response"], end_of_text)
+
+
+def dpo_table(table):
+    # DPOTrainer columns from a batch of read_data_dpo rows
+    columns = {col: table[col] for col in table.column_names}
+    columns["prompt"] = join_context(table["context"], table["prompt"])
+    columns["chosen"] = table["accepted_response"]
+    columns["rejected"] = table["rejected_response"]
+    return pa.table(columns)
+
+
+tokenized_types = {
+    "input_ids": pa.list_(pa.int32()),
+    "attention_mask": pa.list_(pa.int8()),
+}
+
+
+def append_columns(table, columns, types=tokenized_types):
+    # map() over an arrow formatted dataset replaces the batch with what the function returns
+    for name, type in types.items():
+        table = table.append_column(name, pa.array(columns[name], type))
+    return table
+
+
+def dolly_table(path, lang="fi", chatml_format=False):
+    if lang == "fi":
+        instruction_col, context_col, response_col = "instruction", "context", "response"
+    else:
+        instruction_col, context_col, response_col = "orig_instruction", "orig_context", "orig_response"
+    table = read_jsonl_table(path, string_schema([instruction_col, context_col, response_col]))
+    context = table[context_col]
+    context = pc.if_else(is_blank(context), " ", context)
+    return sft_table(format_user(table[instruction_col], chatml_format),
+                     context,
+                     format_assistant(table[response_col], chatml_format))
+
+
+def lima_table(path, chatml_format=False):
+    table = read_jsonl_table(path, string_schema(["question", "answer"]))
+    question = format_user(pc.utf8_trim_whitespace(table["question"]))
+    answer = format_assistant(pc.utf8_trim_whitespace(table["answer"]))
+    return sft_table(question, empty_strings(len(question)), answer)
+
+
+def eval_task_table(path, hellaswag=False):
+    text = read_jsonl_table(path, string_schema(["text"]))["text"].combine_chunks()
+    if hellaswag:
+        parts = pc.split_pattern(text, ".")
+    else:
+        parts = pc.split_pattern_regex(text, "Question:|Answer:")
+    offsets = parts.offsets.to_numpy()
+    lengths = np.diff(offsets)
+    keep = lengths >= 2
+    flat = pc.list_flatten(parts)
+    if hellaswag:
+        # first two sentences, as text.split(".")[:2] does
+        question = join_strings(flat.take(offsets[:-1][keep]), ".")
+        answer = join_strings(flat.take(offsets[:-1][keep] + 1), ".")
+        keep_rows = pc.and_(pc.greater(pc.utf8_length(question), 1), pc.greater(pc.utf8_length(answer), 1))
+    else:
+        # last two pieces, as re.split(...)[-2:] does
+        question = pc.utf8_trim_whitespace(flat.take(offsets[1:][keep] - 2))
+        answer = pc.utf8_trim_whitespace(flat.take(offsets[1:][keep] - 1))
+        keep_rows = pc.and_(pc.greater(pc.utf8_length(question), 0), pc.greater(pc.utf8_length(answer), 0))
+    question = question.filter(keep_rows)
+    answer = answer.filter(keep_rows)
+    # dummy context, don't mind it
+    return sft_table(question, empty_strings(len(question)), answer)
+
+
+def records_table(records):
+    return pa.Table.from_pylist(list(records), schema=sft_schema)
+
+
+def interleave(first, second):
+    # first[0], second[0], first[1], second[1], ...
+    n = len(first)
+    both = pa.chunked_array(first.chunks + second.chunks, type=first.type)
+    return both.take(np.stack([np.arange(n), np.arange(n) + n], axis=1).ravel())
+
+
+def dolly_lang_alignment_table(path, max_examples=0):
+    table = read_jsonl_table(path, string_schema(["instruction", "context", "response",
+                                                  "orig_instruction", "orig_context", "orig_response"]))
+    table = table.filter(pc.not_equal(table["orig_response"], table["response"]))
+    columns = {
+        "prompt": interleave(table["instruction"], table["orig_instruction"]),
+        "context": interleave(table["context"], table["orig_context"]),
+        "accepted_response": interleave(table["response"], table["orig_response"]),
+        "rejected_response": interleave(table["orig_response"], table["response"]),
+    }
+    table = pa.table(columns)
+    if max_examples > 0:
+        table = table.slice(0, max_examples)
+    return table
+
+
+ultrafeedback_criteria = ['instruction_following', 'honesty', 'truthfulness', 'helpfulness']
+
+
+def first_in_segments(values, target, starts):
+    # index of the first element equal to target[row] in every segment of values
+    candidates = np.where(values == np.repeat(target, np.diff(np.append(starts, len(values)))),
+                          np.arange(len(values)), len(values))
+    return np.minimum.reduceat(candidates, starts)
+
+
+def ultrafeedback_table(path, max_examples=0):
+    rating = pa.struct([("Rating", pa.string())])
+    completion = pa.struct([("response", pa.string()),
+                            ("annotations", pa.struct([(crit, rating) for crit in ultrafeedback_criteria]))])
+    table = read_jsonl_table(path, pa.schema([("instruction", pa.string()), ("completions", pa.list_(completion))]))
+    completions = table["completions"].combine_chunks()
+    lengths = pc.list_value_length(completions).fill_null(0).to_numpy(zero_copy_only=False)
+    flat = pc.list_flatten(completions)
+    # mean rating over the criteria, ratings that are not numbers count as 0
+    scores = np.zeros(len(flat))
+    for crit in ultrafeedback_criteria:
+        value = pc.struct_field(flat, ["annotations", crit, "Rating"])
+        numeric = pc.utf8_is_numeric(value).fill_null(False)
+        scores += pc.if_else(numeric, pc.cast(pc.if_else(numeric, value, "0"), pa.float64()), 0.0).to_numpy()
+    scores /= len(ultrafeedback_criteria)
+    # pairs only from instructions with more than one completion
+    keep = lengths > 1
+    kept = np.repeat(keep, lengths)
+    scores = scores[kept]
+    responses = pc.struct_field(flat, "response").filter(pa.array(kept))
+    starts = np.concatenate([[0], np.cumsum(lengths[keep])[:-1]]).astype(np.int64)
+    best, worst = np.maximum.reduceat(scores, starts), np.minimum.reduceat(scores, starts)
+    # first best and first worst, as argmax and argmin pick them
+    best_index, worst_index = first_in_segments(scores, best, starts), first_in_segments(scores, worst, starts)
+    differ = best > worst
+    instructions = table["instruction"].filter(pa.array(keep)).filter(pa.array(differ))
+    table = pa.table({
+        "prompt": instructions,
+        "context": empty_strings(len(instructions)),
+        "accepted_response": responses.take(best_index[differ]),
+        "rejected_response": responses.take(worst_index[differ]),
+    })
+    if max_examples > 0:
+        table = table.slice(0, max_examples)
+    return table
+
+
+def split_last(col, marker):
+    # (text before the last marker, marker + the rest), nulls where the marker is missing
+    parts = pc.split_pattern(pc.fill_null(col, ""), marker, max_splits=1, reverse=True)
+    if isinstance(parts, pa.ChunkedArray):
+        parts = parts.combine_chunks()
+    offsets = parts.offsets.to_numpy()
+    found = pa.array(np.diff(offsets) == 2)
+    return (pc.if_else(found, parts.values.take(offsets[:-1]), None),
+            pc.if_else(found, join_strings(marker, parts.values.take(offsets[1:] - 1)), None))
+
+
+def hh_table(path, max_examples=10000, user_marker="\n\nHuman:", assistant_marker="\n\nAssistant:",
+             user_token=user_token, assistant_token=assistant_token):
+    # the last user turn of the chosen transcript is the prompt, the turns before it the context
+    # and the last assistant turns of both transcripts the responses; transcripts without both
+    # markers are dropped
+    table = read_jsonl_table(path, string_schema(["chosen", "rejected"])).slice(0, max_examples)
+    context, last_user = split_last(table["chosen"], user_marker)
+    _, chosen = split_last(table["chosen"], assistant_marker)
+    _, rejected_user = split_last(table["rejected"], user_marker)
+    _, rejected = split_last(table["rejected"], assistant_marker)
+    found = pc.and_(pc.and_(pc.is_valid(last_user), pc.is_valid(chosen)),
+                    pc.and_(pc.is_valid(rejected_user), pc.is_valid(rejected)))
+    missing = len(table) - int(np.count_nonzero(found.to_numpy(zero_copy_only=False)))
+    if missing:
+        print(f"Human or Assistant tokens not found in {missing} transcripts")
+    context, last_user = context.filter(found), last_user.filter(found)
+    chosen, rejected = chosen.filter(found), rejected.filter(found)
+    # from the last user turn up to the last assistant turn, empty when no assistant turn follows
+    prompt = split_last(last_user, assistant_marker)[0].fill_null("")
+    context = pc.utf8_trim_whitespace(pc.replace_substring(context, user_marker, "\n" + user_token))
+    context = pc.utf8_trim_whitespace(pc.replace_substring(context, assistant_marker, "\n" + assistant_token))
+    return pa.table({
+        "prompt": pc.utf8_trim_whitespace(pc.replace_substring(prompt, user_marker, user_token)),
+        "context": context,
+        "accepted_response": pc.utf8_trim_whitespace(pc.replace_substring(chosen, assistant_marker, assistant_token)),
+        "rejected_response": pc.utf8_trim_whitespace(pc.replace_substring(rejected, assistant_marker, assistant_token)),
+    })
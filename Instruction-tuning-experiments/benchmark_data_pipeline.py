@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+import sys
+import numpy as np
+from time import perf_counter
+from argparse import ArgumentParser
+
+from datasets import Sequence, Value, concatenate_datasets
+from transformers import AutoTokenizer, DataCollatorForLanguageModeling
+
+from instruction_finetuning_datasets import read_data_sft, shuffle_dataset, shuffle_modes
+from arrow_readers import sft_text, append_columns
+from indexed_dataset import masked_labels, prompt_loss_mask
+from collators import LabelPaddingCollator
+from chat_template import TemplateEncoder
+
+
+def argparser():
+    ap = ArgumentParser()
+    ap.add_argument('--benchmark', type=str, default="formatting", choices=sorted(benchmarks))
+    ap.add_argument('--tokenizer', type=str)
+    ap.add_argument('--training_data', type=str, default="oasst")
+    ap.add_argument('--lang', type=str, default="fi")
+    ap.add_argument('--chatml_format', default=False, type=lambda x: (str(x).lower() == 'true'))
+    ap.add_argument('--repeat', type=int, default=1, help="concatenate the data this many times")
+    ap.add_argument('--num_workers', type=int, default=4)
+    ap.add_argument('--random_reads', type=int, default=10000)
+    ap.add_argument('--batch_size', type=int, default=8)
+    ap.add_argument('--batches', type=int, default=1000)
+    return ap
+
+
+def load_data(args):
+    data = read_data_sft(args.training_data, split="train", lang=args.lang, chatml_format=args.chatml_format,
+                         shuffle_data=False)
+    if args.repeat > 1:
+        data = concatenate_datasets([data] * args.repeat)
+    return data
+
+
+def report(name, n, seconds):
+    print(f'{name:<40} {seconds:8.2f} s {n/seconds:12.1f} examples/s')
+
+
+def preprocess_python(data, tokenizer, separator):
+    # per-example string concatenation, as preprocess_sft used to do it
+    combined = []
+    for prompt, context, response in zip(data['prompt'], data['context'], data['response']):
+        if not context or context.isspace():
+            input_i = prompt
+        else:
+            input_i = context + '\n' + prompt
+        combined.append(input_i + separator + response + tokenizer.eos_token)
+    return tokenizer(combined, truncation=True)
+
+
+def preprocess_arrow(data, tokenizer, separator):
+    combined = sft_text(data, separator, tokenizer.eos_token)
+    return append_columns(data, tokenizer(combined.to_pylist(), truncation=True))
+
+
+def benchmark_formatting(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    data = load_data(args)
+    print("Examples", len(data))
+    features = data.features.copy()
+    features['input_ids'] = Sequence(Value('int32'))
+    features['attention_mask'] = Sequence(Value('int8'))
+    runs = [
+        ("python map, 1 process", lambda: data.map(
+            lambda d: preprocess_python(d, tokenizer, '\n'), batched=True, load_from_cache_file=False)),
+        ("arrow map, 1 process", lambda: data.with_format("arrow").map(
+            lambda d: preprocess_arrow(d, tokenizer, '\n'), batched=True, features=features, load_from_cache_file=False)),
+        (f"arrow map, {args.num_workers} processes", lambda: data.with_format("arrow").map(
+            lambda d: preprocess_arrow(d, tokenizer, '\n'), batched=True, features=features, num_proc=args.num_workers,
+            load_from_cache_file=False)),
+    ]
+    for name, run in runs:
+        start = perf_counter()
+        run()
+        report(name, len(data), perf_counter() - start)
+
+
+def format_arrow(data):
+    return data.append_column("text", sft_text(data, '\n', '</s>'))
+
+
+def benchmark_shuffle(args):
+    # the shuffled dataset as the next steps see it: a batched map over every row and random row reads
+    data = load_data(args)
+    print("Examples", len(data))
+    reads = np.random.default_rng(0).integers(0, len(data), args.random_reads)
+    for mode in shuffle_modes:
+        start = perf_counter()
+        shuffled = shuffle_dataset(data, mode)
+        report(f"{mode}: shuffle", len(data), perf_counter() - start)
+        step = perf_counter()
+        features = shuffled.features.copy()
+        features['text'] = Value('string')
+        shuffled.with_format("arrow").map(format_arrow, batched=True, features=features, load_from_cache_file=False)
+        report(f"{mode}: map", len(data), perf_counter() - step)
+        step = perf_counter()
+        for i in reads:
+            shuffled[int(i)]
+        report(f"{mode}: random reads", len(reads), perf_counter() - step)
+        report(f"{mode}: total", len(data), perf_counter() - start)
+
+
+class LoopMaskingCollator(DataCollatorForLanguageModeling):
+    # pad, then mask every row up to its last assistant marker, as PromptMaskingDataCollator did it
+    def __call__(self, features, return_tensors=None):
+        data = super().__call__(features, return_tensors)
+        assistant_id = self.tokenizer("<|assistant|>")['input_ids'][0]
+        for i in range(len(data['labels'])):
+            assistant_indices = np.where(data['labels'][i] == assistant_id)[0]
+            if len(assistant_indices) > 0:
+                data['labels'][i, :assistant_indices[-1]] = -100
+        return data
+
+
+def preprocess_labels(data, tokenizer, assistant_id):
+    table = preprocess_arrow(data, tokenizer, '\n')
+    mask = lambda tokens, offsets: prompt_loss_mask(tokens, offsets, assistant_id) & (tokens != tokenizer.pad_token_id)
+    return table.append_column('labels', masked_labels(table['input_ids'], mask))
+
+
+def benchmark_collation(args):
+    # collation only, the rows of every batch are read beforehand
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    assistant_id = tokenizer("<|assistant|>")['input_ids'][0]
+    data = load_data(args)
+    features = data.features.copy()
+    features['input_ids'] = Sequence(Value('int32'))
+    features['attention_mask'] = Sequence(Value('int8'))
+    features['labels'] = Sequence(Value('int32'))
+    tokenized = data.with_format("arrow").map(lambda d: preprocess_labels(d, tokenizer, assistant_id), batched=True,
+                                             features=features).with_format(None)
+    tokenized = tokenized.select_columns(['input_ids', 'attention_mask', 'labels'])
+    batches = np.random.default_rng(0).integers(0, len(tokenized), (args.batches, args.batch_size))
+    runs = [
+        ("per-row masking collator", LoopMaskingCollator(tokenizer=tokenizer, mlm=False), tokenized, ['input_ids']),
+        ("padding collator, list rows", LabelPaddingCollator(tokenizer), tokenized, ['input_ids', 'labels']),
+        ("padding collator, numpy rows", LabelPaddingCollator(tokenizer), tokenized.with_format("numpy"),
+         ['input_ids', 'labels']),
+    ]
+    for name, collator, dataset, columns in runs:
+        rows = [[{c: dataset[int(i)][c] for c in columns} for i in batch] for batch in batches]
+        start = perf_counter()
+        for batch in rows:
+            collator(batch)
+        seconds = perf_counter() - start
+        print(f'{name:<40} {seconds/len(rows)*1000:8.3f} ms per batch of {args.batch_size}')
+
+
+def benchmark_encoding(args):
+    # training texts to ids, tokenizer() against the TemplateEncoder of preprocess_sft
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    texts = sft_text(load_data(args).with_format("arrow")[:], '\n', tokenizer.eos_token).to_pylist()
+    print("Examples", len(texts))
+    encoder = TemplateEncoder(tokenizer)
+    runs = [
+        ("tokenizer", lambda: tokenizer(texts, truncation=True)['input_ids']),
+        ("template encoder", lambda: encoder.encode(texts)),
+    ]
+    for name, run in runs:
+        encoder.pieces.clear()
+        start = perf_counter()
+        run()
+        report(name, len(texts), perf_counter() - start)
+
+
+benchmarks = {
+    "formatting": benchmark_formatting,
+    "shuffle": benchmark_shuffle,
+    "collation": benchmark_collation,
+    "encoding": benchmark_encoding,
+}
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    benchmarks[args.benchmark](args)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,180 @@
+import time
+import resource
+import torch
+from transformers import TrainerCallback
+
+# Training throughput in TensorBoard (throughput/* next to the Trainer's own logs in logging_dir),
+# summed or averaged over the ranks every logging_steps optimizer steps:
+#   tokens_per_second, supervised_tokens_per_second   non-padding and label tokens, all ranks
+#   padding_fraction                                   padding tokens of the micro-batches
+#   data_wait_seconds, compute_seconds, optimizer_seconds   per optimizer step, mean over ranks
+#   data_starved_fraction                              micro-batches the training process waited
+#                                                      more than starvation_threshold seconds for
+#   data_wait_max_seconds                              longest wait for a micro-batch, all ranks
+#   peak_rss_gb                                        peak host RSS of the busiest rank
+#   checkpoint_stall_seconds                           time a save held training up, slowest rank
+#
+# A step is cut into phases at points the Trainer exposes: a forward pre-hook on the model starts
+# the compute of a micro-batch (and reads its tokens), on_substep_end and the end of the step
+# start waiting for the next batch, and a step pre-hook on the training optimizer starts the
+# update. Data wait is then the data loader plus the copy to the device, compute the forward and
+# backward passes with the gradient reduction and clipping. Without synchronization the host runs
+# ahead of the device and the phases only add up over many steps, so with synchronize the step
+# that ends at each logging step is synchronized at its phase ends and the per step phase times
+# are those of the synchronized steps. The token rates and the data waits count all steps.
+# Evaluation, saving and logging time is left out of the steps, the stall of a save (with
+# AsyncCheckpointMixin only the copy of the state to host memory) is logged at its step on its own.
+
+
+class ThroughputCallback(TrainerCallback):
+    def __init__(self, synchronize=True, starvation_threshold=0.01):
+        self.synchronize = synchronize
+        # a ready batch only has to be copied to the device, which takes well under this
+        self.starvation_threshold = starvation_threshold
+        self.writer = None
+        self.hooks = []
+
+    def on_train_begin(self, args, state, control, model=None, optimizer=None, **kwargs):
+        if state.is_world_process_zero:
+            from torch.utils.tensorboard import SummaryWriter
+            self.writer = SummaryWriter(log_dir=args.logging_dir)
+        # the torch optimizer under the Accelerate and DeepSpeed wrappers, whose step() ends in its own
+        while hasattr(optimizer, "optimizer"):
+            optimizer = optimizer.optimizer
+        self.hooks = [model.register_forward_pre_hook(self.on_forward, with_kwargs=True),
+                      optimizer.register_step_pre_hook(self.on_optimizer_step)]
+        self.device = args.device
+        self.reset()
+        self.phase = "wait"
+        self.sampled = self.sampled_step(state.global_step + 1, args)
+        self.skip()
+
+    def sampled_step(self, step, args):
+        return self.synchronize and step % args.logging_steps == 0
+
+    def reset(self):
+        # tokens, padded tokens, supervised tokens, on the device until they are reported
+        self.counts = torch.zeros(3, dtype=torch.int64, device=self.device)
+        self.times = {"wait": 0.0, "compute": 0.0, "optimizer": 0.0}
+        self.steps = 0
+        # the same for the synchronized steps
+        self.sampled_times = dict(self.times)
+        self.sampled_steps = 0
+        # micro-batches, the starved ones and the longest wait
+        self.batches = 0
+        self.starved = 0
+        self.max_wait = 0.0
+
+    def switch(self, phase, synchronize=False):
+        if synchronize and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.times[self.phase] += now - self.mark
+        if self.sampled:
+            self.sampled_times[self.phase] += now - self.mark
+        self.mark = now
+        self.phase = phase
+
+    def skip(self):
+        # time outside the training steps, a synchronized step starts from an idle device
+        if self.sampled and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.mark = time.perf_counter()
+
+    def on_forward(self, module, args, kwargs):
+        # evaluation and the reference model of DPO run without gradients
+        if not (module.training and torch.is_grad_enabled()):
+            return
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if input_ids is None:
+            return
+        # packed rows have document ids in the attention mask, padding is 0 either way
+        attention_mask = kwargs.get("attention_mask")
+        labels = kwargs.get("labels")
+        self.counts[0] += (attention_mask != 0).sum() if attention_mask is not None else input_ids.numel()
+        self.counts[1] += input_ids.numel()
+        if labels is not None:
+            self.counts[2] += (labels[..., 1:] != -100).sum()
+        waited = time.perf_counter() - self.mark
+        self.batches += 1
+        self.starved += waited > self.starvation_threshold
+        self.max_wait = max(self.max_wait, waited)
+        self.switch("compute")
+
+    def on_optimizer_step(self, optimizer, args, kwargs):
+        if self.phase == "compute":
+            self.switch("optimizer", synchronize=self.sampled)
+
+    def on_substep_end(self, args, state, control, **kwargs):
+        self.switch("wait", synchronize=self.sampled)
+
+    def on_step_end(self, args, state, control, **kwargs):
+        sample_next = self.sampled_step(state.global_step + 1, args)
+        self.switch("wait", synchronize=self.sampled or sample_next)
+        self.steps += 1
+        self.sampled_steps += self.sampled
+        self.sampled = sample_next
+        if state.global_step % args.logging_steps == 0:
+            self.report(args, state)
+            self.skip()
+
+    def on_log(self, args, state, control, **kwargs):
+        self.skip()
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self.skip()
+
+    def on_save(self, args, state, control, **kwargs):
+        # the save comes right after the logging and evaluation of the step, which end in skip()
+        if self.synchronize and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        stall = torch.tensor([time.perf_counter() - self.mark], dtype=torch.float64, device=self.device)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(stall, op=torch.distributed.ReduceOp.MAX)
+        if self.writer is not None:
+            self.writer.add_scalar("throughput/checkpoint_stall_seconds", stall.item(), state.global_step)
+            self.writer.flush()
+        self.skip()
+
+    def report(self, args, state):
+        # the phases of the synchronized steps if there are any
+        phases, phase_steps = (self.sampled_times, self.sampled_steps) if self.sampled_steps else (self.times, self.steps)
+        times = [self.times["wait"], self.times["compute"], self.times["optimizer"], self.batches, self.starved,
+                 phases["wait"], phases["compute"], phases["optimizer"]]
+        sums = torch.cat([self.counts.double(), torch.tensor(times, dtype=torch.float64, device=self.device)])
+        peaks = torch.tensor([resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024.0, self.max_wait],
+                             dtype=torch.float64, device=self.device)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(sums)
+            torch.distributed.all_reduce(peaks, op=torch.distributed.ReduceOp.MAX)
+        tokens, padded, supervised, wait, compute, optimizer, batches, starved, *phases = sums.tolist()
+        peak_rss, max_wait = peaks.tolist()
+        ranks, steps = args.world_size, max(phase_steps, 1)
+        seconds = (wait + compute + optimizer) / ranks
+        metrics = {
+            "padding_fraction": 1 - tokens / padded if padded else 0.0,
+            "data_wait_seconds": phases[0] / ranks / steps,
+            "compute_seconds": phases[1] / ranks / steps,
+            "optimizer_seconds": phases[2] / ranks / steps,
+            "peak_rss_gb": peak_rss / 2**30,
+            "data_wait_max_seconds": max_wait,
+        }
+        if batches:
+            metrics["data_starved_fraction"] = starved / batches
+        if seconds:
+            metrics["tokens_per_second"] = tokens / seconds
+            if supervised:
+                metrics["supervised_tokens_per_second"] = supervised / seconds
+        if self.writer is not None:
+            for name, value in metrics.items():
+                self.writer.add_scalar(f"throughput/{name}", value, state.global_step)
+            self.writer.flush()
+        self.reset()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
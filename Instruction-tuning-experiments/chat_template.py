@@ -0,0 +1,200 @@
+import re
+import json
+import numpy as np
+
+from indexed_dataset import token_rows, conversation_loss_mask
+
+# Role markers and turn layout of the prompt formats, shared by the dataset readers (training) and
+# generate.py, and TemplateEncoder, which encodes the texts built with them to token ids.
+
+user_token = "<|user|>"
+assistant_token = "<|assistant|>"
+chatml_start_token = "<|im_start|>"
+chatml_end_token = "<|im_end|>"
+
+
+class ChatTemplate:
+    # A turn is prefix + text + suffix. sep goes between a plain format role marker and the text,
+    # the readers have used both "" and " " and the training data depends on which.
+    def __init__(self, chatml_format=False, sep=""):
+        self.chatml_format = chatml_format
+        self.sep = sep
+
+    def affixes(self, role):
+        if self.chatml_format:
+            return chatml_start_token + role + "\n", chatml_end_token
+        return (assistant_token if role == "assistant" else user_token) + self.sep, ""
+
+    def turn(self, role, text):
+        prefix, suffix = self.affixes(role)
+        return prefix + text + suffix
+
+    def user(self, text):
+        return self.turn("user", text)
+
+    def assistant(self, text):
+        return self.turn("assistant", text)
+
+    def generation_prompt(self):
+        # opens the assistant turn after a user turn, for generation
+        if self.chatml_format:
+            return "\n" + chatml_start_token + "assistant\n"
+        return "\n" + assistant_token
+
+
+def turn_marker_ids(tokenizer):
+    # the role marker ids of the format the tokenizer has special tokens for, see conversation_loss_mask
+    special_tokens = set(tokenizer.additional_special_tokens)
+    if assistant_token in special_tokens and user_token in special_tokens:
+        return ('plain',
+                tokenizer.convert_tokens_to_ids(user_token),
+                tokenizer.convert_tokens_to_ids(assistant_token))
+    elif chatml_start_token in special_tokens:
+        return ('chatml',
+                tokenizer.convert_tokens_to_ids(chatml_start_token),
+                tokenizer("assistant\n", add_special_tokens=False)['input_ids'][0])
+    return None
+
+
+# TemplateEncoder gives the same ids as tokenizer(texts, truncation=True)["input_ids"] without
+# tokenizing the special tokens: the texts are split at them, their ids are looked up once and
+# the text in between is tokenized one distinct piece at a time (an OASST message recurs in the
+# context of every reply below it) and cached. Byte-level BPE tokenizers (BLOOM, Poro) encode
+# the pieces between special tokens independently anyway. Other tokenizers (a prefix space
+# added per piece, a normalizer, special tokens that strip whitespace) are not known to, and
+# encode whole texts. Splicing is also checked against tokenizer() on a probe text and on a
+# sample of every batch it encodes, a mismatch switches to whole texts for good.
+#
+# The spans of the assistant turns, from the assistant marker to the next role marker or the
+# end of the text (the supervised tokens of conversation_loss_mask), come out of the splicing.
+
+probe_text = "Hei.\n<|user|> Mitä kuuluu?\n<|assistant|>Hyvää, kiitos! <|im_start|>user\nJa sinulle?<|im_end|>\n"
+
+
+def splices_exactly(tokenizer):
+    # byte-level pre-tokenization without an added prefix space, no normalizer, and special
+    # tokens that leave the whitespace around them alone
+    if not tokenizer.is_fast:
+        return False
+    spec = json.loads(tokenizer.backend_tokenizer.to_str())
+    pre_tokenizer = spec.get("pre_tokenizer") or {}
+    steps = pre_tokenizer.get("pretokenizers", [pre_tokenizer])
+    return (spec.get("normalizer") is None
+            and all(step.get("type") == "ByteLevel" and not step.get("add_prefix_space") for step in steps)
+            and not any(token.get("lstrip") or token.get("rstrip") for token in spec.get("added_tokens", [])))
+
+
+class TemplateEncoder:
+    def __init__(self, tokenizer, truncation=True, cache_size=1 << 20, sample_size=8):
+        self.tokenizer = tokenizer
+        self.max_length = tokenizer.model_max_length if truncation else None
+        self.cache_size = cache_size
+        # texts per batch checked against tokenizer()
+        self.sample_size = sample_size
+        self.pieces = {}
+        added = sorted(tokenizer.get_added_vocab().items(), key=lambda item: -len(item[0]))
+        self.special_ids = dict(added)
+        self.pattern = re.compile("(" + "|".join(re.escape(token) for token, _ in added) + ")") if added else None
+        # the ids tokenizer() adds around every text (BOS for Llama, nothing for BLOOM)
+        sentinel = tokenizer.eos_token_id or 0
+        wrapped = tokenizer.build_inputs_with_special_tokens([sentinel])
+        start = wrapped.index(sentinel)
+        self.prefix, self.suffix = wrapped[:start], wrapped[start + 1:]
+        self.turn_marker_ids = turn_marker_ids(tokenizer)
+        markers = self.turn_marker_ids[1:] if self.turn_marker_ids else ()
+        self.role_ids = set(markers[:2]) if self.turn_marker_ids and self.turn_marker_ids[0] == 'plain' else set(markers[:1])
+        self.exact = self.pattern is not None and splices_exactly(tokenizer) and self.check([probe_text])
+        self.pieces.clear()
+        if not self.exact:
+            print(f"TemplateEncoder: {type(tokenizer).__name__} encodes whole texts")
+
+    def check(self, texts, encoded=None):
+        # a sample of the texts spliced as tokenizer() encodes them
+        tokens, offsets, _ = encoded if encoded is not None else self.encode_spliced(texts)
+        sample = np.unique(np.linspace(0, len(texts) - 1, min(self.sample_size, len(texts))).astype(np.int64))
+        expected = self.tokenizer([texts[i] for i in sample], truncation=self.max_length is not None)["input_ids"]
+        return all(tokens[offsets[i]:offsets[i + 1]].tolist() == ids for i, ids in zip(sample, expected))
+
+    def encode_pieces(self, pieces):
+        new = [piece for piece in dict.fromkeys(pieces) if piece not in self.pieces]
+        if len(self.pieces) + len(new) > self.cache_size:
+            self.pieces.clear()
+            new = list(dict.fromkeys(pieces))
+        if new:
+            # the Rust tokenizer directly, BatchEncoding would turn every field into Python lists
+            for piece, encoding in zip(new, self.tokenizer.backend_tokenizer.encode_batch(new, add_special_tokens=False)):
+                self.pieces[piece] = encoding.ids
+
+    def opens_assistant_turn(self, parts, k):
+        # parts[k] is a special token
+        if self.turn_marker_ids is None:
+            return False
+        if self.turn_marker_ids[0] == 'plain':
+            return self.special_ids[parts[k]] == self.turn_marker_ids[2]
+        return parts[k] == chatml_start_token and parts[k + 1].startswith("assistant\n")
+
+    def encode(self, texts):
+        # flat tokens, example offsets and the (example, start, end) token spans of the assistant turns
+        if not self.exact:
+            return self.encode_texts(texts)
+        encoded = self.encode_spliced(texts)
+        if texts and not self.check(texts, encoded):
+            self.exact = False
+            self.pieces.clear()
+            print(f"TemplateEncoder: {type(self.tokenizer).__name__} splices a text differently from "
+                  f"tokenizer(), encodes whole texts from here on")
+            return self.encode_texts(texts)
+        return encoded
+
+    def encode_spliced(self, texts):
+        split = [self.pattern.split(text) for text in texts]
+        # the parts alternate text, special token, text, ...
+        self.encode_pieces([piece for parts in split for piece in parts[::2] if piece])
+        ids = []
+        lengths = []
+        spans = []
+        for row, parts in enumerate(split):
+            row_ids = list(self.prefix)
+            span_start = None
+            for k, part in enumerate(parts):
+                if k % 2 == 0:
+                    row_ids.extend(self.pieces[part] if part else ())
+                    continue
+                token_id = self.special_ids[part]
+                if token_id in self.role_ids:
+                    if span_start is not None:
+                        spans.append((row, span_start, len(row_ids)))
+                    span_start = len(row_ids) if self.opens_assistant_turn(parts, k) else None
+                row_ids.append(token_id)
+            row_ids.extend(self.suffix)
+            if span_start is not None:
+                spans.append((row, span_start, len(row_ids)))
+            if self.max_length is not None and len(row_ids) > self.max_length:
+                row_ids = row_ids[:self.max_length]
+            ids.extend(row_ids)
+            lengths.append(len(row_ids))
+        spans = np.array(spans, dtype=np.int64).reshape(-1, 3)
+        if self.max_length is not None and len(spans):
+            spans[:, 2] = np.minimum(spans[:, 2], np.array(lengths)[spans[:, 0]])
+            spans = spans[spans[:, 1] < spans[:, 2]]
+        return np.array(ids, dtype=np.int64), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64), spans
+
+    def encode_texts(self, texts):
+        input_ids = self.tokenizer(texts, truncation=self.max_length is not None)["input_ids"]
+        offsets = np.concatenate([[0], np.cumsum([len(ids) for ids in input_ids])]).astype(np.int64)
+        tokens = np.fromiter((i for ids in input_ids for i in ids), dtype=np.int64, count=offsets[-1])
+        if self.turn_marker_ids is None:
+            return tokens, offsets, np.zeros((0, 3), dtype=np.int64)
+        return tokens, offsets, mask_spans(conversation_loss_mask(tokens, offsets, self.turn_marker_ids), offsets)
+
+
+def mask_spans(mask, offsets):
+    # (example, start, end) runs of a flat token mask, positions within the example
+    row_start = np.zeros(len(mask), dtype=bool)
+    row_start[offsets[:-1][np.diff(offsets) > 0]] = True
+    previous = np.concatenate([[False], mask[:-1]]) & ~row_start
+    starts = np.flatnonzero(mask & ~previous)
+    following = np.concatenate([mask[1:], [False]]) & ~np.concatenate([row_start[1:], [True]])
+    ends = np.flatnonzero(mask & ~following) + 1
+    rows = token_rows(offsets)[starts]
+    return np.stack([rows, starts - offsets[rows], ends - offsets[rows]], axis=1).reshape(-1, 3)
@@ -0,0 +1,118 @@
+import os
+import copy
+import time
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+# Checkpoint files written on a background thread. Inside capture() the tensor files the Trainer,
+# PEFT and DeepSpeed's checkpoint engine save (torch.save and safetensors' save_file) are
+# snapshotted instead: every tensor is copied into pinned host memory, which is kept and reused
+# by the next checkpoint of the same shapes, and the file is written from the copy by a single
+# writer thread while training goes on. Small files written with open() (configs, trainer state,
+# DeepSpeed's latest tag) are written at once. The save functions are replaced for the whole
+# process, only the thread that entered capture() has its saves deferred, other threads save
+# as before.
+
+
+def save_functions():
+    import safetensors.torch
+    import transformers.modeling_utils
+    import peft.peft_model
+    return [(torch, "save"),
+            (safetensors.torch, "save_file"),
+            (transformers.modeling_utils, "safe_save_file"),
+            (peft.peft_model, "safe_save_file")]
+
+
+class AsyncCheckpointWriter:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint-writer")
+        self.jobs = []
+        self.buffers = []
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        self.copied = 0
+        self.bytes = 0
+        self.write_seconds = 0.0
+
+    @contextmanager
+    def capture(self):
+        self.wait()
+        self.reset()
+        originals = [(module, name, getattr(module, name)) for module, name in save_functions()]
+        self.thread = threading.get_ident()
+        try:
+            for module, name, save in originals:
+                setattr(module, name, self.deferred(save))
+            yield self
+        finally:
+            for module, name, save in originals:
+                setattr(module, name, save)
+            self.thread = None
+
+    def deferred(self, save):
+        def save_later(obj, f, *args, **kwargs):
+            # file objects are written to by the caller right after, they can't wait
+            if threading.get_ident() != self.thread or not isinstance(f, (str, os.PathLike)):
+                return save(obj, f, *args, **kwargs)
+            obj = self.snapshot(obj, {})
+            event = None
+            if torch.cuda.is_available():
+                event = torch.cuda.Event()
+                event.record()
+            self.jobs.append(self.executor.submit(self.write, save, obj, f, event, args, kwargs))
+        return save_later
+
+    def snapshot(self, obj, memo):
+        if isinstance(obj, torch.Tensor):
+            if id(obj) not in memo:
+                memo[id(obj)] = self.buffer(obj).copy_(obj.detach(), non_blocking=True)
+            return memo[id(obj)]
+        if isinstance(obj, dict):
+            # keeps the type of OrderedDicts and the like
+            snapshot = copy.copy(obj)
+            for key, value in obj.items():
+                snapshot[key] = self.snapshot(value, memo)
+            return snapshot
+        if isinstance(obj, (list, tuple)) and type(obj) in (list, tuple):
+            return type(obj)(self.snapshot(value, memo) for value in obj)
+        # learning rates in the param_groups and such change in place as training goes on
+        return copy.deepcopy(obj)
+
+    def buffer(self, tensor):
+        # the n-th tensor of a checkpoint reuses the n-th buffer of the last one
+        i = self.copied
+        self.copied += 1
+        self.bytes += tensor.numel() * tensor.element_size()
+        if i < len(self.buffers) and self.buffers[i].shape == tensor.shape and self.buffers[i].dtype == tensor.dtype:
+            return self.buffers[i]
+        buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=torch.cuda.is_available())
+        if i < len(self.buffers):
+            self.buffers[i] = buffer
+        else:
+            self.buffers.append(buffer)
+        return buffer
+
+    def write(self, save, obj, f, event, args, kwargs):
+        if event is not None:
+            event.synchronize()
+        start = time.perf_counter()
+        save(obj, f, *args, **kwargs)
+        self.write_seconds += time.perf_counter() - start
+
+    def submit(self, fn, *args):
+        # runs after the files submitted so far
+        self.jobs.append(self.executor.submit(fn, *args))
+
+    def done(self):
+        return all(job.done() for job in self.jobs)
+
+    def wait(self):
+        jobs, self.jobs = self.jobs, []
+        for job in jobs:
+            # raises the errors of the writes
+            job.result()
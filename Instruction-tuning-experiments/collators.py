@@ -0,0 +1,44 @@
+import numpy as np
+import torch
+
+# Collators for data that comes with its labels (the labels column of the tokenized SFT data,
+# IndexedDataset, PackedDataset). There is no masking left to do, a batch is padded with one
+# concatenate and one scatter per column.
+
+
+def pad_sequences(sequences, pad_value, padding_side="right"):
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    width = int(lengths.max()) if len(lengths) else 0
+    positions = np.arange(width)
+    if padding_side == "left":
+        filled = positions >= width - lengths[:, None]
+    else:
+        filled = positions < lengths[:, None]
+    padded = np.full((len(sequences), width), pad_value, dtype=np.int64)
+    if width:
+        padded[filled] = np.concatenate(sequences)
+    return padded, filled
+
+
+class PaddingCollator:
+    # pad_values: column -> padding value. Without an attention_mask column, it marks the tokens.
+    def __init__(self, pad_values, padding_side="right"):
+        self.pad_values = pad_values
+        self.padding_side = padding_side
+
+    def __call__(self, features, return_tensors=None):
+        batch = {}
+        for key, pad_value in self.pad_values.items():
+            padded, filled = pad_sequences([f[key] for f in features], pad_value, self.padding_side)
+            batch[key] = torch.from_numpy(padded)
+        if "attention_mask" not in batch:
+            batch["attention_mask"] = torch.from_numpy(filled.astype(np.int64))
+        # per-row source of the eval rows, for the eval loss per source (EvalMetricsMixin)
+        if features and "source_id" in features[0]:
+            batch["source_id"] = torch.tensor([int(f["source_id"]) for f in features])
+        return batch
+
+
+class LabelPaddingCollator(PaddingCollator):
+    def __init__(self, tokenizer):
+        super().__init__({"input_ids": tokenizer.pad_token_id, "labels": -100}, tokenizer.padding_side)
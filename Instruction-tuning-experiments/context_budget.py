@@ -0,0 +1,65 @@
+import numpy as np
+
+# Fits OASST threads into the model context before they are tokenized. Every message is
+# tokenized once, as the "\n"-prefixed turn it becomes in a context, and an example's length is
+# estimated from those counts (a message is an ancestor of many examples, so the thread is never
+# tokenized just to measure it). The oldest context turns are dropped until the estimate fits
+# max_length; the prompt and the response are kept whole. Examples whose prompt and response
+# alone don't fit lose all their context and are left to filter_by_length.
+# This changes the training data, so it is off by default (--context_budget): examples that fit
+# are unchanged, but long threads that huggingface-finetune.py would drop by length (and
+# SFTTrainer in train_sft.py would cut off at the end) are trained on with less context instead.
+# The estimate can be off by a few tokens where a message boundary tokenizes differently, so an
+# example right at max_length may lose a turn it had room for.
+
+
+class ContextBudget:
+    # separator, end_of_text: what the training text is assembled with (sft_text)
+    def __init__(self, tokenizer, max_length, separator="\n", end_of_text=""):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        # separator and end of text, the special tokens the tokenizer adds and the leading " " of the context
+        self.reserve = (len(tokenizer(separator + end_of_text, add_special_tokens=False)['input_ids'])
+                        + tokenizer.num_special_tokens_to_add() + 1)
+
+    def turn_lengths(self, turns, batch_size=1000):
+        lengths = []
+        for start in range(0, len(turns), batch_size):
+            batch = ["\n" + turn for turn in turns[start:start + batch_size]]
+            lengths.extend(self.tokenizer(batch, add_special_tokens=False, return_length=True)['length'])
+        return np.array(lengths, dtype=np.int64)
+
+    def context_turns(self, context_lengths, prompt_length, response_length):
+        # number of most recent context turns that fit next to the prompt and the response
+        free = self.max_length - self.reserve - prompt_length - response_length
+        used = np.cumsum(np.asarray(context_lengths, dtype=np.int64)[::-1])
+        return int(np.searchsorted(used, free, side="right"))
+
+
+class TreeBudget:
+    # a ContextBudget over the messages of an OasstTree, the turn lengths are cached per node
+    def __init__(self, budget, tree, format_turn):
+        self.budget = budget
+        self.tree = tree
+        self.lengths = budget.turn_lengths([format_turn(node) for node in range(len(tree))])
+        self.examples = 0
+        self.trimmed = 0
+        self.dropped_turns = 0
+        self.too_long = 0
+
+    def context_turns(self, question, answer):
+        ancestors = self.tree.path(question)[:-1]
+        turns = self.budget.context_turns(self.lengths[ancestors], self.lengths[question], self.lengths[answer])
+        self.examples += 1
+        if turns < len(ancestors):
+            self.trimmed += 1
+            self.dropped_turns += len(ancestors) - turns
+        if self.lengths[question] + self.lengths[answer] + self.budget.reserve > self.budget.max_length:
+            self.too_long += 1
+        return turns
+
+    def report(self, path):
+        if self.trimmed or self.too_long:
+            print(f"Context budget {self.budget.max_length}: dropped {self.dropped_turns} oldest turns from "
+                  f"{self.trimmed} of {self.examples} examples of {path} "
+                  f"({self.too_long} too long even without context)")
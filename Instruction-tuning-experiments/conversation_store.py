@@ -0,0 +1,102 @@
+import os
+import hashlib
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from oasst_tree import OasstTree
+from arrow_readers import read_jsonl_table
+
+# Parsed, columnar copy of an OASST JSONL dump. The JSONL is decoded once into an uncompressed
+# Arrow IPC file in the datasets cache (HF_DATASETS_CACHE/conversation_store, or
+# $CONVERSATION_STORE_DIR) and every later reader memory-maps that file instead of calling
+# json.loads on every line again. The data directory is only read. The store is rebuilt when the
+# source file changes size or modification time.
+
+store_schema = pa.schema([
+    ("message_id", pa.string()),
+    ("parent_id", pa.string()),
+    ("role", pa.string()),
+    ("text", pa.large_string()),
+    ("orig_text", pa.large_string()),
+    ("label_names", pa.list_(pa.string())),
+    ("label_values", pa.list_(pa.float64())),
+])
+
+
+def store_path(jsonl_path):
+    store_dir = os.environ.get("CONVERSATION_STORE_DIR")
+    if not store_dir:
+        import datasets.config
+        store_dir = os.path.join(datasets.config.HF_DATASETS_CACHE, "conversation_store")
+    # files of the same name in different directories get their own store
+    jsonl_path = os.path.abspath(jsonl_path)
+    digest = hashlib.blake2b(jsonl_path.encode(), digest_size=8).hexdigest()
+    return os.path.join(store_dir, f"{os.path.splitext(os.path.basename(jsonl_path))[0]}-{digest}.arrow")
+
+
+def source_metadata(jsonl_path):
+    st = os.stat(jsonl_path)
+    return {b"source_size": str(st.st_size).encode(), b"source_mtime_ns": str(st.st_mtime_ns).encode()}
+
+
+def is_store_current(jsonl_path, path):
+    if not os.path.exists(path):
+        return False
+    with pa.memory_map(path) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    expected = source_metadata(jsonl_path)
+    return all(metadata.get(key) == value for key, value in expected.items())
+
+
+def parse_oasst_jsonl(jsonl_path):
+    # multi-threaded native JSON parsing, only the columns the store keeps
+    schema = pa.schema([
+        ("message_id", pa.string()),
+        ("parent_id", pa.string()),
+        ("role", pa.string()),
+        ("text", pa.large_string()),
+        ("orig_text", pa.large_string()),
+        ("labels", pa.struct([("name", pa.list_(pa.string())), ("value", pa.list_(pa.float64()))])),
+    ])
+    table = read_jsonl_table(jsonl_path, schema)
+    labels = table["labels"]
+    empty_names = pa.scalar([], pa.list_(pa.string()))
+    empty_values = pa.scalar([], pa.list_(pa.float64()))
+    parent_id = table["parent_id"]
+    columns = {
+        "message_id": table["message_id"],
+        # "" and null both mark a root
+        "parent_id": pc.if_else(pc.equal(parent_id, ""), pa.scalar(None, pa.string()), parent_id),
+        "role": table["role"],
+        "text": table["text"],
+        "orig_text": table["orig_text"],
+        "label_names": pc.struct_field(labels, "name").fill_null(empty_names),
+        "label_values": pc.struct_field(labels, "value").fill_null(empty_values),
+    }
+    return pa.table(columns, schema=store_schema)
+
+
+def build_store(jsonl_path, path=None):
+    path = path or store_path(jsonl_path)
+    table = parse_oasst_jsonl(jsonl_path).replace_schema_metadata(source_metadata(jsonl_path))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # concurrent builders (one per rank) each write their own file and atomically replace
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_store(jsonl_path):
+    path = store_path(jsonl_path)
+    if not is_store_current(jsonl_path, path):
+        print("Building conversation store", path)
+        build_store(jsonl_path, path)
+    # zero-copy: columns point into the memory-mapped file
+    return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+
+def load_oasst_tree(jsonl_path, text_cols=("text", "orig_text"), label_names=()):
+    return OasstTree.from_table(load_store(jsonl_path), text_cols=text_cols, label_names=label_names)
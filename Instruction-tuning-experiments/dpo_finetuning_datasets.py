@@ -1,14 +1,18 @@
 from datasets import Dataset
+from datasets.table import InMemoryTable
 from pathlib import Path
 import os
 import re
 import json
 import numpy as np
+import pyarrow as pa
+from logging import warning
+
+from conversation_store import load_oasst_tree
+from arrow_readers import dolly_lang_alignment_table, ultrafeedback_table, hh_table, string_schema
+from instruction_finetuning_datasets import shuffle_dataset
+from chat_template import ChatTemplate, user_token, assistant_token
 
-user_token = "<|user|>"
-assistant_token = "<|assistant|>"
-chatml_start_token = "<|im_start|>"
-chatml_end_token = "<|im_end|>"
 anthropic_user_token = "\n\nHuman:"
 anthropic_asst_token = "\n\nAssistant:"
 
@@ -17,54 +21,29 @@ def read_oasst(path, lang='fi', score_type='toxicity', max_examples=0):
         text_col = "text"
     else:
         text_col = "orig_text"
-    path = Path(path)
-    with open(path, 'rb') as f:
-        oasst_dict = list(f)
-    questions_dict = {}
-    context_wq_dict = {}
-    answers_dict = {}
-    for index, json_str in enumerate(oasst_dict):
-        result = json.loads(json_str)
-        if result["role"] == "prompter":
-            question_combined = user_token + result[text_col]
-            questions_dict[result["message_id"]] = question_combined
-            context_wq_dict[result["message_id"]] = " "
-            if result["parent_id"]:
-                try:
-                    context_wq_dict[result["message_id"]] = context_wq_dict[result["parent_id"]]
-                except:
-                    context_wq_dict[result["message_id"]] = " "
-        elif result["role"] == "assistant":
-            if result['labels'] is not None and score_type in result['labels']['name']:
-                response_score_index = int(result['labels']['name'].index(score_type))
-                response_score = result['labels']['value'][response_score_index]
-                if result["parent_id"] in questions_dict:
-                    if result["parent_id"] not in answers_dict:
-                        answers_dict[result["parent_id"]] = {'question': questions_dict[result["parent_id"]],
-                                                             'context': '',
-                                                             'answers': []
-                                                             }
-                    answer_combined = assistant_token + result[text_col]
-                    answers_dict[result["parent_id"]]['answers'].append((answer_combined, response_score))
-                    if context_wq_dict[result["parent_id"]]:
-                        answers_dict[result["parent_id"]]["context"] = context_wq_dict[result["parent_id"]]
-                        context_wq_dict[result["message_id"]] = context_wq_dict[result["parent_id"]] + questions_dict[
-                            result["parent_id"]] + answer_combined
-                    else:
-                        context_wq_dict[result["message_id"]] = questions_dict[result["parent_id"]] + "\n" + answer_combined
-                    context_wq_dict[result["message_id"]] = context_wq_dict[result["parent_id"]] + "\n" + questions_dict[
-                        result["parent_id"]] + "\n" + answer_combined
+    tree = load_oasst_tree(path, text_cols=[text_col], label_names=[score_type])
+    scores = tree.labels[score_type]
+
+    template = ChatTemplate()
+
+    def format_turn(node):
+        return template.turn("assistant" if tree.is_assistant[node] else "user", tree.text(node, text_col))
+
     questions_list = []
     contexts_list = []
     answers_best_list = []
     answers_worst_list = []
-    for key in answers_dict:
+    for node in range(len(tree)):
+        if tree.is_assistant[node]:
+            continue
+        answers = [(format_turn(child), scores[child]) for child in tree.children(node)
+                   if tree.is_assistant[child] and not np.isnan(scores[child])]
         # sort answers by response score
-        sorted_answers = sorted(answers_dict[key]["answers"], key=lambda x: float(x[1]), reverse=True)
+        sorted_answers = sorted(answers, key=lambda x: float(x[1]), reverse=True)
         # only return prompts that have more than one answer
         if len(sorted_answers) > 1:
-            questions_list.append(answers_dict[key]["question"])
-            contexts_list.append(answers_dict[key]["context"])
+            questions_list.append(format_turn(node))
+            contexts_list.append(tree.context(node, format_turn))
             answers_best_list.append(sorted_answers[-1][0])
             answers_worst_list.append(sorted_answers[0][0])
     if max_examples > 0:
@@ -152,53 +131,26 @@ def read_oasst_lang_alignment(path):
         "fi": {"text": "text"},
         "en": {"text": "orig_text"}
     }
-    path = Path(path)
-    with open(path, 'rb') as f:
-        oasst_dict = list(f)
-    questions_dict = {}
-    context_wq_dict = {}
+    tree = load_oasst_tree(path, text_cols=[col_names[lang]["text"] for lang in languages])
+
+    template = ChatTemplate(sep=" ")
+
+    def turn_formatter(lang):
+        def format_turn(node):
+            return template.turn("assistant" if tree.is_assistant[node] else "user", tree.text(node, col_names[lang]["text"]))
+        return format_turn
+
+    format_turn = {lang: turn_formatter(lang) for lang in languages}
     context_return = []
-    # answers_return = []
     chosen_answers_return = []
     rejected_answers_return = []
     questions_return = []
-    for index, json_str in enumerate(oasst_dict):
-        # print("-"*20, "Index", index, "-"*20)
-        result = json.loads(json_str)
-        if result["role"] == "prompter":
-            questions_dict[result["message_id"]] = {lang: user_token + " " + result[col_names[lang]["text"]] for lang in languages}
-            context_wq_dict[result["message_id"]] = {lang: " " for lang in languages }
-            if result["parent_id"]:
-                try:
-                    context_wq_dict[result["message_id"]] = {lang: context_wq_dict[result["parent_id"]][lang] for lang in languages}
-                except:
-                    context_wq_dict[result["message_id"]] = {lang: " " for lang in languages}
-        elif result["role"] == "assistant":
-            try:
-                questions_return.extend([questions_dict[result["parent_id"]][lang] for lang in languages])
-                # print("Question:", questions_dict[result["parent_id"]])
-            except:
-                continue
-            answer_combined = {lang: assistant_token + " " + result[col_names[lang]["text"]] for lang in languages}
-            chosen_answers_return.extend([answer_combined[lang] for lang in languages])
-            rejected_answers_return.extend([answer_combined[lang] for lang in reversed(languages)])
-            # answers_return.append(answer_combined)
-            # print("Answer:", answer_combined)
-            # answers_return.append(result[text_col])
-            if context_wq_dict[result["parent_id"]]:
-                context_return.extend([context_wq_dict[result["parent_id"]][lang] for lang in languages])
-                # context_return.append(context_wq_dict[result["parent_id"]])
-                # print("Context:", context_wq_dict[result["parent_id"]])
-                # context_wq_dict[result["message_id"]] = context_wq_dict[result["parent_id"]] + questions_dict[result["parent_id"]] + result[text_col]
-                context_wq_dict[result["message_id"]] ={lang: context_wq_dict[result["parent_id"]][lang] + questions_dict[
-                    result["parent_id"]][lang] + answer_combined[lang] for lang in languages}
-            else:
-                # context_wq_dict[result["message_id"]] = questions_dict[result["parent_id"]] + "\n" + result[text_col]
-                context_wq_dict[result["message_id"]] = {lang: questions_dict[result["parent_id"]][lang] + "\n" + answer_combined[lang] 
-                                                         for lang in languages}
-            # context_wq_dict[result["message_id"]] = context_wq_dict[result["parent_id"]] + "\n\n" + questions_dict[result["parent_id"]] + "\n\n" + result[text_col]
-            context_wq_dict[result["message_id"]] = {lang: context_wq_dict[result["parent_id"]][lang] + "\n" + questions_dict[
-                result["parent_id"]][lang] + "\n" + answer_combined[lang] for lang in languages}
+    for question, answer in tree.prompt_answer_pairs():
+        questions_return.extend([format_turn[lang](question) for lang in languages])
+        answer_combined = {lang: format_turn[lang](answer) for lang in languages}
+        chosen_answers_return.extend([answer_combined[lang] for lang in languages])
+        rejected_answers_return.extend([answer_combined[lang] for lang in reversed(languages)])
+        context_return.extend([tree.context(question, format_turn[lang]) for lang in languages])
     return questions_return, context_return, chosen_answers_return, rejected_answers_return
 
 
@@ -242,201 +194,95 @@ def read_dolly_lang_alignment(path, max_examples=0):
     return prompts_list, contexts_list, answers_chosen_list, answers_rejected_list
 
 
-def read_data_dpo(data="oasst", split="train", lang="fi", shuffle_data=True, max_examples=10000):
-    questions = []
-    context = []
-    answers_best = []
-    answers_worst = []
-    if "train" in split:
-        if "oasst" in data:
-            if "lang" in data:
-                oasst_questions, oasst_context, oasst_answers_best, oasst_answers_worst = read_oasst_lang_alignment("data/oasst-fi/oasst1-fi-train-filter.jsonl")
-                questions = questions + oasst_questions
-                context = context + oasst_context
-                answers_best = answers_best + oasst_answers_best
-                answers_worst = answers_worst + oasst_answers_worst
-                print("Size of oasst lang alignment training data", len(questions))
-            else:
-                if "lang" == "both":
-                    languages = ["fi", "en"]
-                else:
-                    languages = [lang]
-                for la in languages:
-                    oasst_questions, oasst_context, oasst_answers_best, oasst_answers_worst = read_oasst("data/oasst-fi/oasst1-fi-train-filter.jsonl",
-                                                                                                     lang=la,
-                                                                                                     max_examples=max_examples)
-                    questions = questions + oasst_questions
-                    context = context + oasst_context
-                    answers_best = answers_best + oasst_answers_best
-                    answers_worst = answers_worst + oasst_answers_worst
-                print("Size of oasst preference training data", len(questions))
-        if "ultrafeedback" in data:
-            ultra_questions, ultra_context, ultra_answers_best, ultra_answers_worst = read_ultrafeedback("data/UltraFeedback/ultrafeedback-train.jsonl",
-                                                                                                         max_examples=max_examples)
-            questions = questions + ultra_questions
-            context = context + ultra_context
-            answers_best = answers_best + ultra_answers_best
-            answers_worst = answers_worst + ultra_answers_worst
-            print("Size of ultrafeedback training data", len(questions))
-        if "dolly" in data:
-            dolly_questions, dolly_context, dolly_answers_best, dolly_answers_worst = read_dolly_lang_alignment("data/dolly-fi/dolly-fi-train.jsonl",
-                                                                                                                max_examples=max_examples)
-            questions = questions + dolly_questions
-            context = context + dolly_context
-            answers_best = answers_best + dolly_answers_best
-            answers_worst = answers_worst + dolly_answers_worst
-            print("Size of dolly training data", len(questions))
-        if "hh" in data:
-            parent_path = "/scratch/project_462000319/finetuning_data/hh_rlhf"
-            if "helpful" in data:
-                hh_questions, hh_context, hh_answers_best, hh_answers_worst = read_hh(os.path.join(parent_path, "helpful-base-train.jsonl"),
-                                                                                  max_examples=max_examples)
-            
-                questions = questions + hh_questions
-                context = context + hh_context
-                answers_best = answers_best + hh_answers_best
-                answers_worst = answers_worst + hh_answers_worst
-                print("Size of hh helpful training data", len(questions))
-            if "harmless" in data:
-                hh_questions, hh_context, hh_answers_best, hh_answers_worst = read_hh(os.path.join(parent_path, "harmless-base-train.jsonl"),
-                                                                                  max_examples=max_examples)
-                questions = questions + hh_questions
-                context = context + hh_context
-                answers_best = answers_best + hh_answers_best
-                answers_worst = answers_worst + hh_answers_worst
-                print("Size of hh harmless training data", len(questions))
-            else:
-                hh_questions, hh_context, hh_answers_best, hh_answers_worst = read_hh(os.path.join(parent_path, "hh_rlhf-train.jsonl"),
-                                                                                      max_examples=max_examples)
-                questions = questions + hh_questions
-                context = context + hh_context
-                answers_best = answers_best + hh_answers_best
-                answers_worst = answers_worst + hh_answers_worst
-                print("Size of hh training data", len(questions))
-    elif "valid" in split:
-        if "oasst" in data:
-            if "lang" in data:
-                oasst_questions, oasst_context, oasst_answers_best, oasst_answers_worst = read_oasst_lang_alignment("data/oasst-fi/oasst1-fi-valid-filter.jsonl")
-                questions = questions + oasst_questions
-                context = context + oasst_context
-                answers_best = answers_best + oasst_answers_best
-                answers_worst = answers_worst + oasst_answers_worst
-            else:
-                if "lang" == "both":
-                    languages = ["fi", "en"]
-                else:
-                    languages = [lang]
-                for la in languages:
-                    oasst_questions, oasst_context, oasst_answers_best, oasst_answers_worst = read_oasst("data/oasst-fi/oasst1-fi-valid-filter.jsonl",
-                                                                                                     lang=la,
-                                                                                                     max_examples=max_examples)
-                    questions = questions + oasst_questions
-                    context = context + oasst_context
-                    answers_best = answers_best + oasst_answers_best
-                    answers_worst = answers_worst + oasst_answers_worst
-        if "ultrafeedback" in data:
-            ultra_questions, ultra_context, ultra_answers_best, ultra_answers_worst = read_ultrafeedback("data/UltraFeedback/ultrafeedback-valid.jsonl",
-                                                                                                         max_examples=max_examples)
-            questions = questions + ultra_questions
-            context = context + ultra_context
-            answers_best = answers_best + ultra_answers_best
-            answers_worst = answers_worst + ultra_answers_worst
-        if "dolly" in data:
-            dolly_questions, dolly_context, dolly_answers_best, dolly_answers_worst = read_dolly_lang_alignment("data/dolly-fi/dolly-fi-valid.jsonl",
-                                                                                                                max_examples=max_examples)
-            questions = questions + dolly_questions
-            context = context + dolly_context
-            answers_best = answers_best + dolly_answers_best
-            answers_worst = answers_worst + dolly_answers_worst
-        if "hh" in data:
-            parent_path = "/scratch/project_462000319/finetuning_data/hh_rlhf"
-            if "helpful" in data:
-                hh_questions, hh_context, hh_answers_best, hh_answers_worst = read_hh(os.path.join(parent_path, "helpful-base-test.jsonl"),
-                                                                                  max_examples=max_examples)
-                questions = questions + hh_questions
-                context = context + hh_context
-                answers_best = answers_best + hh_answers_best
-                answers_worst = answers_worst + hh_answers_worst
-            if "harmless" in data:
-                hh_questions, hh_context, hh_answers_best, hh_answers_worst = read_hh(os.path.join(parent_path, "harmless-base-test.jsonl"),
-                                                                                  max_examples=max_examples)
-                questions = questions + hh_questions
-                context = context + hh_context
-                answers_best = answers_best + hh_answers_best
-                answers_worst = answers_worst + hh_answers_worst
-            else:
-                hh_questions, hh_context, hh_answers_best, hh_answers_worst = read_hh(os.path.join(parent_path, "hh_rlhf-valid.jsonl"),
-                                                                                      max_examples=max_examples)
-                questions = questions + hh_questions
-                context = context + hh_context
-                answers_best = answers_best + hh_answers_best
-                answers_worst = answers_worst + hh_answers_worst
-    elif "eval" in split:
+pair_columns = ['prompt', 'context', 'accepted_response', 'rejected_response']
+
+hh_path = "/scratch/project_462000319/finetuning_data/hh_rlhf"
+
+dpo_files = {
+    "train": {
+        "oasst": "data/oasst-fi/oasst1-fi-train-filter.jsonl",
+        "ultrafeedback": "data/UltraFeedback/ultrafeedback-train.jsonl",
+        "dolly": "data/dolly-fi/dolly-fi-train.jsonl",
+        "hh_helpful": os.path.join(hh_path, "helpful-base-train.jsonl"),
+        "hh_harmless": os.path.join(hh_path, "harmless-base-train.jsonl"),
+        "hh": os.path.join(hh_path, "hh_rlhf-train.jsonl"),
+    },
+    "valid": {
+        "oasst": "data/oasst-fi/oasst1-fi-valid-filter.jsonl",
+        "ultrafeedback": "data/UltraFeedback/ultrafeedback-valid.jsonl",
+        "dolly": "data/dolly-fi/dolly-fi-valid.jsonl",
+        "hh_helpful": os.path.join(hh_path, "helpful-base-test.jsonl"),
+        "hh_harmless": os.path.join(hh_path, "harmless-base-test.jsonl"),
+        "hh": os.path.join(hh_path, "hh_rlhf-valid.jsonl"),
+    },
+    "eval": {
+        "oasst": "data/oasst-fi/oasst1-fi-eval-filter.jsonl",
+        "ultrafeedback": "data/UltraFeedback/ultrafeedback-eval.jsonl",
+        "dolly": "data/dolly-fi/dolly-fi-eval.jsonl",
+        "hh_helpful": os.path.join(hh_path, "helpful-base-test.jsonl"),
+        "hh_harmless": os.path.join(hh_path, "harmless-base-test.jsonl"),
+        "hh": os.path.join(hh_path, "hh_rlhf-test.jsonl"),
+    },
+}
+
+
+def read_pairs(tables, backend, reader, table_reader, path, **kwargs):
+    # one table per source keeps the sources in order whichever backend reads them, returns the
+    # pairs read so far
+    if backend == "arrow" and table_reader is not None:
+        tables.append(table_reader(path, **kwargs))
+    else:
+        if backend == "arrow":
+            warning(f"{reader.__name__} has no Arrow table reader, reading {path} through Python lists")
+        tables.append(pa.table(dict(zip(pair_columns, reader(path, **kwargs))), schema=string_schema(pair_columns)))
+    return sum(table.num_rows for table in tables)
+
+
+def read_data_dpo(data="oasst", split="train", lang="fi", shuffle_data=True, max_examples=10000, backend="python",
+                  shuffle_mode="flatten"):
+    # with backend == "arrow" the sources with a table reader (ultrafeedback, dolly, hh) skip the
+    # Python lists, oasst is read from its conversation tree either way
+    tables = []
+    split_name = next((name for name in ("train", "valid", "eval") if name in split), None)
+    if split_name is not None:
+        files = dpo_files[split_name]
+        # sizes are reported for the training data
+        report = print if split_name == "train" else (lambda *args: None)
         if "oasst" in data:
             if "lang" in data:
-                oasst_questions, oasst_context, oasst_answers_best, oasst_answers_worst = read_oasst_lang_alignment("data/oasst-fi/oasst1-fi-eval-filter.jsonl")
-                questions = questions + oasst_questions
-                context = context + oasst_context
-                answers_best = answers_best + oasst_answers_best
-                answers_worst = answers_worst + oasst_answers_worst
+                size = read_pairs(tables, backend, read_oasst_lang_alignment, None, files["oasst"])
+                report("Size of oasst lang alignment training data", size)
             else:
                 if "lang" == "both":
                     languages = ["fi", "en"]
                 else:
                     languages = [lang]
                 for la in languages:
-                    oasst_questions, oasst_context, oasst_answers_best, oasst_answers_worst = read_oasst("data/oasst-fi/oasst1-fi-eval-filter.jsonl",
-                                                                                                     lang=la,
-                                                                                                     max_examples=max_examples)
-                    questions = questions + oasst_questions
-                    context = context + oasst_context
-                    answers_best = answers_best + oasst_answers_best
-                    answers_worst = answers_worst + oasst_answers_worst
+                    size = read_pairs(tables, backend, read_oasst, None, files["oasst"], lang=la, max_examples=max_examples)
+                report("Size of oasst preference training data", size)
         if "ultrafeedback" in data:
-            ultra_questions, ultra_context, ultra_answers_best, ultra_answers_worst = read_ultrafeedback("data/UltraFeedback/ultrafeedback-eval.jsonl",
-                                                                                                         max_examples=max_examples)
-            questions = questions + ultra_questions
-            context = context + ultra_context
-            answers_best = answers_best + ultra_answers_best
-            answers_worst = answers_worst + ultra_answers_worst
+            size = read_pairs(tables, backend, read_ultrafeedback, ultrafeedback_table, files["ultrafeedback"],
+                              max_examples=max_examples)
+            report("Size of ultrafeedback training data", size)
         if "dolly" in data:
-            dolly_questions, dolly_context, dolly_answers_best, dolly_answers_worst = read_dolly_lang_alignment("data/dolly-fi/dolly-fi-eval.jsonl",
-                                                                                                                max_examples=max_examples)
-            questions = questions + dolly_questions
-            context = context + dolly_context
-            answers_best = answers_best + dolly_answers_best
-            answers_worst = answers_worst + dolly_answers_worst
+            size = read_pairs(tables, backend, read_dolly_lang_alignment, dolly_lang_alignment_table, files["dolly"],
+                              max_examples=max_examples)
+            report("Size of dolly training data", size)
         if "hh" in data:
-            parent_path = "/scratch/project_462000319/finetuning_data/hh_rlhf"
             if "helpful" in data:
-                hh_questions, hh_context, hh_answers_best, hh_answers_worst = read_hh(os.path.join(parent_path, "helpful-base-test.jsonl"),
-                                                                                  max_examples=max_examples)
-                questions = questions + hh_questions
-                context = context + hh_context
-                answers_best = answers_best + hh_answers_best
-                answers_worst = answers_worst + hh_answers_worst
+                size = read_pairs(tables, backend, read_hh, hh_table, files["hh_helpful"], max_examples=max_examples)
+                report("Size of hh helpful training data", size)
             if "harmless" in data:
-                hh_questions, hh_context, hh_answers_best, hh_answers_worst = read_hh(os.path.join(parent_path, "harmless-base-test.jsonl"),
-                                                                                  max_examples=max_examples)
-                questions = questions + hh_questions
-                context = context + hh_context
-                answers_best = answers_best + hh_answers_best
-                answers_worst = answers_worst + hh_answers_worst
+                size = read_pairs(tables, backend, read_hh, hh_table, files["hh_harmless"], max_examples=max_examples)
+                report("Size of hh harmless training data", size)
             else:
-                hh_questions, hh_context, hh_answers_best, hh_answers_worst = read_hh(os.path.join(parent_path, "hh_rlhf-test.jsonl"),
-                                                                                      max_examples=max_examples)
-                questions = questions + hh_questions
-                context = context + hh_context
-                answers_best = answers_best + hh_answers_best
-                answers_worst = answers_worst + hh_answers_worst
+                size = read_pairs(tables, backend, read_hh, hh_table, files["hh"], max_examples=max_examples)
+                report("Size of hh training data", size)
 
-    data = {
-        'prompt': questions,
-        'context': context,
-        'accepted_response': answers_best,
-        'rejected_response': answers_worst
-    }
-    data = Dataset.from_dict(data)
+    if tables:
+        data = Dataset(InMemoryTable(pa.concat_tables(tables)))
+    else:
+        data = Dataset.from_dict({col: [] for col in pair_columns})
     if shuffle_data:
-        data = data.shuffle(seed=42)
-    return data
\ No newline at end of file
+        data = shuffle_dataset(data, shuffle_mode)
+    return data
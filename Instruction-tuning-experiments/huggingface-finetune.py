@@ -2,29 +2,48 @@ import sys
 import os
 import torch
 import numpy as np
-from logging import warning
-from datasets import DatasetDict, interleave_datasets
+import pyarrow as pa
+from datasets import DatasetDict, Sequence, Value, interleave_datasets
 from argparse import ArgumentParser
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     TrainingArguments,
-    Trainer,
-    DataCollatorForLanguageModeling
 )
 
 
 # custom classes
-from instruction_finetuning_datasets import read_data_sft
-from utils import load_model
+from instruction_finetuning_datasets import read_data_sft, parse_data_weights, shuffle_modes, sft_source_paths
+from utils import load_model, preprocess_on_main_process, is_preprocessing_process, filter_by_length, stratified_subsample, add_source_ids
+from tokenized_cache import load_or_build
+from indexed_dataset import (
+    IndexedDataset,
+    export_indexed_dataset,
+    is_index_current,
+    prompt_loss_mask,
+    eval_task_loss_mask,
+    conversation_loss_mask,
+    supervised_token_counts,
+    list_column
+)
+from arrow_readers import sft_text
+from chat_template import TemplateEncoder, turn_marker_ids, assistant_token, chatml_start_token
+from streaming import (
+    StreamingDataset,
+    StreamPositionCallback,
+    prepare_streaming_args,
+    resolve_checkpoint,
+    load_stream_position
+)
+from packing import PackedDataset, PackedDataCollator, enable_packed_attention, takes_position_ids, example_lengths
+from callbacks import ThroughputCallback
+from trainers import BucketedTrainer
+from collators import LabelPaddingCollator
+from context_budget import ContextBudget
 
 import logging
 torch.cuda.empty_cache()
 model_max_length = 2048
-user_token = "<|user|>"
-assistant_token = "<|assistant|>"
-chatml_start_token = "<|im_start|>"
-chatml_end_token = "<|im_end|>"
 
 def argparser():
     ap = ArgumentParser()
@@ -44,100 +63,133 @@ def argparser():
     ap.add_argument('--use_lora', default=True, type=lambda x: (str(x).lower() == 'true'))
     ap.add_argument('--lora_r', type=int, default=16)
     ap.add_argument('--chatml_format', default=False, type=lambda x: (str(x).lower() == 'true'))
+    ap.add_argument('--conversations', default=False, type=lambda x: (str(x).lower() == 'true'))
     ap.add_argument('--transformers_cache',type=str, default="/scratch/project_462000319/transformers_cache")
     ap.add_argument('--dropout',type=float, default=0.1)
+    ap.add_argument('--data_weights', type=str, default=None)
+    ap.add_argument('--data_backend', type=str, default="python", choices=["python", "arrow"])
+    ap.add_argument('--shuffle_mode', type=str, default="sampler", choices=shuffle_modes)
+    ap.add_argument('--preprocessed_dir', type=str, default=None)
+    ap.add_argument('--preprocessing_num_workers', type=int, default=None)
+    ap.add_argument('--tokenized_cache_dir', type=str, default=None)
+    ap.add_argument('--tokenized_cache_max_gb', type=float, default=200)
+    ap.add_argument('--indexed_data', type=str, default=None, help="path prefix of the binary token/loss mask export")
+    ap.add_argument('--streaming', default=False, type=lambda x: (str(x).lower() == 'true'))
+    ap.add_argument('--shuffle_buffer_size', type=int, default=10000)
+    ap.add_argument('--resume_from_checkpoint', type=str, default=None, help="checkpoint path, or true for the latest one")
+    ap.add_argument('--preprocess_per_node', default=False, type=lambda x: (str(x).lower() == 'true'))
+    ap.add_argument('--packing', default=False, type=lambda x: (str(x).lower() == 'true'))
+    ap.add_argument('--length_bucketing', default=False, type=lambda x: (str(x).lower() == 'true'), help="micro-batches of examples of similar length, changes the order of the training data")
+    ap.add_argument('--bucket_batches', type=int, default=64, help="micro-batches per length bucket")
+    ap.add_argument('--max_tokens_per_batch', type=int, default=None, help="token budget per micro-batch instead of per_device_batch_size rows")
     ap.add_argument('--prompt_structure', default=False, type=lambda x: (str(x).lower() == 'true'))
+    ap.add_argument('--context_budget', default=False, type=lambda x: (str(x).lower() == 'true'), help="keep OASST examples longer than model_max_length with their oldest turns dropped, changes the training data (see context_budget.py)")
+    ap.add_argument('--per_device_eval_batch_size', type=int, default=4)
+    ap.add_argument('--eval_examples', type=int, default=None, help="evaluate on a fixed subsample of the validation split, stratified by source")
+    ap.add_argument('--eval_time_budget', type=float, default=None, help="seconds per evaluation during training")
+    ap.add_argument('--throughput_log', default=False, type=lambda x: (str(x).lower() == 'true'), help="tokens/sec, padding and step time breakdown in TensorBoard")
+    ap.add_argument('--async_checkpointing', default=False, type=lambda x: (str(x).lower() == 'true'), help="write checkpoints in the background while training goes on (transformers 4.36, not with DeepSpeed ZeRO-3)")
+    ap.add_argument('--dataloader_num_workers', type=int, default=0, help="worker processes that collate the batches, 0 collates in the training process")
+    ap.add_argument('--dataloader_prefetch_factor', type=int, default=2, help="batches every worker keeps ready")
+    ap.add_argument('--dataloader_pin_memory', default=True, type=lambda x: (str(x).lower() == 'true'), help="batches in pinned memory for faster copies to the GPU")
     return ap
 
 
-def logits_argmax(logits):
-    # https://github.com/huggingface/transformers/issues/15466
-    return logits.argmax(axis=-1)
+def get_assistant_id(tokenizer):
+    # if tokenizer has assistant_token, use it to signal prompt boundary, else use <|endofprompt|>
+    if assistant_token in tokenizer.additional_special_tokens:
+        return tokenizer(assistant_token)['input_ids'][0]
+    elif chatml_start_token in tokenizer.additional_special_tokens:
+        return tokenizer(chatml_start_token)['input_ids'][0]
+    return -100
 
-class PromptMaskingDataCollator(DataCollatorForLanguageModeling):    # Sampo's script
-    def __call__(self, features, return_tensors=None):
-        data = super().__call__(features, return_tensors)
-        # if tokenizer has assistant_token, use it to signal prompt boundary, else use <|endofprompt|>
-        if assistant_token in self.tokenizer.additional_special_tokens:
-            assistant_id = self.tokenizer(assistant_token)['input_ids'][0]
-        elif chatml_start_token in self.tokenizer.additional_special_tokens:
-            assistant_id = self.tokenizer(chatml_start_token)['input_ids'][0]
-        else:
-            assistant_id = -100
-        # print("assistant_id:", assistant_id)
-        for i in range(len(data['labels'])):
-            assistant_indices = np.where(data['labels'][i] == assistant_id)[0]
-            # print("original labels:", data['labels'][i])
-            # print("decoded:", self.tokenizer.decode(data['input_ids'][i]))
-            # print("assistant_indices:", assistant_indices)
-            # print("last assistant index:", assistant_indices[-1])
-            if len(assistant_indices) > 0:
-                data['labels'][i, :assistant_indices[-1]] = -100
-            else:
-                warning('missing assistant_token in labels')
-            # print("masked labels:", data['labels'][i])
-            # print("decoded labels:", self.tokenizer.decode(data['labels'][i][assistant_indices[-1]:]))
-            # print("-"*100)
-        return data
-
-class EvalTasksDataCollator(DataCollatorForLanguageModeling):    
-    def __call__(self, features, return_tensors=None):
-        data = super().__call__(features, return_tensors)
-        # for finetuning on eval tasks, use pad_token to signal boundary between question and answer 
-        # print("assistant_id:", assistant_id)
-        mask_token_id = -100 #self.tokenizer.pad_token_id
-        for i in range(len(data['labels'])):
-            pad_indices = np.where(data['labels'][i] == mask_token_id)[0]
-            # print("labels:", data['labels'][i])
-            # print("decoded:", self.tokenizer.decode(data['input_ids'][i]))
-            # print("pad_indices:", pad_indices)
-            if len(pad_indices) > 0:
-                data['labels'][i, :pad_indices[0]] = -100
-            else:
-                warning('missing pad_token in labels')
-            # print("labels:", data['labels'][i])
-            # print("decoded labels:", self.tokenizer.decode(data['labels'][i][(pad_indices[0]+1):]))
-            # print("-"*100)
-        return data
-
-def filter_by_length(datasetdict, max_length):
-    for k in datasetdict:
-        dataset = datasetdict[k]
-        filtered = dataset.filter(lambda e: len(e['input_ids']) <= max_length)
-        orig_length = len(dataset['input_ids'])
-        filt_length = len(filtered['input_ids'])
-        if filt_length < orig_length:
-            warning(
-                f'filtered {k} from {orig_length} to {filt_length} '
-                f'({filt_length/orig_length:.1%}) by max_length {max_length}'
-            )
-            datasetdict[k] = filtered
-    return datasetdict
-
-def preprocess_sft(data, tokenizer, model_args): 
-    prompts = data['prompt']
-    contexts = data['context']
-    responses = data['response']
-    end_of_prompt = tokenizer.pad_token 
-    end_of_text = tokenizer.eos_token
-    combined = []
-    for prompt, context, response in zip(prompts, contexts, responses):
-        if not context or context.isspace():
-            input_i = prompt
-        else:
-            input_i = context + '\n' + prompt
-        # FinGPT needs end_of_prompt to signal prompt boundary, Poro uses assistant_token or chatml_start_token
-        if "eval_tasks" in model_args.training_data:
-            combined_line = input_i + tokenizer.pad_token + response + end_of_text
-        elif (assistant_token in tokenizer.additional_special_tokens) or (chatml_start_token in tokenizer.additional_special_tokens):
-            combined_line = input_i + '\n' + response + end_of_text
-        else:
-            combined_line = input_i + end_of_prompt + '\n' + response + end_of_text
-        # print("combined_line:", combined_line)
-        combined.append(combined_line)
+def sft_loss_mask(tokenizer, model_args):
+    # loss mask over a flat token stream (see indexed_dataset), the marker ids are looked up once
+    pad_id = tokenizer.pad_token_id
+    if "eval_tasks" in model_args.training_data:
+        # for finetuning on eval tasks, pad_token signals the boundary between question and answer
+        mask = lambda tokens, offsets: eval_task_loss_mask(tokens, offsets, pad_id)
+    elif model_args.conversations and turn_marker_ids(tokenizer) is not None:
+        # supervise every assistant turn of a multi-turn conversation
+        marker_ids = turn_marker_ids(tokenizer)
+        mask = lambda tokens, offsets: conversation_loss_mask(tokens, offsets, marker_ids)
+    else:
+        assistant_id = get_assistant_id(tokenizer)
+        mask = lambda tokens, offsets: prompt_loss_mask(tokens, offsets, assistant_id)
+    # pad tokens are never supervised
+    return lambda tokens, offsets: mask(tokens, offsets) & (tokens != pad_id)
+
+def sft_separator(tokenizer, model_args):
+    # FinGPT needs end_of_prompt to signal prompt boundary, Poro uses assistant_token or chatml_start_token
+    if "eval_tasks" in model_args.training_data:
+        return tokenizer.pad_token
+    elif (assistant_token in tokenizer.additional_special_tokens) or (chatml_start_token in tokenizer.additional_special_tokens):
+        return '\n'
+    else:
+        return tokenizer.pad_token + '\n'
+
+def preprocess_sft(data, encoder, model_args, loss_mask):
+    # data is a pyarrow Table batch (dataset.with_format("arrow"))
+    tokenizer = encoder.tokenizer
+    combined = sft_text(data, sft_separator(tokenizer, model_args), tokenizer.eos_token)
     # Truncation would be problematic for this task
-    tokenized = tokenizer(combined, truncation=True)
-    return tokenized
+    tokens, offsets, _ = encoder.encode(combined.to_pylist())
+    table = data.append_column('input_ids', list_column(tokens, offsets))
+    table = table.append_column('attention_mask', list_column(np.ones(len(tokens)), offsets, pa.int8()))
+    table = table.append_column('labels', list_column(np.where(loss_mask(tokens, offsets), tokens, -100), offsets))
+    return table.append_column('length', pa.array(np.diff(offsets), pa.int32()))
+
+def tokenize_sft(dataset, tokenizer, model_args, loss_mask):
+    # the prompt is masked once here, the collator only pads. The length column is for filtering,
+    # bucketing and packing without reading the tokens.
+    features = dataset.features.copy()
+    features['input_ids'] = Sequence(Value('int32'))
+    features['attention_mask'] = Sequence(Value('int8'))
+    features['labels'] = Sequence(Value('int32'))
+    features['length'] = Value('int32')
+    encoder = TemplateEncoder(tokenizer)
+    return dataset.with_format("arrow").map(
+        lambda d: preprocess_sft(d, encoder, model_args, loss_mask),
+        batched=True,
+        features=features,
+        num_proc=model_args.preprocessing_num_workers,
+    ).with_format(None)
+
+class StreamingSFTCollator:
+    # in streaming mode train rows arrive untokenized and are tokenized here a batch at a time,
+    # eval rows are tokenized already. The stream is not filtered by length (filter_by_length), so
+    # rows longer than max_length are dropped from their micro-batch here and counted.
+    def __init__(self, collator, tokenizer, model_args, loss_mask, max_length=model_max_length):
+        self.collator = collator
+        self.encoder = TemplateEncoder(tokenizer)
+        self.model_args = model_args
+        self.loss_mask = loss_mask
+        self.max_length = max_length
+        # rows tokenized and dropped by this process (each dataloader worker counts its own)
+        self.rows = 0
+        self.dropped = 0
+
+    def __call__(self, features, return_tensors=None):
+        if 'input_ids' not in features[0]:
+            batch = pa.Table.from_pylist(features)
+            features = self.drop_long(preprocess_sft(batch, self.encoder, self.model_args, self.loss_mask))
+        return self.collator([{'input_ids': f['input_ids'], 'labels': f['labels']} for f in features], return_tensors)
+
+    def drop_long(self, table):
+        lengths = table['length'].to_numpy()
+        keep = lengths <= self.max_length
+        if not keep.any():
+            # a micro-batch can't be empty, its shortest example is kept and truncated
+            keep[np.argmin(lengths)] = True
+            logging.warning(f'all examples of a streamed micro-batch are longer than max_length {self.max_length}, '
+                            f'truncated the shortest one')
+        self.rows += len(keep)
+        if not keep.all():
+            self.dropped += int((~keep).sum())
+            logging.warning(f'dropped {(~keep).sum()} streamed examples longer than max_length {self.max_length}, '
+                            f'{self.dropped} of {self.rows} so far')
+        features = table.filter(pa.array(keep)).select(['input_ids', 'labels']).to_pylist()
+        return [{k: v[:self.max_length] for k, v in f.items()} for f in features]
 
 
 def train_sft(args):
@@ -175,9 +227,15 @@ def train_sft(args):
         # eval_steps=100,
         #lr_scheduler_type="cosine",
         learning_rate=args.learning_rate,
-        per_device_train_batch_size=1,
-        gradient_accumulation_steps=4,
-        per_device_eval_batch_size=1,
+        per_device_train_batch_size=args.per_device_batch_size,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        per_device_eval_batch_size=args.per_device_eval_batch_size,
+        dataloader_num_workers=args.dataloader_num_workers,
+        # the workers stay up between the evaluations
+        dataloader_persistent_workers=args.dataloader_num_workers > 0,
+        dataloader_pin_memory=args.dataloader_pin_memory,
+        # loss, token accuracy and loss per source are summed in the eval loop (EvalMetricsMixin), no logits are gathered
+        prediction_loss_only=True,
         log_on_each_node=False,
         logging_strategy="steps",
         logging_steps=10,
@@ -231,53 +289,137 @@ def train_sft(args):
     #     train_gsm8k = read_data_sft(args.training_data, split="train", eval_task="gsm8k")
     #     train_data = interleave_datasets([train_arc, train_gsm8k], probabilities=[0.75, 0.25], stopping_strategy="all_exhausted")
     # else:
-    train_data = read_data_sft(args.training_data, split="train", lang=args.lang, chatml_format=args.chatml_format)
-    val_data = read_data_sft(args.training_data, split="valid", lang=args.lang, chatml_format=args.chatml_format)
-    eval_data = read_data_sft(args.training_data, split="eval", lang=args.lang, chatml_format=args.chatml_format)
-
-    print("Size of training data", len(train_data))
-    print("Size of validation data", len(val_data))
-    print("Size of evaluation data", len(eval_data))
-
-    dataset = DatasetDict({
-        'train': train_data,
-        'validation': val_data,
-        'evaluation': eval_data,
-    })
-
-    dataset = dataset.map(
-        lambda d: preprocess_sft(d, tokenizer, args),
-        batched=True
-    )
+    label_mask = sft_loss_mask(tokenizer, args)
+    context_budget = ContextBudget(tokenizer, model_max_length, sft_separator(tokenizer, args),
+                                   tokenizer.eos_token) if args.context_budget else None
 
-    print("Filtering by length")
-    dataset = filter_by_length(dataset, model_max_length)
+    def build_dataset():
+        data_weights = parse_data_weights(args.data_weights)
+        train_data = read_data_sft(args.training_data, split="train", lang=args.lang, chatml_format=args.chatml_format,
+                                   conversations=args.conversations, backend=args.data_backend,
+                                   weights=data_weights, shuffle_mode=args.shuffle_mode, context_budget=context_budget)
+        val_data = read_data_sft(args.training_data, split="valid", lang=args.lang, chatml_format=args.chatml_format,
+                                   conversations=args.conversations, backend=args.data_backend,
+                                   weights=data_weights, shuffle_mode=args.shuffle_mode, context_budget=context_budget)
+        eval_data = read_data_sft(args.training_data, split="eval", lang=args.lang, chatml_format=args.chatml_format,
+                                   conversations=args.conversations, backend=args.data_backend,
+                                   weights=data_weights, shuffle_mode=args.shuffle_mode, context_budget=context_budget)
 
-    print("Get data collator")
-    if "eval_tasks" in args.training_data:
-        data_collator = EvalTasksDataCollator(
-            tokenizer=tokenizer,
-            mlm=False
-        )
+        print("Size of training data", len(train_data))
+        print("Size of validation data", len(val_data))
+        print("Size of evaluation data", len(eval_data))
+
+        dataset = DatasetDict({
+            'train': train_data,
+            'validation': val_data,
+            'evaluation': eval_data,
+        })
+
+        if args.streaming:
+            # the train split stays untokenized, StreamingSFTCollator tokenizes it on the fly
+            train_data = dataset.pop('train')
+
+        dataset = DatasetDict({split: tokenize_sft(data, tokenizer, args, label_mask) for split, data in dataset.items()})
+
+        print("Filtering by length")
+        dataset = filter_by_length(dataset, model_max_length)
+        if args.streaming:
+            dataset['train'] = train_data
+        return dataset
+
+    # read, tokenize and filter once, the other ranks memory-map the result
+    if args.tokenized_cache_dir:
+        settings = {
+            "script": "huggingface-finetune",
+            "training_data": args.training_data,
+            "lang": args.lang,
+            "chatml_format": args.chatml_format,
+            "conversations": args.conversations,
+            "data_weights": args.data_weights,
+            "data_backend": args.data_backend,
+            "shuffle_mode": args.shuffle_mode,
+            "streaming": args.streaming,
+            "model_max_length": model_max_length,
+            "context_budget": args.context_budget,
+        }
+        source_paths = sft_source_paths(args.training_data, lang=args.lang, conversations=args.conversations)
+        dataset = load_or_build(training_args, build_dataset, args.tokenized_cache_dir, source_paths, tokenizer,
+                                settings, max_gb=args.tokenized_cache_max_gb, per_node=args.preprocess_per_node)
     else:
-        data_collator = PromptMaskingDataCollator(
-            tokenizer=tokenizer,
-            mlm=False
-        )
+        dataset = preprocess_on_main_process(training_args, build_dataset,
+                                             preprocessed_dir=args.preprocessed_dir,
+                                             per_node=args.preprocess_per_node)
+
+    # the same validation examples in every evaluation, the cached dataset keeps all of them
+    dataset['validation'] = stratified_subsample(dataset['validation'], args.eval_examples, seed=training_args.seed)
+    eval_sources = []
+    if not (args.indexed_data or args.packing):
+        # the loss per source needs the source of every eval row, the flat and packed rows have none
+        dataset['validation'], eval_sources = add_source_ids(dataset['validation'])
+
+    # the labels are part of the data (tokenize_sft, the indexed export), the collator only pads
+    data_collator = LabelPaddingCollator(tokenizer)
+
+    if args.indexed_data:
+        # training reads flat memory-mapped token and mask files
+        with training_args.main_process_first(local=args.preprocess_per_node, desc="indexed data export"):
+            if is_preprocessing_process(training_args, args.preprocess_per_node):
+                for split in dataset:
+                    prefix = f"{args.indexed_data}-{split}"
+                    if not is_index_current(prefix, dataset[split]._fingerprint):
+                        export_indexed_dataset(dataset[split], prefix)
+        dataset = {split: IndexedDataset(f"{args.indexed_data}-{split}") for split in dataset}
+    else:
+        # rows come as numpy arrays, faster to read and to pad than python lists
+        for split in dataset:
+            if not (args.streaming and split == 'train'):
+                dataset[split] = dataset[split].with_format("numpy")
+
+    if args.packing:
+        # several examples per model_max_length row
+        dataset = {split: PackedDataset(dataset[split], model_max_length) for split in dataset}
+        enable_packed_attention(model)
+        data_collator = PackedDataCollator(tokenizer, position_ids=takes_position_ids(model))
 
     print("Size of training data", len(dataset['train']))
 
-    trainer = Trainer(
+    resume_from_checkpoint = resolve_checkpoint(args.resume_from_checkpoint, output_dir)
+    if args.dataloader_num_workers > 0:
+        # the tokenizer has run its threads in this process, the forked workers get none instead of a warning each
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    callbacks = [ThroughputCallback()] if args.throughput_log else []
+    if args.streaming:
+        dataset['train'] = StreamingDataset(dataset['train'],
+                                            buffer_size=args.shuffle_buffer_size,
+                                            seed=training_args.seed,
+                                            start_position=load_stream_position(resume_from_checkpoint),
+                                            batch_size=training_args.per_device_train_batch_size * training_args.world_size)
+        prepare_streaming_args(training_args, dataset['train'].num_examples, args.num_train_epochs)
+        callbacks.append(StreamPositionCallback(dataset['train']))
+        data_collator = StreamingSFTCollator(data_collator, tokenizer, args, label_mask)
+
+    trainer = BucketedTrainer(
         model=model,
         args=training_args,
         train_dataset=dataset['train'],
         eval_dataset=dataset['validation'],
         data_collator=data_collator,
         tokenizer=tokenizer,
-        preprocess_logits_for_metrics=logits_argmax,
+        callbacks=callbacks,
+        # micro-batches of similar lengths, the streamed train set has no sampler
+        length_fn=example_lengths if (args.length_bucketing or args.max_tokens_per_batch) and not args.streaming else None,
+        bucket_batches=args.bucket_batches,
+        max_tokens=args.max_tokens_per_batch,
+        supervised_fn=supervised_token_counts,
+        # eval batches sorted by length, packed rows when packing
+        eval_length_fn=example_lengths,
+        eval_time_budget=args.eval_time_budget,
+        async_checkpointing=args.async_checkpointing,
+        dataloader_prefetch_factor=args.dataloader_prefetch_factor,
+        eval_sources=eval_sources,
     )
 
-    trainer.train()
+    trainer.train(resume_from_checkpoint=resume_from_checkpoint)
     base_model_name = os.path.basename(args.model)
     if "eval_tasks" in args.training_data:
             save_directory = os.path.join("../../models/sft_finetuned/", base_model_name + 
@@ -301,7 +443,14 @@ def train_sft(args):
 
 
 def main(argv):
-    args = argparser().parse_args(argv[1:])
+    ap = argparser()
+    args = ap.parse_args(argv[1:])
+    if args.streaming and args.indexed_data:
+        ap.error("--streaming reads the Arrow dataset, it can't be combined with --indexed_data")
+    if args.streaming and args.max_tokens_per_batch:
+        ap.error("--max_tokens_per_batch batches by length, it can't be combined with --streaming")
+    if args.streaming and args.packing:
+        ap.error("--packing needs the lengths of all examples up front, it can't be combined with --streaming")
     if args.task == "sft":
         train_sft(args)
     else:
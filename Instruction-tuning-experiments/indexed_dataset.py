@@ -0,0 +1,194 @@
+import os
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import torch
+
+# Flat binary layout for tokenized SFT data, in the spirit of Megatron's indexed datasets:
+#   <prefix>.bin   uint32 token ids of all examples back to back
+#   <prefix>.idx   int64 offsets, example i is tokens[offsets[i]:offsets[i + 1]]
+#   <prefix>.mask  loss mask over the same token stream, one bit per token (np.packbits, little bit order)
+#   <prefix>.json  counts and the fingerprint of the dataset it was exported from
+# Everything is memory-mapped, an example is two slices.
+# The loss masks below work on the same flat token stream, a batch of examples at a time. They
+# make the labels column of the tokenized SFT data (masked_labels).
+
+index_version = 1
+
+
+def token_rows(offsets):
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def row_starts(offsets):
+    return np.repeat(offsets[:-1], np.diff(offsets))
+
+
+def flat_tokens(input_ids):
+    # token stream and example offsets of an arrow list column
+    if hasattr(input_ids, "combine_chunks"):
+        input_ids = input_ids.combine_chunks()
+    tokens = pc.list_flatten(input_ids).to_numpy().astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(pc.list_value_length(input_ids).to_numpy())]).astype(np.int64)
+    return tokens, offsets
+
+
+def token_lengths(dataset):
+    # tokens per example, from the length column of the tokenized data (tokenize_sft) if it has one
+    table = dataset.with_format("arrow")
+    if "length" in dataset.column_names:
+        return table["length"].to_numpy().astype(np.int64)
+    return pc.list_value_length(table["input_ids"]).to_numpy().astype(np.int64)
+
+
+def prompt_loss_mask(tokens, offsets, assistant_id):
+    # everything from the last assistant marker of each example on, all of it without a marker
+    positions = np.arange(len(tokens))
+    rows = token_rows(offsets)
+    last_marker = np.full(len(offsets) - 1, -1)
+    np.maximum.at(last_marker, rows, np.where(tokens == assistant_id, positions, -1))
+    return positions >= last_marker[rows]
+
+
+def eval_task_loss_mask(tokens, offsets, pad_id):
+    # everything after the first pad token (question/answer boundary)
+    positions = np.arange(len(tokens))
+    rows = token_rows(offsets)
+    first_pad = np.full(len(offsets) - 1, len(tokens))
+    np.minimum.at(first_pad, rows, np.where(tokens == pad_id, positions, len(tokens)))
+    # no pad token: nothing is masked
+    first_pad[first_pad == len(tokens)] = -1
+    return positions > first_pad[rows]
+
+
+def conversation_loss_mask(tokens, offsets, turn_marker_ids):
+    # tokens whose closest preceding role marker opens an assistant turn
+    if turn_marker_ids[0] == 'chatml':
+        _, start_id, assistant_role_id = turn_marker_ids
+        next_ids = np.roll(tokens, -1)
+        # the last token of an example has no next token
+        next_ids[offsets[1:][np.diff(offsets) > 0] - 1] = -1
+        assistant_start = (tokens == start_id) & (next_ids == assistant_role_id)
+        user_start = (tokens == start_id) & (next_ids != assistant_role_id)
+    else:
+        _, user_id, assistant_id = turn_marker_ids
+        assistant_start = tokens == assistant_id
+        user_start = tokens == user_id
+    positions = np.arange(len(tokens))
+    last_marker = np.maximum.accumulate(np.where(assistant_start | user_start, positions, row_starts(offsets)))
+    return assistant_start[last_marker]
+
+
+def list_column(values, offsets, type=pa.int32()):
+    # arrow list column of a flat array and its example offsets
+    return pa.ListArray.from_arrays(pa.array(offsets.astype(np.int32)), pa.array(values, type))
+
+
+def masked_labels(input_ids, loss_mask):
+    # list<int32> labels column, -100 where loss_mask(tokens, offsets) is off
+    tokens, offsets = flat_tokens(input_ids)
+    return list_column(np.where(loss_mask(tokens, offsets), tokens, -100), offsets)
+
+
+def batch_loss_mask(batch, loss_mask=None):
+    # tokens, offsets and the loss mask of an arrow batch, from its labels column without loss_mask
+    tokens, offsets = flat_tokens(batch["input_ids"])
+    if loss_mask is not None:
+        return tokens, offsets, loss_mask(tokens, offsets)
+    labels, _ = flat_tokens(batch["labels"])
+    return tokens, offsets, labels != -100
+
+
+def supervised_token_counts(dataset, loss_mask=None, batch_size=10000):
+    # label tokens per example, without the first one which nothing predicts
+    if hasattr(dataset, "supervised_counts"):
+        # IndexedDataset, PackedDataset
+        return dataset.supervised_counts()
+    counts = []
+    for batch in dataset.with_format("arrow").iter(batch_size=batch_size):
+        _, offsets, mask = batch_loss_mask(batch, loss_mask)
+        counts.append(mask_counts(mask, offsets))
+    return np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+
+
+def mask_counts(mask, offsets):
+    mask = mask.copy()
+    mask[offsets[:-1][np.diff(offsets) > 0]] = False
+    cumulative = np.concatenate([[0], np.cumsum(mask)])
+    return cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+
+
+def is_index_current(prefix, fingerprint):
+    if not os.path.exists(prefix + ".json"):
+        return False
+    with open(prefix + ".json") as f:
+        meta = json.load(f)
+    return meta.get("version") == index_version and meta.get("fingerprint") == fingerprint
+
+
+def export_indexed_dataset(dataset, prefix, loss_mask=None, batch_size=10000):
+    # loss_mask(tokens, offsets) -> bool array over tokens, by default the labels column
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+    tmp = f"{prefix}.tmp{os.getpid()}"
+    num_tokens = 0
+    offsets = [np.zeros(1, dtype=np.int64)]
+    # bits left over from the previous batch, packbits works on whole bytes
+    carry = np.zeros(0, dtype=bool)
+    with open(tmp + ".bin", "wb") as bin_file, open(tmp + ".mask", "wb") as mask_file:
+        for batch in dataset.with_format("arrow").iter(batch_size=batch_size):
+            tokens, batch_offsets, mask = batch_loss_mask(batch, loss_mask)
+            bin_file.write(tokens.astype(np.uint32).tobytes())
+            bits = np.concatenate([carry, mask])
+            whole = len(bits) - len(bits) % 8
+            mask_file.write(np.packbits(bits[:whole], bitorder="little").tobytes())
+            carry = bits[whole:]
+            offsets.append(batch_offsets[1:] + num_tokens)
+            num_tokens += len(tokens)
+        mask_file.write(np.packbits(carry, bitorder="little").tobytes())
+    np.concatenate(offsets).tofile(tmp + ".idx")
+    with open(tmp + ".json", "w") as f:
+        json.dump({"version": index_version,
+                   "fingerprint": dataset._fingerprint,
+                   "num_examples": len(dataset),
+                   "num_tokens": num_tokens}, f)
+    for suffix in [".bin", ".idx", ".mask", ".json"]:
+        os.replace(tmp + suffix, prefix + suffix)
+    print(f"Exported {len(dataset)} examples, {num_tokens} tokens to {prefix}")
+
+
+def memmap(path, dtype):
+    # np.memmap refuses empty files, e.g. an empty eval split
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+class IndexedDataset(torch.utils.data.Dataset):
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.tokens = memmap(prefix + ".bin", np.uint32)
+        self.offsets = memmap(prefix + ".idx", np.int64)
+        self.mask_bytes = memmap(prefix + ".mask", np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def mask(self, start, end):
+        bits = np.unpackbits(self.mask_bytes[start // 8:(end + 7) // 8], bitorder="little")
+        return bits[start % 8:start % 8 + end - start].astype(bool)
+
+    def supervised_counts(self, batch_size=10000):
+        counts = []
+        for first in range(0, len(self), batch_size):
+            offsets = np.asarray(self.offsets[first:first + batch_size + 1])
+            counts.append(mask_counts(self.mask(int(offsets[0]), int(offsets[-1])), offsets - offsets[0]))
+        return np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+
+    def __getitem__(self, i):
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        input_ids = self.tokens[start:end].astype(np.int64)
+        return {"input_ids": input_ids, "labels": np.where(self.mask(start, end), input_ids, -100)}
@@ -1,74 +1,64 @@
-from datasets import Dataset
+from datasets import Dataset, concatenate_datasets
+from datasets.table import InMemoryTable
 from pathlib import Path
 import os
 import re
 import json
+import hashlib
 import numpy as np
 
-user_token = "<|user|>"
-assistant_token = "<|assistant|>"
-chatml_start_token = "<|im_start|>"
-chatml_end_token = "<|im_end|>"
+from conversation_store import load_oasst_tree
+from oasst_tree import OasstTree
+from context_budget import TreeBudget
+from chat_template import ChatTemplate
+import arrow_readers
 
 
-def read_oasst(path, lang='fi', chatml_format=False):
-    # end_of_text = tokenizer.eos_token
+
+def iter_jsonl(path):
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def oasst_turn_formatter(tree, text_col, chatml_format=False):
+    template = ChatTemplate(chatml_format)
+    def format_turn(node):
+        return template.turn("assistant" if tree.is_assistant[node] else "user", tree.text(node, text_col))
+    return format_turn
+
+
+def iter_oasst_pairs(path, pairs, lang='fi', chatml_format=False, context_budget=None):
+    # pairs(tree) -> (prompter node, assistant node) pairs, one example each
     if lang == 'fi':
         text_col = "text"
     else:
         text_col = "orig_text"
-    path = Path(path)
-    with open(path, 'rb') as f:
-        oasst_dict = list(f)
-    questions_dict = {}
-    context_wq_dict = {}
-    context_return = []
-    answers_return = []
-    questions_return = []
-    for index, json_str in enumerate(oasst_dict):
-        # print("-"*20, "Index", index, "-"*20)
-        result = json.loads(json_str)
-        if result["role"] == "prompter":
-            if chatml_format:
-                question_combined = chatml_start_token + "user\n" + result[text_col] + chatml_end_token
-            else:
-                question_combined = user_token + result[text_col]
-            questions_dict[result["message_id"]] = question_combined
-            context_wq_dict[result["message_id"]] = " "
-            if result["parent_id"]:
-                try:
-                    context_wq_dict[result["message_id"]] = context_wq_dict[result["parent_id"]]
-                except:
-                    context_wq_dict[result["message_id"]] = " "
-        elif result["role"] == "assistant":
-            try:
-                questions_return.append(questions_dict[result["parent_id"]])
-                # print("Question:", questions_dict[result["parent_id"]])
-            except:
-                continue
-            if chatml_format:
-                answer_combined = chatml_start_token + "assistant\n" + result[text_col] + chatml_end_token
-            else:
-                answer_combined = assistant_token + result[text_col]
-            answers_return.append(answer_combined)
-            # print("Answer:", answer_combined)
-            # answers_return.append(result[text_col])
-            if context_wq_dict[result["parent_id"]]:
-                context_return.append(context_wq_dict[result["parent_id"]])
-                # print("Context:", context_wq_dict[result["parent_id"]])
-                # context_wq_dict[result["message_id"]] = context_wq_dict[result["parent_id"]] + questions_dict[result["parent_id"]] + result[text_col]
-                context_wq_dict[result["message_id"]] = context_wq_dict[result["parent_id"]] + questions_dict[
-                    result["parent_id"]] + answer_combined
-            else:
-                # context_wq_dict[result["message_id"]] = questions_dict[result["parent_id"]] + "\n" + result[text_col]
-                context_wq_dict[result["message_id"]] = questions_dict[result["parent_id"]] + "\n" + answer_combined
-            # context_wq_dict[result["message_id"]] = context_wq_dict[result["parent_id"]] + "\n\n" + questions_dict[result["parent_id"]] + "\n\n" + result[text_col]
-            context_wq_dict[result["message_id"]] = context_wq_dict[result["parent_id"]] + "\n" + questions_dict[
-                result["parent_id"]] + "\n" + answer_combined
-    return questions_return, context_return, answers_return
+    tree = load_oasst_tree(path, text_cols=[text_col])
+    format_turn = oasst_turn_formatter(tree, text_col, chatml_format=chatml_format)
+    budget = TreeBudget(context_budget, tree, format_turn) if context_budget else None
+    for question, answer in pairs(tree):
+        yield {'prompt': format_turn(question),
+               'context': tree.context(question, format_turn,
+                                       max_turns=budget.context_turns(question, answer) if budget else None),
+               'response': format_turn(answer)}
+    if budget:
+        budget.report(path)
 
 
-def read_dolly(path, lang="fi", chatml_format=False):
+def iter_oasst(path, lang='fi', chatml_format=False, context_budget=None):
+    # end_of_text = tokenizer.eos_token
+    return iter_oasst_pairs(path, OasstTree.prompt_answer_pairs, lang, chatml_format, context_budget)
+
+
+def iter_oasst_conversations(path, lang='fi', chatml_format=False, context_budget=None):
+    # one example per root-to-leaf conversation; every assistant turn in it is supervised
+    # by the multi-span label mask instead of re-emitting the thread once per answer
+    return iter_oasst_pairs(path, OasstTree.conversation_ends, lang, chatml_format, context_budget)
+
+
+def iter_dolly(path, lang="fi", chatml_format=False):
     if lang == "fi":
         instruction_col = "instruction"
         context_col = "context"
@@ -77,251 +67,323 @@ def read_dolly(path, lang="fi", chatml_format=False):
         instruction_col = "orig_instruction"
         context_col = "orig_context"
         response_col = "orig_response"
-    path = Path(path)
-    with open(path, 'rb') as f:
-        dolly_dict = list(f)
-    questions = []
-    answers = []
-    context = []
-    for json_str in dolly_dict:
-        result = json.loads(json_str)
+    template = ChatTemplate(chatml_format, sep=" ")
+    for result in iter_jsonl(Path(path)):
         # prompt = result['instruction'] + '\n\n'
-        if chatml_format:
-            prompt = chatml_start_token + "user\n" + result[instruction_col] + chatml_end_token
-        else:
-            prompt = user_token + " " + result[instruction_col]
         if result[context_col] and not result[context_col].isspace():
-            context.append(result[context_col])
+            context = result[context_col]
         else:
-            context.append(' ')
-        questions.append(prompt)
-        # answers.append(result["response"])
-        if chatml_format:
-            answer = chatml_start_token + "assistant\n" + result[response_col] + chatml_end_token
-        else:
-            answer = assistant_token + " " + result[response_col]
-        answers.append(answer)
-    return questions, context, answers
+            context = ' '
+        yield {'prompt': template.user(result[instruction_col]),
+               'context': context,
+               'response': template.assistant(result[response_col])}
 
 
-def read_eval_tasks(task="arc_challenge", split="train"):
-    parent_path = "/scratch/project_462000319/jburdge/data/eval_datasets"
-    eval_task_datasets = {
-        "arc_challenge": {
-            "train": "arc/arc_challenge-train-split.jsonl",
-            "valid": "arc/arc_challenge-valid-split.jsonl"
-            },
-        "drop": {
-            "train": "drop/drop-train-split.jsonl",
-            "valid": "drop/drop-valid-split.jsonl"
-            },
-        "gsm8k": {
-            "train": "gsm8k/gsm8k-train-split.jsonl",
-            "valid": "gsm8k/gsm8k-valid-split.jsonl"
-            },
-        "hellaswag": {
-            "train": "hellaswag/hellaswag-train-split.jsonl",
-            "valid": "hellaswag/hellaswag-valid-split.jsonl"
-            }
-    }
-    questions = []
-    answers = []
-    contexts = []
-    # tasks = ["arc_challenge", "gsm8k"]
-    data_path = Path(os.path.join(parent_path, eval_task_datasets[task][split]))
-    results = [json.loads(line) for line in open(data_path)]
-    for result in results:
+eval_tasks_parent_path = "/scratch/project_462000319/jburdge/data/eval_datasets"
+eval_task_datasets = {
+    "arc_challenge": {
+        "train": "arc/arc_challenge-train-split.jsonl",
+        "valid": "arc/arc_challenge-valid-split.jsonl"
+        },
+    "drop": {
+        "train": "drop/drop-train-split.jsonl",
+        "valid": "drop/drop-valid-split.jsonl"
+        },
+    "gsm8k": {
+        "train": "gsm8k/gsm8k-train-split.jsonl",
+        "valid": "gsm8k/gsm8k-valid-split.jsonl"
+        },
+    "hellaswag": {
+        "train": "hellaswag/hellaswag-train-split.jsonl",
+        "valid": "hellaswag/hellaswag-valid-split.jsonl"
+        }
+}
+
+
+def eval_task_path(task="arc_challenge", split="train"):
+    return os.path.join(eval_tasks_parent_path, eval_task_datasets[task][split])
+
+
+def iter_eval_tasks(task="arc_challenge", split="train"):
+    for result in iter_jsonl(Path(eval_task_path(task, split))):
         if task != "hellaswag":
             result = re.split("Question:|Answer:", result['text'])
             answer =  result[-1].strip()
             question = result[-2].strip()
             if answer and question:
-                questions.append(question)
-                answers.append(answer)
                 # dummy context, don't mind it
-                contexts.append('')
+                yield {'prompt': question, 'context': '', 'response': answer}
         else:
             result = result['text'].split(".")
             question = result[0]+"."
             answer = result[1]+"."
             if len(question) > 1 and len(answer) > 1:
-                questions.append(question)
-                answers.append(answer)
                 # dummy context, don't mind it
-                contexts.append('')
-    return questions, contexts, answers
+                yield {'prompt': question, 'context': '', 'response': answer}
 
-def read_lima(path, chatml_format=False):
+
+def iter_lima(path, chatml_format=False):
+    template = ChatTemplate(sep=" ")
+    for entry in iter_jsonl(path):
+        yield {'prompt': template.user(entry['question'].strip()), 'context': '', 'response': template.assistant(entry['answer'].strip())}
+
+
+def _as_columns(records):
     questions = []
     contexts = []
     answers = []
-    data = [json.loads(line) for line in open(path)]
-    for entry in data:
-        question = user_token + " " + entry['question'].strip()
-        answer = assistant_token + " " + entry['answer'].strip()
-        questions.append(question)
-        answers.append(answer)
-        contexts.append('')
+    for record in records:
+        questions.append(record['prompt'])
+        contexts.append(record['context'])
+        answers.append(record['response'])
     return questions, contexts, answers
 
 
-def read_data_sft(data="dolly", split="train", lang="fi", chatml_format=False, shuffle_data=True):
-    questions = []
-    context = []
-    answers = []
+def read_oasst(path, lang='fi', chatml_format=False):
+    return _as_columns(iter_oasst(path, lang=lang, chatml_format=chatml_format))
+
+
+def read_dolly(path, lang="fi", chatml_format=False):
+    return _as_columns(iter_dolly(path, lang=lang, chatml_format=chatml_format))
+
+
+def read_eval_tasks(task="arc_challenge", split="train"):
+    return _as_columns(iter_eval_tasks(task=task, split=split))
+
+
+def read_lima(path, chatml_format=False):
+    return _as_columns(iter_lima(path, chatml_format=chatml_format))
+
+
+def eval_tasks_table(task="arc_challenge", split="train"):
+    return arrow_readers.eval_task_table(eval_task_path(task, split), hellaswag=(task == "hellaswag"))
+
+
+# Arrow backend counterpart of every streaming reader
+table_readers = {
+    iter_dolly: arrow_readers.dolly_table,
+    iter_lima: arrow_readers.lima_table,
+    iter_eval_tasks: eval_tasks_table,
+    iter_oasst: lambda **kwargs: arrow_readers.records_table(iter_oasst(**kwargs)),
+    iter_oasst_conversations: lambda **kwargs: arrow_readers.records_table(iter_oasst_conversations(**kwargs)),
+}
+
+
+lima_parent_path = "/scratch/project_462000319/finetuning_data/lima"
+
+# Every SFT source: reader, reader kwargs per split and default sampling weight. `languages` is
+# "expand" for sources read once per language when lang == "both", "single" for sources that only
+# take the lang argument and None for sources without language columns. A source is selected when
+# its name (or a group containing it) occurs in --training_data.
+sft_registry = {
+    "dolly": {
+        "reader": iter_dolly,
+        "splits": {split: {"path": f"data/dolly-fi/dolly-fi-{split}.jsonl"} for split in ["train", "valid", "eval"]},
+        "languages": "expand",
+        "chatml": True,
+        "weight": 1,
+    },
+    "instruct_qa": {
+        "reader": iter_dolly,
+        "splits": {split: {"path": f"data/instruct_qa/instruct_qa_fi_{split}.jsonl"} for split in ["train", "valid", "eval"]},
+        "languages": "single",
+        "chatml": True,
+        "weight": 1,
+    },
+    "oasst": {
+        "reader": iter_oasst,
+        "conversation_reader": iter_oasst_conversations,
+        "splits": {split: {"path": f"data/oasst-fi/oasst1-fi-{split}-filter.jsonl"} for split in ["train", "valid", "eval"]},
+        "languages": "expand",
+        "chatml": True,
+        "context_budget": True,
+        "weight": 1,
+    },
+    # eval tasks only have train and valid splits, eval reuses valid
+    "arc_challenge": {
+        "reader": iter_eval_tasks,
+        "splits": {"train": {"task": "arc_challenge", "split": "train"},
+                   "valid": {"task": "arc_challenge", "split": "valid"},
+                   "eval": {"task": "arc_challenge", "split": "valid"}},
+        "languages": None,
+        "chatml": False,
+        "weight": 4,
+    },
+    "gsm8k": {
+        "reader": iter_eval_tasks,
+        "splits": {"train": {"task": "gsm8k", "split": "train"},
+                   "valid": {"task": "gsm8k", "split": "valid"},
+                   "eval": {"task": "gsm8k", "split": "valid"}},
+        "languages": None,
+        "chatml": False,
+        "weight": 1,
+    },
+    "lima": {
+        "reader": iter_lima,
+        "splits": {"train": {"path": os.path.join(lima_parent_path, "fin_lima_translated-enhanced-trimmed-train.jsonl")},
+                   "valid": {"path": os.path.join(lima_parent_path, "fin_lima_translated-enhanced-trimmed-valid.jsonl")},
+                   "eval": {"path": os.path.join(lima_parent_path, "fin_lima_translated-enhanced-trimmed-valid.jsonl")}},
+        "languages": None,
+        "chatml": True,
+        "weight": 1,
+    },
+}
+
+sft_groups = {
+    "eval_tasks": ["arc_challenge", "gsm8k"],
+}
+
+
+def parse_data_weights(weights):
+    # "arc_challenge=4,oasst=0.5" -> {"arc_challenge": 4.0, "oasst": 0.5}
+    if not weights:
+        return {}
+    parsed = {}
+    for item in weights.split(","):
+        name, weight = item.split("=")
+        parsed[name.strip()] = float(weight)
+    return parsed
+
+
+def selected_sft_sources(data):
+    names = []
+    for name in sft_registry:
+        if name in data or any(group in data and name in members for group, members in sft_groups.items()):
+            names.append(name)
+    return names
+
+
+def sft_sources(data="dolly", split="train", lang="fi", chatml_format=False, conversations=False, context_budget=None):
+    # (name, reader, reader kwargs) for every source selected by data/split
     if "train" in split:
-        if "dolly" in data:
-            if "lang" == "both":
-                languages = ["en", "fi"]
-            else:
-                languages = [lang]
-            for la in languages:
-                dolly_questions, dolly_context, dolly_answers = read_dolly("data/dolly-fi/dolly-fi-train.jsonl", 
-                                                                               lang=la,
-                                                                               chatml_format=chatml_format)
-                questions = questions + dolly_questions
-                context = context + dolly_context
-                answers = answers + dolly_answers
-            print("Size of dolly training data", len(questions))
-
-        if "instruct_qa" in data:
-            instruct_questions, instruct_context, instruct_answers = read_dolly("data/instruct_qa/instruct_qa_fi_train.jsonl",
-                                                                                        lang=lang,
-                                                                                        chatml_format=chatml_format)
-            questions = questions + instruct_questions
-            context = context + instruct_context
-            answers = answers + instruct_answers
-            print("Size of instruct_qa training data", len(questions))
-        if "oasst" in data:
-            if "lang" == "both":
-                languages = ["en", "fi"]
-            else:
-                languages = [lang]
-            for la in languages:
-                oasst_questions, oasst_context, oasst_answers = read_oasst("data/oasst-fi/oasst1-fi-train-filter.jsonl", 
-                                                                               lang=la, 
-                                                                               chatml_format=chatml_format)
-                questions = questions + oasst_questions
-                context = context + oasst_context
-                answers = answers + oasst_answers
-            print("Size of oasst training data", len(questions))
-        if "eval_tasks" in data:
-            tasks = ["arc_challenge", "arc_challenge", "arc_challenge", "arc_challenge", "gsm8k"]
-            for task in tasks:
-                eval_questions, eval_context, eval_answers = read_eval_tasks(task=task, split=split)
-                questions = questions + eval_questions
-                context = context + eval_context
-                answers = answers + eval_answers
-            print("Size of eval_tasks training data", len(questions))
-        if "lima" in data:
-            parent_path = "/scratch/project_462000319/finetuning_data/lima"
-            lima_questions, lima_context, lima_answers = read_lima(os.path.join(parent_path, "fin_lima_translated-enhanced-trimmed-train.jsonl"),
-                                                               chatml_format=chatml_format)
-            questions = questions + lima_questions
-            context = context + lima_context
-            answers = answers + lima_answers
-            print("Size of LIMA training data", len(questions))
+        file_split = "train"
     elif "valid" in split:
-        if "dolly" in data:
-            if "lang" == "both":
-                languages = ["en", "fi"]
-            else:
-                languages = [lang]
-            for la in languages:
-                dolly_questions, dolly_context, dolly_answers = read_dolly("data/dolly-fi/dolly-fi-valid.jsonl", 
-                                                                               lang=la,
-                                                                               chatml_format=chatml_format)
-                questions = questions + dolly_questions
-                context = context + dolly_context
-                answers = answers + dolly_answers
-        if "instruct_qa" in data:
-            instruct_questions, instruct_context, instruct_answers = read_dolly("data/instruct_qa/instruct_qa_fi_valid.jsonl",
-                                                                                        lang=lang,
-                                                                                        chatml_format=chatml_format)
-            questions = questions + instruct_questions
-            context = context + instruct_context
-            answers = answers + instruct_answers
-        if "oasst" in data:
-            if "lang" == "both":
-                languages = ["en", "fi"]
-            else:
-                languages = [lang]
-            for la in languages:
-                oasst_questions, oasst_context, oasst_answers = read_oasst("data/oasst-fi/oasst1-fi-valid-filter.jsonl",
-                                                                       lang=la,
-                                                                       chatml_format=chatml_format)
-                questions = questions + oasst_questions
-                context = context + oasst_context
-                answers = answers + oasst_answers
-        if "eval_tasks" in data:
-            tasks = ["arc_challenge", "arc_challenge", "arc_challenge", "arc_challenge", "gsm8k"]
-            for task in tasks:
-                eval_questions, eval_context, eval_answers = read_eval_tasks(task=task, split=split)
-                questions = questions + eval_questions
-                context = context + eval_context
-                answers = answers + eval_answers
-        if "lima" in data:
-            parent_path = "/scratch/project_462000319/finetuning_data/lima"
-            lima_questions, lima_context, lima_answers = read_lima(os.path.join(parent_path, "fin_lima_translated-enhanced-trimmed-valid.jsonl"),
-                                                               chatml_format=chatml_format)
-            questions = questions + lima_questions
-            context = context + lima_context
-            answers = answers + lima_answers
+        file_split = "valid"
     elif "eval" in split:
-        if "dolly" in data:
-            if "lang" == "both":
-                languages = ["en", "fi"]
-            else:
-                languages = [lang]
-            for la in languages:
-                dolly_questions, dolly_context, dolly_answers = read_dolly("data/dolly-fi/dolly-fi-eval.jsonl", 
-                                                                               lang=la,
-                                                                               chatml_format=chatml_format)
-                questions = questions + dolly_questions
-                context = context + dolly_context
-                answers = answers + dolly_answers
-        if "instruct_qa" in data:
-            instruct_questions, instruct_context, instruct_answers = read_dolly("data/instruct_qa/instruct_qa_fi_eval.jsonl",
-                                                                                lang=lang,
-                                                                                chatml_format=chatml_format)
-            questions = questions + instruct_questions
-            context = context + instruct_context
-            answers = answers + instruct_answers
-        if "oasst" in data:
-            if "lang" == "both":
-                languages = ["en", "fi"]
-            else:
-                languages = [lang]
-            for la in languages:
-                oasst_questions, oasst_context, oasst_answers = read_oasst("data/oasst-fi/oasst1-fi-eval-filter.jsonl",
-                                                                       lang=la,
-                                                                       chatml_format=chatml_format)
-                questions = questions + oasst_questions
-                context = context + oasst_context
-                answers = answers + oasst_answers
-        if "eval_tasks" in data:
-            tasks = ["arc_challenge", "arc_challenge", "arc_challenge", "arc_challenge",  "gsm8k"]
-            for task in tasks:
-                eval_questions, eval_context, eval_answers = read_eval_tasks(task=task, split="valid")
-                questions = questions + eval_questions
-                context = context + eval_context
-                answers = answers + eval_answers
-        if "lima" in data:
-            parent_path = "/scratch/project_462000319/finetuning_data/lima"
-            lima_questions, lima_context, lima_answers = read_lima(os.path.join(parent_path, "fin_lima_translated-enhanced-trimmed-valid.jsonl"),
-                                                               chatml_format=chatml_format)
-            questions = questions + lima_questions
-            context = context + lima_context
-            answers = answers + lima_answers
-
-    data = {
-        'prompt': questions,
-        'context': context,
-        'response': answers,
-    }
-    data = Dataset.from_dict(data)
-    if shuffle_data:
-        data = data.shuffle(seed=42)
+        file_split = "eval"
+    else:
+        return []
+    sources = []
+    for name in selected_sft_sources(data):
+        entry = sft_registry[name]
+        reader = entry["conversation_reader"] if conversations and "conversation_reader" in entry else entry["reader"]
+        kwargs = dict(entry["splits"][file_split])
+        if entry["chatml"]:
+            kwargs["chatml_format"] = chatml_format
+        if context_budget is not None and entry.get("context_budget"):
+            kwargs["context_budget"] = context_budget
+        if entry["languages"] == "expand" and lang == "both":
+            languages = ["en", "fi"]
+        elif entry["languages"] is not None:
+            languages = [lang]
+        else:
+            languages = [None]
+        for la in languages:
+            if la is not None:
+                kwargs = dict(kwargs, lang=la)
+            sources.append((name, reader, kwargs))
+    return sources
+
+
+def source_path(kwargs):
+    return kwargs["path"] if "path" in kwargs else eval_task_path(kwargs["task"], kwargs["split"])
+
+
+def sft_source_paths(data, splits=("train", "valid", "eval"), lang="fi", conversations=False):
+    return [source_path(kwargs)
+            for split in splits
+            for name, reader, kwargs in sft_sources(data, split, lang, conversations=conversations)]
+
+
+def source_file_stats(sources):
+    stats = []
+    for name, reader, kwargs in sources:
+        path = source_path(kwargs)
+        st = os.stat(path)
+        stats.append((path, st.st_size, st.st_mtime_ns))
+    return stats
+
+
+def source_cache_name(sources):
+    # the generator cache is keyed by the config name along with the generator and its arguments,
+    # the size and mtime of the source files make an edited file a new cache entry
+    h = hashlib.blake2b(digest_size=8)
+    h.update(repr(source_file_stats(sources)).encode())
+    return f"source-{h.hexdigest()}"
+
+
+def iter_source(reader, kwargs):
+    yield from reader(**kwargs)
+
+
+def read_source(name, reader, kwargs, backend="python"):
+    if backend == "arrow":
+        # multi-threaded native JSON parsing, columns assembled with Arrow kernels
+        return Dataset(InMemoryTable(table_readers[reader](**kwargs)))
+    # records are written to an on-disk Arrow file as they are read, so memory stays flat
+    return Dataset.from_generator(iter_source,
+                                  gen_kwargs={"reader": reader, "kwargs": kwargs},
+                                  config_name=source_cache_name([(name, reader, kwargs)]))
+
+
+def mix_sources(datasets, names, weights, seed=42):
+    # Each source is read once; upsampling repeats its row indices (the fractional part of a
+    # weight draws a seeded subset) and the mixture is a single index selection over the
+    # concatenated sources.
+    rng = np.random.default_rng(seed)
+    indices = []
+    offset = 0
+    for dataset, name in zip(datasets, names):
+        n = len(dataset)
+        weight = weights.get(name, 1)
+        repeats = int(weight)
+        source_indices = [np.tile(np.arange(n), repeats)]
+        extra = int(round((weight - repeats) * n))
+        if extra > 0:
+            source_indices.append(np.sort(rng.choice(n, size=extra, replace=False)))
+        indices.append(offset + np.concatenate(source_indices))
+        offset += n
+    data = concatenate_datasets(datasets)
+    indices = np.concatenate(indices)
+    if len(indices) == len(data) and np.array_equal(indices, np.arange(len(data))):
+        return data
+    return data.select(indices)
+
+
+shuffle_modes = ["flatten", "sampler", "indices"]
+
+
+def shuffle_dataset(data, shuffle_mode="flatten", seed=42):
+    # "flatten": shuffle and rewrite the rows in shuffled order once, so map/filter/random access
+    #            afterwards read a contiguous table instead of going through an indices mapping
+    # "sampler": keep file order and leave shuffling to the Trainer's RandomSampler
+    # "indices": shuffle through an indices mapping only
+    if shuffle_mode == "indices":
+        return data.shuffle(seed=seed)
+    if shuffle_mode == "flatten":
+        data = data.shuffle(seed=seed)
+    if data._indices is not None:
+        data = data.flatten_indices()
     return data
 
 
+def read_data_sft(data="dolly", split="train", lang="fi", chatml_format=False, shuffle_data=True, conversations=False,
+                  backend="python", weights=None, shuffle_mode="flatten", context_budget=None):
+    # context_budget: a ContextBudget to fit multi-turn threads into the model context
+    sources = sft_sources(data, split=split, lang=lang, chatml_format=chatml_format, conversations=conversations,
+                          context_budget=context_budget)
+    if not sources:
+        return Dataset.from_dict({'prompt': [], 'context': [], 'response': [], 'source': []})
+    weights = dict({name: entry["weight"] for name, entry in sft_registry.items()}, **(weights or {}))
+    datasets = []
+    names = []
+    for name, reader, kwargs in sources:
+        dataset = read_source(name, reader, kwargs, backend=backend)
+        datasets.append(dataset.add_column("source", [name] * len(dataset)))
+        names.append(name)
+        if "train" in split:
+            print(f"Size of {name} training data", len(dataset), "weight", weights.get(name, 1))
+    data = mix_sources(datasets, names, weights)
+    if shuffle_data:
+        data = shuffle_dataset(data, shuffle_mode)
+    return data
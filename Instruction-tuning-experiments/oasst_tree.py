@@ -0,0 +1,114 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Compact index over an OASST message dump. Messages get integer node ids in file order,
+# parents are resolved after the whole file is read (so any file order works) and texts
+# are kept as Arrow string arrays (one buffer + offsets per column) instead of per-thread copies.
+# Contexts are materialized on demand by walking parent pointers up to the root.
+
+
+def _as_arrow(values, type=None):
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        return values
+    return pa.array(values, type)
+
+
+class OasstTree:
+    def __init__(self, message_ids, parent_ids, roles, texts, labels=None):
+        self.message_ids = _as_arrow(message_ids, pa.string())
+        # parents missing from the file (filtered or deleted messages) make their child a root
+        value_set = self.message_ids.combine_chunks() if isinstance(self.message_ids, pa.ChunkedArray) else self.message_ids
+        parent = pc.index_in(_as_arrow(parent_ids, pa.string()), value_set=value_set)
+        self.parent = parent.fill_null(-1).to_numpy().astype(np.int64)
+        self.is_assistant = pc.equal(_as_arrow(roles, pa.string()), "assistant").fill_null(False).to_numpy(zero_copy_only=False)
+        self.texts = {col: _as_arrow(values, pa.large_string()) for col, values in texts.items()}
+        self.labels = {name: np.asarray(values, dtype=np.float64) for name, values in (labels or {}).items()}
+        # children in CSR form, stable so siblings keep file order
+        has_parent = np.flatnonzero(self.parent >= 0)
+        order = has_parent[np.argsort(self.parent[has_parent], kind="stable")]
+        counts = np.bincount(self.parent[has_parent], minlength=len(self))
+        self.child_offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.child_offsets[1:])
+        self.child_index = order
+
+    @classmethod
+    def from_records(cls, records, text_cols=("text", "orig_text"), label_names=()):
+        message_ids = []
+        parent_ids = []
+        roles = []
+        texts = {col: [] for col in text_cols}
+        labels = {name: [] for name in label_names}
+        for record in records:
+            message_ids.append(record["message_id"])
+            parent_ids.append(record["parent_id"])
+            roles.append(record["role"])
+            for col in text_cols:
+                texts[col].append(record[col])
+            record_labels = record.get("labels")
+            for name in label_names:
+                if record_labels and name in record_labels["name"]:
+                    labels[name].append(float(record_labels["value"][record_labels["name"].index(name)]))
+                else:
+                    labels[name].append(np.nan)
+        return cls(message_ids, parent_ids, roles, texts, labels)
+
+    @classmethod
+    def from_table(cls, table, text_cols=("text", "orig_text"), label_names=()):
+        # table in the conversation store layout, see conversation_store.py
+        labels = {}
+        if label_names:
+            names = table.column("label_names").combine_chunks()
+            values = pc.list_flatten(table.column("label_values").combine_chunks()).to_numpy(zero_copy_only=False)
+            rows = pc.list_parent_indices(names).to_numpy()
+            flat_names = pc.list_flatten(names)
+            for name in label_names:
+                match = pc.equal(flat_names, name).fill_null(False).to_numpy(zero_copy_only=False)
+                labels[name] = np.full(table.num_rows, np.nan)
+                labels[name][rows[match]] = values[match]
+        return cls(table.column("message_id"),
+                   table.column("parent_id"),
+                   table.column("role"),
+                   {col: table.column(col) for col in text_cols},
+                   labels)
+
+    def __len__(self):
+        return len(self.message_ids)
+
+    def text(self, node, col):
+        return self.texts[col][int(node)].as_py()
+
+    def children(self, node):
+        return self.child_index[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+    def path(self, node):
+        # root ... node
+        path = []
+        node = int(node)
+        while node >= 0 and len(path) <= len(self):
+            path.append(node)
+            node = int(self.parent[node])
+        path.reverse()
+        return path
+
+    def context(self, node, format_turn, max_turns=None):
+        # same layout the readers have always produced: " " followed by "\n<turn>" for every ancestor,
+        # only the last max_turns of them with a context budget
+        ancestors = self.path(node)[:-1]
+        if max_turns is not None:
+            ancestors = ancestors[len(ancestors) - max_turns:]
+        return " " + "".join("\n" + format_turn(ancestor) for ancestor in ancestors)
+
+    def prompt_answer_pairs(self):
+        # (prompter node, assistant node) for every reply to a prompt, in file order
+        for node in range(len(self)):
+            parent = self.parent[node]
+            if self.is_assistant[node] and parent >= 0 and not self.is_assistant[parent]:
+                yield int(parent), node
+
+    def conversation_ends(self):
+        # (prompter node, assistant node) pairs that close a root-to-leaf conversation,
+        # i.e. no follow-up question to the answer was itself answered
+        for question, answer in self.prompt_answer_pairs():
+            if not any(self.is_assistant[reply] for follow_up in self.children(answer) for reply in self.children(follow_up)):
+                yield question, answer
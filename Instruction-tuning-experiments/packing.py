@@ -0,0 +1,158 @@
+import sys
+import inspect
+import numpy as np
+import torch
+
+from indexed_dataset import token_rows, row_starts, supervised_token_counts, token_lengths
+from collators import PaddingCollator
+
+# Sequence packing for SFT. Tokenized examples are bin-packed first-fit-decreasing into rows of
+# up to max_length tokens. Inside a row, position ids restart at every document and the
+# attention_mask holds the document index of each token (0 for padding) instead of 0/1.
+# transformers 4.36 only takes 2D padding masks, enable_packed_attention makes the model build a
+# block diagonal causal mask from those indices so that no token attends across documents.
+
+
+def first_fit_decreasing(lengths, max_length):
+    # packs[k] lists the examples in row k. A max segment tree over the free space of the rows
+    # (unopened rows have all max_length free) finds the first row an example fits in.
+    lengths = np.asarray(lengths)
+    if len(lengths) == 0:
+        return []
+    if lengths.max() > max_length:
+        raise ValueError(f"can't pack examples longer than {max_length} tokens, filter them by length first")
+    size = 1
+    while size < len(lengths):
+        size *= 2
+    free = [max_length] * (2 * size)
+    packs = []
+    for i in np.argsort(-lengths, kind="stable").tolist():
+        length = int(lengths[i])
+        node = 1
+        while node < size:
+            node = 2 * node if free[2 * node] >= length else 2 * node + 1
+        row = node - size
+        if row == len(packs):
+            packs.append([])
+        packs[row].append(i)
+        free[node] -= length
+        node //= 2
+        while node:
+            free[node] = max(free[2 * node], free[2 * node + 1])
+            node //= 2
+    return packs
+
+
+def example_lengths(dataset):
+    if hasattr(dataset, "lengths"):
+        # IndexedDataset, PackedDataset
+        return dataset.lengths()
+    return token_lengths(dataset)
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    # loss_mask(tokens, offsets) -> bool array over the tokens of a row, as for export_indexed_dataset.
+    # Without it the examples have to carry their labels already (tokenize_sft, IndexedDataset).
+    def __init__(self, dataset, max_length, loss_mask=None):
+        self.dataset = dataset
+        self.loss_mask = loss_mask
+        lengths = example_lengths(dataset)
+        self.packs = first_fit_decreasing(lengths, max_length)
+        self.pack_lengths = np.array([lengths[pack].sum() for pack in self.packs], dtype=np.int64)
+        if self.packs:
+            print(f"Packed {len(lengths)} examples into {len(self.packs)} rows of {max_length} tokens, "
+                  f"{lengths.sum()/(len(self.packs)*max_length):.1%} full")
+
+    def __len__(self):
+        return len(self.packs)
+
+    def lengths(self):
+        return self.pack_lengths
+
+    def supervised_counts(self):
+        # no document's first token is supervised in a row either
+        counts = supervised_token_counts(self.dataset, self.loss_mask)
+        return np.array([counts[pack].sum() for pack in self.packs], dtype=np.int64)
+
+    def __getitem__(self, i):
+        examples = [self.dataset[j] for j in self.packs[i]]
+        input_ids = np.concatenate([np.asarray(e["input_ids"], dtype=np.int64) for e in examples])
+        offsets = np.concatenate([[0], np.cumsum([len(e["input_ids"]) for e in examples])])
+        if self.loss_mask is None:
+            labels = np.concatenate([np.asarray(e["labels"], dtype=np.int64) for e in examples])
+        else:
+            labels = np.where(self.loss_mask(input_ids, offsets), input_ids, -100)
+        # the first token of a document would be predicted from the end of the previous one
+        labels[offsets[:-1]] = -100
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": np.arange(len(input_ids)) - row_starts(offsets),
+            "attention_mask": token_rows(offsets) + 1,
+        }
+
+
+class PackedDataCollator(PaddingCollator):
+    def __init__(self, tokenizer, position_ids=True):
+        pad_values = {"input_ids": tokenizer.pad_token_id, "labels": -100, "attention_mask": 0}
+        if position_ids:
+            pad_values["position_ids"] = 0
+        super().__init__(pad_values)
+
+
+def base_model(model):
+    # under a peft wrapper
+    return model.get_base_model() if hasattr(model, "get_base_model") else model
+
+
+def takes_position_ids(model):
+    # ALiBi models (BLOOM, Poro) have no position ids
+    return "position_ids" in inspect.signature(base_model(model).forward).parameters
+
+
+def packed_causal_mask(documents, dtype, sliding_window=None):
+    # (batch, 1, query, key) additive mask, a token sees the earlier tokens of its own document
+    length = documents.shape[-1]
+    positions = torch.arange(length, device=documents.device)
+    allowed = ((documents[:, :, None] == documents[:, None, :])
+               & (positions[None, :, None] >= positions[None, None, :]))
+    if sliding_window is not None:
+        allowed &= positions[None, :, None] - positions[None, None, :] < sliding_window
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=documents.device)
+    return mask.masked_fill(~allowed, torch.finfo(dtype).min)[:, None]
+
+
+def packed_mask_function(prepare_mask):
+    def prepare_packed_mask(attention_mask, input_shape, inputs_embeds, past_key_values_length, sliding_window=None):
+        # generation with a cache goes through the original 0/1 mask path
+        if attention_mask is None or past_key_values_length > 0 or attention_mask.dim() != 2:
+            return prepare_mask(attention_mask, input_shape, inputs_embeds, past_key_values_length, sliding_window)
+        # a 0/1 padding mask is the one document case of this
+        return packed_causal_mask(attention_mask, inputs_embeds.dtype, sliding_window)
+    return prepare_packed_mask
+
+
+def packed_alibi_function(build_alibi_tensor):
+    def build_packed_alibi_tensor(attention_mask, num_heads, dtype):
+        # ALiBi only depends on distances within a document and the block diagonal mask hides
+        # the others, so key positions can run across the whole row
+        return build_alibi_tensor((attention_mask > 0).to(attention_mask.dtype), num_heads, dtype)
+    return build_packed_alibi_tensor
+
+
+def enable_packed_attention(model):
+    model = base_model(model)
+    if getattr(model.config, "_attn_implementation", None) == "flash_attention_2":
+        raise ValueError("packing needs the eager or sdpa attention, flash attention only takes padding masks")
+    module = sys.modules[type(model).__module__]
+    patched = []
+    for name in ["_prepare_4d_causal_attention_mask", "_prepare_4d_causal_attention_mask_for_sdpa"]:
+        if hasattr(module, name):
+            setattr(module, name, packed_mask_function(getattr(module, name)))
+            patched.append(name)
+    if hasattr(module, "build_alibi_tensor"):
+        module.build_alibi_tensor = packed_alibi_function(module.build_alibi_tensor)
+        patched.append("build_alibi_tensor")
+    if not any(name.startswith("_prepare_4d") for name in patched):
+        raise ValueError(f"packed attention is not supported for {type(model).__name__}")
+    print("Packed attention masks for", type(model).__name__)
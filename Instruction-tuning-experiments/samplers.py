@@ -0,0 +1,184 @@
+import numpy as np
+import torch
+
+# Length-bucketed training order. Every epoch the examples are shuffled and cut into buckets of
+# bucket_batches micro-batches, each bucket is sorted by length and cut into micro-batches, and
+# the micro-batches of all buckets are shuffled again. Consecutive runs of batch_size indices
+# are then examples of similar length, which the Trainer's BatchSampler turns into micro-batches
+# (and accelerate deals out to the ranks), while the order of the batches stays random.
+
+
+def bucketed_batches(lengths, batch_size, bucket_batches, rng):
+    order = rng.permutation(len(lengths))
+    bucket_size = batch_size * bucket_batches
+    batches = []
+    for start in range(0, len(order), bucket_size):
+        bucket = order[start:start + bucket_size]
+        bucket = bucket[np.argsort(lengths[bucket], kind="stable")]
+        batches.extend(bucket[i:i + batch_size] for i in range(0, len(bucket), batch_size))
+    # only the last bucket can end in a short batch, it stays last so that the others stay aligned
+    last = [batches.pop()] if batches and len(batches[-1]) < batch_size else []
+    return [batches[i] for i in rng.permutation(len(batches))] + last
+
+
+def padding_ratio(lengths, batches):
+    # share of padding tokens in the padded micro-batches
+    padded = sum(lengths[batch].max() * len(batch) for batch in batches)
+    return 1 - lengths.sum() / padded if padded else 0.0
+
+
+class LengthBucketedSampler(torch.utils.data.Sampler):
+    def __init__(self, lengths, batch_size, bucket_batches=64, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self, epoch):
+        rng = np.random.default_rng([self.seed, epoch])
+        return bucketed_batches(self.lengths, self.batch_size, self.bucket_batches, rng)
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)
+        # accelerate only passes the epoch on to the sampler of a single process, count it here
+        # (before the first index, the Trainer starts an iteration per epoch to skip on resume)
+        self.epoch += 1
+        for batch in batches:
+            yield from batch.tolist()
+
+    def report(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        order = rng.permutation(len(self.lengths))
+        random_batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        print(f"Padding with length bucketing: {padding_ratio(self.lengths, self.batches(self.epoch)):.1%} "
+              f"of the tokens, with random batches: {padding_ratio(self.lengths, random_batches):.1%} "
+              f"(per_device_batch_size {self.batch_size})")
+
+
+# Evaluation order. The whole eval set is one bucket: sorted by length and cut into batches,
+# so that a batch is hardly padded, and the batches come in a random order that is the same for
+# every evaluation of the run. An evaluation cut short by a time budget has then covered a
+# random sample of the batches rather than the shortest examples, and the same one every time.
+
+
+class EvalSampler(torch.utils.data.Sampler):
+    def __init__(self, lengths, batch_size, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        rng = np.random.default_rng(seed)
+        self.batches = bucketed_batches(self.lengths, batch_size, len(self.lengths) // batch_size + 1, rng)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield from batch.tolist()
+
+    def report(self):
+        in_order = [np.arange(i, min(i + self.batch_size, len(self.lengths))) for i in range(0, len(self.lengths), self.batch_size)]
+        print(f"Eval padding sorted by length: {padding_ratio(self.lengths, self.batches):.1%} of the tokens, "
+              f"in dataset order: {padding_ratio(self.lengths, in_order):.1%} "
+              f"(per_device_eval_batch_size {self.batch_size})")
+
+
+# Token-budget batching. Examples are sorted by length (ties in random order) and cut into
+# micro-batches of as many rows as fit max_tokens once padded to the longest row, so the rows per
+# batch vary with the length. The batches are fixed for the run, as in fairseq, and only their
+# order is shuffled every epoch, which keeps the number of steps per epoch constant.
+
+
+def token_budget_batches(lengths, max_tokens, rng):
+    order = rng.permutation(len(lengths))
+    order = order[np.argsort(lengths[order], kind="stable")]
+    batches = []
+    start = 0
+    for end in range(len(order)):
+        # ascending order, the current example is the longest of the batch
+        if end > start and (end - start + 1) * lengths[order[end]] > max_tokens:
+            batches.append(order[start:end])
+            start = end
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+
+def split_to_multiple(batches, multiple):
+    # every rank takes the same number of batches and the accumulation windows line up with the
+    # epochs, split the biggest batches until the count divides evenly
+    while len(batches) % multiple:
+        k = max(range(len(batches)), key=lambda b: len(batches[b]))
+        batch = batches[k]
+        if len(batch) < 2:
+            batches.append(batch)
+            continue
+        batches[k:k + 1] = [batch[:len(batch) // 2], batch[len(batch) // 2:]]
+    return batches
+
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    # With supervised (label tokens per example) the indices come paired with the number of
+    # supervised tokens in their accumulation window, window_batches consecutive batches
+    # (gradient_accumulation_steps x ranks), for the loss normalization of TokenBudgetMixin.
+    def __init__(self, lengths, max_tokens, window_batches=1, supervised=None, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.window_batches = window_batches
+        self.supervised = supervised
+        self.seed = seed
+        self.epoch = 0
+        rng = np.random.default_rng(seed)
+        self.batches = split_to_multiple(token_budget_batches(self.lengths, max_tokens, rng), window_batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+        batches = [self.batches[i] for i in rng.permutation(len(self.batches))]
+        for start in range(0, len(batches), self.window_batches):
+            window = batches[start:start + self.window_batches]
+            if self.supervised is None:
+                yield from (batch.tolist() for batch in window)
+                continue
+            tokens = int(sum(self.supervised[batch].sum() for batch in window))
+            for batch in window:
+                yield [(int(i), tokens) for i in batch]
+
+    def report(self):
+        rows = np.array([len(batch) for batch in self.batches])
+        print(f"Token budget {self.max_tokens}: {len(self.batches)} batches of {rows.min()}-{rows.max()} "
+              f"(mean {rows.mean():.1f}) rows, padding {padding_ratio(self.lengths, self.batches):.1%} of the tokens")
+
+
+class WindowTokensDataset(torch.utils.data.Dataset):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, item):
+        i, tokens = item
+        return self.dataset[i], tokens
+
+
+class WindowTokensCollator:
+    def __init__(self, collator):
+        self.collator = collator
+
+    def __call__(self, features):
+        batch = self.collator([feature for feature, _ in features])
+        batch["window_tokens"] = torch.tensor(features[0][1])
+        return batch
@@ -44,8 +44,9 @@ python -m pip install --upgrade pip setuptools wheel
 # Install pip packages
 #python -m pip install --upgrade torch==1.13.1+rocm5.2 --extra-index-url https://download.pytorch.org/whl/rocm5.2
 python -m pip install --upgrade numpy datasets evaluate accelerate scikit-learn nltk
+# must be a 4.36 branch, trainers.AsyncCheckpointMixin follows its Trainer and a newer trl would upgrade it
 python -m pip install --upgrade /scratch/project_462000319/zosaelai2/transformers
-python -m pip install --upgrade trl
+python -m pip install trl==0.7.4
 python -m pip install --upgrade deepspeed
 python -m pip install --upgrade tensorboard
 python -m pip install --upgrade peft
@@ -27,8 +27,9 @@ python -m pip install --upgrade pip setuptools wheel
 # Install pip packages
 #python -m pip install --upgrade torch==1.13.1+rocm5.2 --extra-index-url https://download.pytorch.org/whl/rocm5.2
 python -m pip install --upgrade numpy datasets evaluate accelerate scikit-learn nltk
-python -m pip install --upgrade transformers
-python -m pip install --upgrade trl
+# trainers.AsyncCheckpointMixin follows the Trainer of 4.36, a newer trl would upgrade it
+python -m pip install transformers==4.36.2
+python -m pip install trl==0.7.4
 python -m pip install --upgrade deepspeed
 python -m pip install --upgrade tensorboard
 python -m pip install --upgrade peft
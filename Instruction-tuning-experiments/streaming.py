@@ -0,0 +1,136 @@
+import os
+import json
+import math
+import numpy as np
+import torch
+from transformers import TrainerCallback
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR, get_last_checkpoint
+
+# Streaming training mode. Rows are read one at a time from the memory-mapped Arrow dataset and
+# formatted/tokenized in the collator. The order is a seeded shuffle within windows of buffer_size
+# consecutive rows (windows visited in random order, a fresh permutation every epoch), so at most
+# one window of indices is held and reads stay local like with a shuffle buffer. Unlike a shuffle
+# buffer the order is a pure function of the position in the stream, so a checkpoint only needs
+# that one integer and a resumed run starts reading right where it stopped.
+# With dataloader workers, worker k of n reads the batches k, k + n, k + 2n, ... of batch_size
+# rows (the micro-batch of all ranks), which the DataLoader takes from the workers in turn, so
+# the order and the stream position are those of a single reader.
+
+stream_state_file = "stream_state.json"
+
+
+class WindowedPermutation:
+    def __init__(self, num_examples, window_size, seed=42):
+        self.num_examples = num_examples
+        self.window_size = max(1, min(window_size, num_examples))
+        self.seed = seed
+        self.num_windows = math.ceil(num_examples / self.window_size)
+
+    def window_order(self, epoch):
+        order = np.random.default_rng([self.seed, epoch]).permutation(self.num_windows)
+        sizes = np.minimum(self.window_size, self.num_examples - order * self.window_size)
+        return order, np.concatenate([[0], np.cumsum(sizes)])
+
+    def window(self, epoch, window):
+        start = window * self.window_size
+        size = min(self.window_size, self.num_examples - start)
+        return start + np.random.default_rng([self.seed, epoch, window]).permutation(size)
+
+    def rows(self, position=0):
+        # row indices from an absolute stream position on, epoch after epoch
+        if self.num_examples == 0:
+            return
+        epoch, offset = divmod(position, self.num_examples)
+        while True:
+            order, starts = self.window_order(epoch)
+            k = int(np.searchsorted(starts, offset, side="right")) - 1
+            for k in range(k, self.num_windows):
+                rows = self.window(epoch, order[k])
+                for row in rows[offset - starts[k]:]:
+                    yield int(row)
+                offset = starts[k + 1]
+            epoch += 1
+            offset = 0
+
+
+class StreamingDataset(torch.utils.data.IterableDataset):
+    def __init__(self, dataset, buffer_size=10000, seed=42, start_position=0, batch_size=1):
+        self.dataset = dataset
+        self.order = WindowedPermutation(len(dataset), buffer_size, seed)
+        self.start_position = start_position
+        self.batch_size = batch_size
+
+    @property
+    def num_examples(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        for i, row in enumerate(self.order.rows(self.start_position)):
+            # only the rows of this worker's batches are read
+            if (i // self.batch_size) % num_workers == worker_id:
+                yield self.dataset[row]
+
+
+def streaming_max_steps(num_examples, num_train_epochs, training_args):
+    examples_per_step = (training_args.per_device_train_batch_size * training_args.gradient_accumulation_steps
+                         * training_args.world_size)
+    return math.ceil(num_train_epochs * num_examples / examples_per_step)
+
+
+def prepare_streaming_args(training_args, num_examples, num_train_epochs):
+    # an iterable train set has no length, the Trainer needs max_steps instead of epochs
+    training_args.max_steps = streaming_max_steps(num_examples, num_train_epochs, training_args)
+    # the stream restarts at its saved position, don't replay and discard batches on resume
+    training_args.ignore_data_skip = True
+    # every rank reads the stream and keeps its share; dispatching from rank 0 would
+    # concatenate batches of different padded lengths
+    training_args.dispatch_batches = False
+    # rows reach the collator untokenized
+    training_args.remove_unused_columns = False
+    print("Streaming", num_examples, "examples for", training_args.max_steps, "steps")
+
+
+def resolve_checkpoint(resume_from_checkpoint, output_dir):
+    # "true" resumes from the latest checkpoint in output_dir
+    if resume_from_checkpoint is None or resume_from_checkpoint.lower() == "false":
+        return None
+    if resume_from_checkpoint.lower() == "true":
+        return get_last_checkpoint(output_dir)
+    return resume_from_checkpoint
+
+
+def load_stream_position(checkpoint_dir):
+    if checkpoint_dir is None or not os.path.exists(os.path.join(checkpoint_dir, stream_state_file)):
+        return 0
+    with open(os.path.join(checkpoint_dir, stream_state_file)) as f:
+        state = json.load(f)
+    print("Resuming the stream at example", state["position"])
+    return state["position"]
+
+
+class StreamPositionCallback(TrainerCallback):
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.start_step = 0
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        # global_step is already restored from the checkpoint here
+        self.start_step = state.global_step
+
+    def on_save(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero:
+            return
+        examples_per_step = args.per_device_train_batch_size * args.gradient_accumulation_steps * args.world_size
+        position = self.dataset.start_position + (state.global_step - self.start_step) * examples_per_step
+        checkpoint_dir = os.path.join(args.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{state.global_step}")
+        # an asynchronous save (AsyncCheckpointMixin) is renamed to checkpoint-N once it is written
+        staging_dir = os.path.join(args.output_dir, f"tmp-{PREFIX_CHECKPOINT_DIR}-{state.global_step}")
+        if os.path.isdir(staging_dir):
+            checkpoint_dir = staging_dir
+        with open(os.path.join(checkpoint_dir, stream_state_file), "w") as f:
+            json.dump({"position": position,
+                       "num_examples": self.dataset.num_examples,
+                       "buffer_size": self.dataset.order.window_size,
+                       "seed": self.dataset.order.seed}, f)
@@ -0,0 +1,56 @@
+import os
+import sys
+import json
+import importlib.util
+import pytest
+
+experiments_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, experiments_dir)
+
+corpus = [
+    "The quick brown fox jumps over the lazy dog.",
+    "Kettu hyppää laiskan koiran yli ja juoksee metsään.",
+    "Write a short answer to the question below, please.",
+    "What is the capital of Finland? Helsinki is the capital.",
+    "Numbers 1 2 3 4 5 6 7 8 9 0 and some punctuation: ; , . ! ?",
+]
+
+
+def load_script(name):
+    # the training scripts are not importable by name (huggingface-finetune.py)
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_").replace(".py", ""),
+                                                  os.path.join(experiments_dir, name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_jsonl(path, records):
+    os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def tokenizer():
+    from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+    special_tokens = ["<unk>", "<pad>", "</s>", "<|user|>", "<|assistant|>"]
+    tok = Tokenizer(models.BPE(unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizers.Whitespace()
+    tok.train_from_iterator(corpus * 10, trainers.BpeTrainer(vocab_size=200, special_tokens=special_tokens,
+                                                              show_progress=False))
+    return PreTrainedTokenizerFast(tokenizer_object=tok, unk_token="<unk>", pad_token="<pad>", eos_token="</s>",
+                                   additional_special_tokens=["<|user|>", "<|assistant|>"])
+
+
+@pytest.fixture
+def tiny_llama(tokenizer):
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+    torch.manual_seed(0)
+    return LlamaForCausalLM(LlamaConfig(vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64,
+                                        num_hidden_layers=2, num_attention_heads=2, num_key_value_heads=2,
+                                        max_position_embeddings=512))
@@ -0,0 +1,88 @@
+import logging
+import random
+import pytest
+
+import dpo_finetuning_datasets as dpo
+from arrow_readers import ultrafeedback_table, hh_table
+from conftest import write_jsonl
+
+
+def table_pairs(table):
+    return tuple(table.column(col).to_pylist() for col in dpo.pair_columns)
+
+
+def ultrafeedback_records(n=60, seed=0):
+    rng = random.Random(seed)
+    criteria = ['instruction_following', 'honesty', 'truthfulness', 'helpfulness']
+    records = []
+    for i in range(n):
+        completions = []
+        # 0 and 1 completions give no pair, equal ratings neither
+        for j in range(i % 5):
+            ratings = {crit: {"Rating": rng.choice(["1", "2", "3", "4", "5", "N/A"]) if i % 7 else "3"}
+                       for crit in criteria}
+            completions.append({"annotations": ratings, "response": f"response {i}.{j}"})
+        records.append({"instruction": f"instruction {i}", "completions": completions})
+    return records
+
+
+def hh_records():
+    h, a = "\n\nHuman:", "\n\nAssistant:"
+    return [
+        {"chosen": f"{h} hi{a} hello", "rejected": f"{h} hi{a} go away"},
+        {"chosen": f"{h} one{a} two{h} three{a} four", "rejected": f"{h} one{a} two{h} three{a} five"},
+        # no markers, skipped by both
+        {"chosen": "plain text", "rejected": "plain text"},
+        # the rejected transcript has no assistant turn
+        {"chosen": f"{h} q{a} yes", "rejected": f"{h} q"},
+        # a trailing user turn after the last answer
+        {"chosen": f"{h} q{a} yes{h} thanks", "rejected": f"{h} q{a} no{h} thanks"},
+        {"chosen": f"{h}  spaced  {a}  answer  ", "rejected": f"{h}  spaced  {a}  other  "},
+    ]
+
+
+@pytest.mark.parametrize("max_examples", [0, 5, 10000])
+def test_ultrafeedback_table_matches_reader(tmp_path, max_examples):
+    path = write_jsonl(tmp_path / "uf.jsonl", ultrafeedback_records())
+    expected = dpo.read_ultrafeedback(path, max_examples=max_examples)
+    assert table_pairs(ultrafeedback_table(path, max_examples=max_examples)) == tuple(expected)
+    assert len(expected[0]) > 0
+
+
+@pytest.mark.parametrize("max_examples", [0, 3, 10000])
+def test_hh_table_matches_reader(tmp_path, max_examples):
+    path = write_jsonl(tmp_path / "hh.jsonl", hh_records())
+    expected = dpo.read_hh(path, max_examples=max_examples)
+    assert table_pairs(hh_table(path, max_examples=max_examples)) == tuple(expected)
+
+
+def test_hh_table_empty(tmp_path):
+    path = write_jsonl(tmp_path / "hh.jsonl", [{"chosen": "no markers", "rejected": "none"}])
+    assert hh_table(path).num_rows == 0
+
+
+@pytest.mark.parametrize("data", ["ultrafeedback", "hh", "ultrafeedback_hh"])
+@pytest.mark.parametrize("split", ["train", "valid"])
+def test_read_data_dpo_backends_agree(tmp_path, monkeypatch, data, split):
+    monkeypatch.chdir(tmp_path)
+    for name in ("train", "valid", "eval"):
+        write_jsonl(tmp_path / f"data/UltraFeedback/ultrafeedback-{name}.jsonl", ultrafeedback_records(seed=len(name)))
+        write_jsonl(tmp_path / f"hh-{name}.jsonl", hh_records())
+        monkeypatch.setitem(dpo.dpo_files[name], "hh", str(tmp_path / f"hh-{name}.jsonl"))
+    python = dpo.read_data_dpo(data, split=split, shuffle_data=False, backend="python")
+    arrow = dpo.read_data_dpo(data, split=split, shuffle_data=False, backend="arrow")
+    assert len(python) > 0
+    assert python.to_dict() == arrow.to_dict()
+
+
+def test_sources_without_table_reader_warn(tmp_path, caplog):
+    def read_pairs_from_lists(path):
+        return ["p"], ["c"], ["a"], ["r"]
+    tables = []
+    with caplog.at_level(logging.WARNING):
+        assert dpo.read_pairs(tables, "arrow", read_pairs_from_lists, None, "some.jsonl") == 1
+    assert "read_pairs_from_lists has no Arrow table reader" in caplog.text
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        dpo.read_pairs(tables, "python", read_pairs_from_lists, None, "some.jsonl")
+    assert caplog.text == ""
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+from transformers import PreTrainedTokenizerFast
+
+from chat_template import TemplateEncoder, splices_exactly
+from indexed_dataset import conversation_loss_mask
+from conftest import corpus
+
+
+def byte_level_tokenizer(add_prefix_space=False):
+    # a BLOOM style tokenizer
+    special_tokens = ["<unk>", "<pad>", "</s>", "<|user|>", "<|assistant|>"]
+    tok = Tokenizer(models.BPE(unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=add_prefix_space)
+    tok.decoder = decoders.ByteLevel()
+    tok.train_from_iterator(corpus * 10, trainers.BpeTrainer(vocab_size=400, special_tokens=special_tokens,
+                                                              initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+                                                              show_progress=False))
+    return PreTrainedTokenizerFast(tokenizer_object=tok, unk_token="<unk>", pad_token="<pad>", eos_token="</s>",
+                                   additional_special_tokens=["<|user|>", "<|assistant|>"])
+
+
+def conversations():
+    return ["<|user|> The quick brown fox?\n<|assistant|>Jumps over the lazy dog.</s>",
+            "Context first.\n<|user|>Mikä on Suomen pääkaupunki?\n<|assistant|> Helsinki.\n<|user|> Kiitos!\n<|assistant|>Ole hyvä</s>",
+            "no markers at all",
+            "",
+            "<|assistant|><|assistant|>  two  spaces  <|user|>"]
+
+
+def assert_encodes_like_the_tokenizer(encoder, texts):
+    tokens, offsets, spans = encoder.encode(texts)
+    expected = encoder.tokenizer(texts)["input_ids"]
+    assert [tokens[offsets[i]:offsets[i + 1]].tolist() for i in range(len(texts))] == expected
+    # the assistant spans of the splicing cover the tokens of the loss mask
+    covered = np.zeros(len(tokens), dtype=bool)
+    for row, start, end in spans:
+        covered[offsets[row] + start:offsets[row] + end] = True
+    assert (covered == conversation_loss_mask(tokens, offsets, encoder.turn_marker_ids)).all()
+
+
+def test_byte_level_tokenizer_is_spliced():
+    tokenizer = byte_level_tokenizer()
+    assert splices_exactly(tokenizer)
+    encoder = TemplateEncoder(tokenizer)
+    assert encoder.exact
+    assert_encodes_like_the_tokenizer(encoder, conversations())
+    assert encoder.exact
+
+
+@pytest.mark.parametrize("make_tokenizer", [lambda tokenizer: tokenizer, lambda _: byte_level_tokenizer(True)])
+def test_other_tokenizers_encode_whole_texts(tokenizer, make_tokenizer):
+    # whitespace pre-tokenization, a prefix space per piece
+    tokenizer = make_tokenizer(tokenizer)
+    assert not splices_exactly(tokenizer)
+    encoder = TemplateEncoder(tokenizer)
+    assert not encoder.exact
+    assert_encodes_like_the_tokenizer(encoder, conversations())
+
+
+def test_mismatch_in_the_data_switches_to_whole_texts():
+    encoder = TemplateEncoder(byte_level_tokenizer(), sample_size=100)
+    # a piece the data splices wrong
+    encoder.pieces[" Helsinki.\n"] = [0]
+    assert_encodes_like_the_tokenizer(encoder, conversations())
+    assert not encoder.exact and not encoder.pieces
+
+
+def test_truncation():
+    tokenizer = byte_level_tokenizer()
+    tokenizer.model_max_length = 12
+    encoder = TemplateEncoder(tokenizer)
+    assert encoder.exact
+    tokens, offsets, spans = encoder.encode(conversations())
+    assert np.diff(offsets).max() == 12
+    expected = tokenizer(conversations(), truncation=True)["input_ids"]
+    assert [tokens[offsets[i]:offsets[i + 1]].tolist() for i in range(len(expected))] == expected
+    assert (spans[:, 2] <= 12).all()
@@ -0,0 +1,73 @@
+import os
+import threading
+
+import pytest
+import torch
+from safetensors.torch import load_file
+from transformers import TrainingArguments
+
+import trainers
+from checkpointing import AsyncCheckpointWriter
+from collators import LabelPaddingCollator
+from trainers import BucketedTrainer
+from test_trainers import sft_dataset
+
+
+def checkpoint_trainer(output_dir, tokenizer, model, dataset, async_checkpointing):
+    args = TrainingArguments(output_dir=str(output_dir), report_to=[], seed=0, use_cpu=True,
+                             per_device_train_batch_size=2, max_steps=4, save_strategy="steps", save_steps=2,
+                             logging_steps=1)
+    return BucketedTrainer(model=model, args=args, train_dataset=dataset, data_collator=LabelPaddingCollator(tokenizer),
+                           tokenizer=tokenizer, async_checkpointing=async_checkpointing)
+
+
+def files(directory):
+    return sorted(os.path.relpath(os.path.join(root, name), directory)
+                  for root, _, names in os.walk(directory) for name in names)
+
+
+def test_async_checkpoints_match_the_trainer_ones(tmp_path, tokenizer, tiny_llama):
+    dataset = sft_dataset(tokenizer, n=8)
+    state = {k: v.clone() for k, v in tiny_llama.state_dict().items()}
+    checkpoint_trainer(tmp_path / "sync", tokenizer, tiny_llama, dataset, False).train()
+    tiny_llama.load_state_dict(state)
+    checkpoint_trainer(tmp_path / "async", tokenizer, tiny_llama, dataset, True).train()
+
+    # no tmp-checkpoint-N left behind
+    assert sorted(os.listdir(tmp_path / "async")) == sorted(os.listdir(tmp_path / "sync")) == ["checkpoint-2", "checkpoint-4"]
+    for checkpoint in ("checkpoint-2", "checkpoint-4"):
+        sync, written = tmp_path / "sync" / checkpoint, tmp_path / "async" / checkpoint
+        assert files(written) == files(sync)
+        expected = load_file(sync / "model.safetensors")
+        for key, tensor in load_file(written / "model.safetensors").items():
+            torch.testing.assert_close(tensor, expected[key], rtol=0, atol=0)
+        expected = torch.load(sync / "optimizer.pt", weights_only=False)["state"]
+        for key, value in torch.load(written / "optimizer.pt", weights_only=False)["state"].items():
+            for name, tensor in value.items():
+                torch.testing.assert_close(tensor, expected[key][name], rtol=0, atol=0)
+
+
+def test_capture_only_defers_the_capturing_thread(tmp_path):
+    writer = AsyncCheckpointWriter()
+    tensor = torch.arange(4.0)
+    with writer.capture():
+        other = threading.Thread(target=torch.save, args=(tensor, str(tmp_path / "other.pt")))
+        other.start()
+        other.join()
+        torch.save(tensor, str(tmp_path / "deferred.pt"))
+        # only the capturing thread's tensor went through the host copy
+        assert writer.copied == 1
+    writer.wait()
+    for name in ("other.pt", "deferred.pt"):
+        torch.testing.assert_close(torch.load(tmp_path / name), tensor)
+
+
+def test_async_checkpointing_refuses_zero3_and_other_transformers(tmp_path, tokenizer, tiny_llama, monkeypatch):
+    dataset = sft_dataset(tokenizer, n=4)
+    checkpoint_trainer(tmp_path, tokenizer, tiny_llama, dataset, False)
+    monkeypatch.setattr(trainers, "is_deepspeed_zero3_enabled", lambda: True)
+    with pytest.raises(ValueError, match="ZeRO-3"):
+        checkpoint_trainer(tmp_path, tokenizer, tiny_llama, dataset, True)
+    monkeypatch.setattr(trainers.transformers, "__version__", "4.40.0")
+    with pytest.raises(ValueError, match="4.36"):
+        checkpoint_trainer(tmp_path, tokenizer, tiny_llama, dataset, True)
@@ -0,0 +1,141 @@
+import json
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from datasets import Dataset
+
+from collators import LabelPaddingCollator
+from indexed_dataset import (
+    IndexedDataset, export_indexed_dataset, is_index_current, supervised_token_counts, token_lengths,
+    prompt_loss_mask, eval_task_loss_mask, conversation_loss_mask, flat_tokens,
+)
+from conftest import load_script
+
+hf = load_script("huggingface-finetune.py")
+
+
+def sft_rows(n=23):
+    words = "the quick brown fox jumps over the lazy dog kettu hyppää koiran yli".split()
+    rows = []
+    for i in range(n):
+        rows.append({"prompt": "<|user|>" + " ".join(words[:1 + i % 7]),
+                     "context": "" if i % 3 else " ".join(words[i % 5:]),
+                     # an odd number of tokens now and then, so examples end mid byte of the mask
+                     "response": "<|assistant|>" + " ".join(words[i % 4:i % 4 + 1 + i % 6])})
+    return Dataset.from_list(rows)
+
+
+def model_args(training_data="dolly"):
+    return SimpleNamespace(training_data=training_data, conversations=False, preprocessing_num_workers=None)
+
+
+@pytest.fixture
+def tokenized(tokenizer):
+    args = model_args()
+    return hf.tokenize_sft(sft_rows(), tokenizer, args, hf.sft_loss_mask(tokenizer, args))
+
+
+def test_round_trip_matches_tokenized(tmp_path, tokenized):
+    prefix = str(tmp_path / "index" / "train")
+    # small batches, the mask bits of an example cross bytes and batches
+    export_indexed_dataset(tokenized, prefix, batch_size=3)
+    indexed = IndexedDataset(prefix)
+    assert len(indexed) == len(tokenized)
+    labels = np.concatenate(tokenized["labels"])
+    assert (labels == -100).any() and (labels != -100).any()
+    for i, row in enumerate(tokenized):
+        item = indexed[i]
+        assert item["input_ids"].tolist() == row["input_ids"]
+        assert item["labels"].tolist() == row["labels"]
+    assert indexed.lengths().tolist() == token_lengths(tokenized).tolist()
+    assert indexed.supervised_counts(batch_size=4).tolist() == supervised_token_counts(tokenized).tolist()
+
+
+def test_collated_batches_match(tmp_path, tokenizer, tokenized):
+    prefix = str(tmp_path / "train")
+    export_indexed_dataset(tokenized, prefix, batch_size=5)
+    indexed = IndexedDataset(prefix)
+    collator = LabelPaddingCollator(tokenizer)
+    for start in range(0, len(tokenized), 4):
+        rows = range(start, min(start + 4, len(tokenized)))
+        expected = collator([{k: tokenized[i][k] for k in ("input_ids", "labels")} for i in rows])
+        batch = collator([indexed[i] for i in rows])
+        for key in expected:
+            assert torch.equal(batch[key], expected[key])
+
+
+def test_loss_mask_argument_overrides_labels(tmp_path, tokenizer, tokenized):
+    # exporting with the loss mask gives the labels column it made
+    prefix = str(tmp_path / "train")
+    export_indexed_dataset(tokenized.remove_columns("labels"), prefix, loss_mask=hf.sft_loss_mask(tokenizer, model_args()))
+    indexed = IndexedDataset(prefix)
+    assert [indexed[i]["labels"].tolist() for i in range(len(indexed))] == tokenized["labels"]
+
+
+def test_metadata(tmp_path, tokenized):
+    prefix = str(tmp_path / "train")
+    assert not is_index_current(prefix, tokenized._fingerprint)
+    export_indexed_dataset(tokenized, prefix)
+    with open(prefix + ".json") as f:
+        meta = json.load(f)
+    assert meta["num_examples"] == len(tokenized)
+    assert meta["num_tokens"] == int(token_lengths(tokenized).sum())
+    assert is_index_current(prefix, tokenized._fingerprint)
+    assert not is_index_current(prefix, "another fingerprint")
+
+
+def test_empty_dataset(tmp_path, tokenized):
+    prefix = str(tmp_path / "empty")
+    export_indexed_dataset(tokenized.select([]), prefix)
+    indexed = IndexedDataset(prefix)
+    assert len(indexed) == 0
+    assert indexed.supervised_counts().tolist() == []
+
+
+def rows_of(tokens, offsets):
+    return [tokens[offsets[i]:offsets[i + 1]].tolist() for i in range(len(offsets) - 1)]
+
+
+def flat(rows):
+    tokens, offsets = flat_tokens(Dataset.from_dict({"input_ids": rows}).with_format("arrow")["input_ids"])
+    return tokens, offsets
+
+
+def test_prompt_loss_mask():
+    rows = [[5, 9, 7, 9, 3], [4, 4], [], [9], [1, 9, 2]]
+    tokens, offsets = flat(rows)
+    mask = rows_of(prompt_loss_mask(tokens, offsets, 9), offsets)
+    # from the last marker on, the whole example without one
+    assert mask == [[False, False, False, True, True], [True, True], [], [True], [False, True, True]]
+
+
+def test_eval_task_loss_mask():
+    rows = [[5, 0, 7, 0, 3], [4, 4], [0], [2, 3, 0]]
+    tokens, offsets = flat(rows)
+    mask = rows_of(eval_task_loss_mask(tokens, offsets, 0), offsets)
+    # after the first pad, nothing masked without one
+    assert mask == [[False, False, True, True, True], [True, True], [False], [False, False, False]]
+
+
+def test_conversation_loss_mask():
+    user, assistant = 1, 2
+    rows = [[8, user, 5, assistant, 6, user, 7, assistant, 9], [assistant, 3], [user, 4]]
+    tokens, offsets = flat(rows)
+    mask = rows_of(conversation_loss_mask(tokens, offsets, ("plain", user, assistant)), offsets)
+    assert mask == [[False, False, False, True, True, False, False, True, True], [True, True], [False, False]]
+
+
+def test_conversation_loss_mask_chatml():
+    start, assistant_role = 1, 2
+    rows = [[start, 3, 5, start, assistant_role, 6, 7], [4, start], [start, assistant_role]]
+    tokens, offsets = flat(rows)
+    mask = rows_of(conversation_loss_mask(tokens, offsets, ("chatml", start, assistant_role)), offsets)
+    # a start token at the end of an example does not look into the next one
+    assert mask == [[False] * 3 + [True] * 4, [False, False], [True, True]]
+
+
+def test_supervised_token_counts_skip_first_token(tokenized):
+    expected = [int(np.sum(np.array(labels[1:]) != -100)) for labels in tokenized["labels"]]
+    assert supervised_token_counts(tokenized, batch_size=4).tolist() == expected
@@ -0,0 +1,156 @@
+import sys
+
+import numpy as np
+import pytest
+import torch
+from datasets import Dataset
+
+from packing import (
+    first_fit_decreasing, PackedDataset, PackedDataCollator, enable_packed_attention, packed_causal_mask,
+    takes_position_ids, example_lengths,
+)
+from indexed_dataset import supervised_token_counts, prompt_loss_mask
+
+
+def reference_first_fit_decreasing(lengths, max_length):
+    # the same packing with a linear scan over the open rows
+    packs, free = [], []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        row = next((k for k, f in enumerate(free) if f >= lengths[i]), len(packs))
+        if row == len(packs):
+            packs.append([])
+            free.append(max_length)
+        packs[row].append(i)
+        free[row] -= lengths[i]
+    return packs
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("n", [1, 2, 7, 64, 300])
+def test_first_fit_decreasing_matches_reference(seed, n):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 100, n)
+    packs = first_fit_decreasing(lengths, 100)
+    assert packs == reference_first_fit_decreasing(lengths.tolist(), 100)
+    assert sorted(i for pack in packs for i in pack) == list(range(n))
+    assert all(lengths[pack].sum() <= 100 for pack in packs)
+
+
+def test_first_fit_decreasing_edge_cases():
+    assert first_fit_decreasing([], 10) == []
+    assert first_fit_decreasing([10, 10, 10], 10) == [[0], [1], [2]]
+    # ties keep their order
+    assert first_fit_decreasing([3, 5, 3, 3], 8) == [[1, 0], [2, 3]]
+    with pytest.raises(ValueError):
+        first_fit_decreasing([3, 11], 10)
+
+
+def documents(n=9, seed=0, vocab_size=100):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(n):
+        input_ids = rng.integers(5, vocab_size, rng.integers(2, 12)).tolist()
+        # a prompt of a few tokens, then the response marker 4
+        input_ids[min(2, len(input_ids) - 1)] = 4
+        rows.append(input_ids)
+    return Dataset.from_dict({"input_ids": rows})
+
+
+def loss_mask(tokens, offsets):
+    return prompt_loss_mask(tokens, offsets, 4)
+
+
+def test_packed_dataset_rows():
+    data = documents()
+    packed = PackedDataset(data, 24, loss_mask)
+    assert len(packed) == len(first_fit_decreasing(example_lengths(data), 24))
+    seen = []
+    for i in range(len(packed)):
+        row = packed[i]
+        assert len(row["input_ids"]) == packed.lengths()[i] <= 24
+        documents_in_row = row["attention_mask"]
+        for d, j in enumerate(packed.packs[i]):
+            ids = np.asarray(data[j]["input_ids"])
+            tokens = documents_in_row == d + 1
+            assert row["input_ids"][tokens].tolist() == ids.tolist()
+            assert row["position_ids"][tokens].tolist() == list(range(len(ids)))
+            labels = np.where(loss_mask(ids, np.array([0, len(ids)])), ids, -100)
+            labels[0] = -100
+            assert row["labels"][tokens].tolist() == labels.tolist()
+            seen.append(j)
+        # the row's supervised tokens are its documents'
+        assert packed.supervised_counts()[i] == (row["labels"] != -100).sum()
+    assert sorted(seen) == list(range(len(data)))
+    assert packed.supervised_counts().sum() == supervised_token_counts(data, loss_mask).sum()
+
+
+def test_packed_dataset_from_labels():
+    data = documents()
+    labelled = data.map(lambda row: {"labels": np.where(loss_mask(np.array(row["input_ids"]),
+                                                                  np.array([0, len(row["input_ids"])])),
+                                                        row["input_ids"], -100).tolist()})
+    packed, expected = PackedDataset(labelled, 24), PackedDataset(data, 24, loss_mask)
+    for i in range(len(packed)):
+        assert packed[i]["labels"].tolist() == expected[i]["labels"].tolist()
+
+
+def test_packed_causal_mask():
+    documents_in_row = torch.tensor([[1, 1, 2, 2, 2, 0]])
+    allowed = packed_causal_mask(documents_in_row, torch.float32) == 0
+    expected = torch.tensor([[1, 0, 0, 0, 0, 0],
+                             [1, 1, 0, 0, 0, 0],
+                             [0, 0, 1, 0, 0, 0],
+                             [0, 0, 1, 1, 0, 0],
+                             [0, 0, 1, 1, 1, 0],
+                             [0, 0, 0, 0, 0, 1]], dtype=torch.bool)
+    assert torch.equal(allowed[0, 0], expected)
+    # a sliding window of 2 also hides the first token of a document from its third one
+    windowed = packed_causal_mask(documents_in_row, torch.float32, sliding_window=2) == 0
+    assert torch.equal(windowed[0, 0], expected & ~torch.tensor([[i - j >= 2 for j in range(6)] for i in range(6)]))
+
+
+def restore_mask_functions(monkeypatch, model):
+    # enable_packed_attention patches the modeling module, undone after the test
+    module = sys.modules[type(model).__module__]
+    for name in ["_prepare_4d_causal_attention_mask", "_prepare_4d_causal_attention_mask_for_sdpa", "build_alibi_tensor"]:
+        if hasattr(module, name):
+            monkeypatch.setattr(module, name, getattr(module, name))
+
+
+def assert_packed_logits_match(model, tokenizer, monkeypatch):
+    model.eval()
+    restore_mask_functions(monkeypatch, model)
+    enable_packed_attention(model)
+    data = documents(n=7, seed=1, vocab_size=len(tokenizer))
+    packed = PackedDataset(data, 30, loss_mask)
+    batch = PackedDataCollator(tokenizer, position_ids=takes_position_ids(model))([packed[i] for i in range(len(packed))])
+    assert len(packed) > 1 and (batch["attention_mask"] == 0).any()
+    with torch.no_grad():
+        logits = model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"],
+                       **({"position_ids": batch["position_ids"]} if "position_ids" in batch else {})).logits
+        for i in range(len(packed)):
+            for d, j in enumerate(packed.packs[i]):
+                ids = torch.tensor([data[j]["input_ids"]])
+                expected = model(input_ids=ids).logits[0]
+                torch.testing.assert_close(logits[i][batch["attention_mask"][i] == d + 1], expected,
+                                           atol=1e-5, rtol=1e-4)
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+def test_packed_logits_equal_document_logits(tiny_llama, tokenizer, monkeypatch, attn_implementation):
+    tiny_llama.config._attn_implementation = attn_implementation
+    assert_packed_logits_match(tiny_llama, tokenizer, monkeypatch)
+
+
+def test_packed_logits_equal_document_logits_alibi(tokenizer, monkeypatch):
+    from transformers import BloomConfig, BloomForCausalLM
+    torch.manual_seed(0)
+    model = BloomForCausalLM(BloomConfig(vocab_size=len(tokenizer), hidden_size=32, n_layer=2, n_head=4))
+    assert not takes_position_ids(model)
+    assert_packed_logits_match(model, tokenizer, monkeypatch)
+
+
+def test_flash_attention_is_refused(tiny_llama):
+    tiny_llama.config._attn_implementation = "flash_attention_2"
+    with pytest.raises(ValueError):
+        enable_packed_attention(tiny_llama)
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from samplers import (
+    bucketed_batches, padding_ratio, LengthBucketedSampler, token_budget_batches, split_to_multiple,
+    TokenBudgetBatchSampler,
+)
+
+
+def random_lengths(n, seed=0):
+    return np.random.default_rng(seed).integers(1, 500, n)
+
+
+@pytest.mark.parametrize("n, batch_size, bucket_batches", [(100, 4, 5), (101, 4, 5), (7, 8, 64), (64, 1, 3)])
+def test_bucketed_batches_cover_every_example(n, batch_size, bucket_batches):
+    lengths = random_lengths(n)
+    batches = bucketed_batches(lengths, batch_size, bucket_batches, np.random.default_rng(1))
+    assert sorted(np.concatenate(batches).tolist()) == list(range(n))
+    # only the last batch is short
+    assert all(len(batch) == batch_size for batch in batches[:-1])
+    assert len(batches[-1]) == (n % batch_size or batch_size)
+
+
+def test_batches_come_from_one_bucket_sorted_by_length():
+    lengths = random_lengths(200)
+    rng = np.random.default_rng(3)
+    order = np.random.default_rng(3).permutation(200)
+    buckets = [set(order[i:i + 40].tolist()) for i in range(0, 200, 40)]
+    for batch in bucketed_batches(lengths, 4, 10, rng):
+        assert any(set(batch.tolist()) <= bucket for bucket in buckets)
+        assert (np.diff(lengths[batch]) >= 0).all()
+
+
+def test_bucketing_cuts_padding():
+    lengths = random_lengths(1000)
+    rng = np.random.default_rng(0)
+    order = rng.permutation(1000)
+    random_batches = [order[i:i + 8] for i in range(0, 1000, 8)]
+    bucketed = bucketed_batches(lengths, 8, 64, rng)
+    assert padding_ratio(lengths, bucketed) < padding_ratio(lengths, random_batches) / 4
+
+
+def test_sampler_epochs():
+    lengths = random_lengths(50)
+    sampler = LengthBucketedSampler(lengths, 4, bucket_batches=3, seed=5)
+    first, second = list(sampler), list(sampler)
+    assert len(first) == len(sampler) == 50
+    assert sorted(first) == sorted(second) == list(range(50))
+    assert first != second
+    # the order of an epoch only depends on the seed and the epoch
+    sampler.set_epoch(1)
+    assert list(sampler) == second
+    assert list(LengthBucketedSampler(lengths, 4, bucket_batches=3, seed=5)) == first
+
+
+@pytest.mark.parametrize("max_tokens", [500, 1000, 4096])
+def test_token_budget_batches_fit_the_budget(max_tokens):
+    lengths = random_lengths(300)
+    batches = token_budget_batches(lengths, max_tokens, np.random.default_rng(0))
+    assert sorted(np.concatenate(batches).tolist()) == list(range(300))
+    assert all(len(batch) * lengths[batch].max() <= max_tokens for batch in batches)
+    # a batch is only cut when the next example would not fit
+    cut = [len(a) + 1 for a, b in zip(batches, batches[1:])]
+    assert all(n * lengths[b[0]] > max_tokens for n, b in zip(cut, batches[1:]))
+
+
+def test_longer_examples_than_the_budget_get_a_batch_each():
+    lengths = np.array([10, 300, 20, 400])
+    batches = token_budget_batches(lengths, 100, np.random.default_rng(0))
+    assert [b.tolist() for b in batches] == [[0, 2], [1], [3]]
+
+
+@pytest.mark.parametrize("multiple", [1, 3, 8])
+def test_split_to_multiple(multiple):
+    lengths = random_lengths(50)
+    batches = split_to_multiple(token_budget_batches(lengths, 2000, np.random.default_rng(0)), multiple)
+    assert len(batches) % multiple == 0
+    assert sorted(np.concatenate(batches).tolist()) == list(range(50))
+
+
+def batch_rows(batches):
+    return sorted(sorted(i for i, _ in batch) for batch in batches)
+
+
+def test_window_tokens():
+    lengths = random_lengths(60)
+    supervised = np.random.default_rng(1).integers(0, 50, 60)
+    sampler = TokenBudgetBatchSampler(lengths, 1500, window_batches=3, supervised=supervised, seed=2)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) and len(batches) % 3 == 0
+    for start in range(0, len(batches), 3):
+        window = batches[start:start + 3]
+        tokens = sum(supervised[i] for batch in window for i, _ in batch)
+        # every row of the window carries the window's supervised tokens
+        assert {t for batch in window for _, t in batch} == {tokens}
+    # the same batches every epoch, in another order
+    assert batch_rows(batches) == batch_rows(list(sampler))
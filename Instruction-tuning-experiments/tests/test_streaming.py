@@ -0,0 +1,130 @@
+from functools import partial
+from itertools import islice
+from types import SimpleNamespace
+
+import pytest
+import torch
+from datasets import Dataset
+
+from streaming import (
+    WindowedPermutation, StreamingDataset, StreamPositionCallback, load_stream_position, streaming_max_steps,
+)
+from conftest import load_script
+
+
+def stream_rows(order, position, n):
+    return list(islice(order.rows(position), n))
+
+
+@pytest.mark.parametrize("num_examples, window_size", [(1, 4), (10, 3), (10, 10), (37, 8), (5, 100)])
+def test_every_epoch_is_a_permutation(num_examples, window_size):
+    order = WindowedPermutation(num_examples, window_size, seed=1)
+    rows = stream_rows(order, 0, 3 * num_examples)
+    for epoch in range(3):
+        assert sorted(rows[epoch * num_examples:(epoch + 1) * num_examples]) == list(range(num_examples))
+
+
+def test_windows_are_read_whole():
+    order = WindowedPermutation(40, 8, seed=3)
+    rows = stream_rows(order, 0, 40)
+    # consecutive runs of window_size rows come from one window
+    assert all(len({row // 8 for row in rows[i:i + 8]}) == 1 for i in range(0, 40, 8))
+    # and the epochs are shuffled differently
+    assert rows != stream_rows(order, 40, 40)
+
+
+@pytest.mark.parametrize("position", [0, 1, 7, 8, 23, 36, 37, 50, 111])
+def test_stream_from_position(position):
+    order = WindowedPermutation(37, 8, seed=5)
+    assert stream_rows(order, position, 60) == stream_rows(order, 0, position + 60)[position:]
+
+
+def test_empty_stream():
+    assert stream_rows(WindowedPermutation(0, 8), 0, 5) == []
+
+
+def batches(dataset, batch_size, n, num_workers=0):
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                                         collate_fn=lambda rows: [row["i"] for row in rows])
+    return list(islice(loader, n))
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_workers_read_in_stream_order(num_workers):
+    data = Dataset.from_dict({"i": list(range(29))})
+    stream = StreamingDataset(data, buffer_size=6, seed=2, batch_size=3)
+    expected = stream_rows(stream.order, 0, 3 * 12)
+    assert sum(batches(stream, 3, 12, num_workers), []) == expected
+
+
+def save_position(tmp_path, callback, start_step, global_step, args):
+    state = SimpleNamespace(global_step=start_step, is_world_process_zero=True)
+    callback.on_train_begin(args, state, None)
+    state.global_step = global_step
+    checkpoint = tmp_path / f"checkpoint-{global_step}"
+    checkpoint.mkdir()
+    callback.on_save(args, state, None)
+    return str(checkpoint)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_resumed_stream_gives_the_same_batches(tmp_path, num_workers):
+    data = Dataset.from_dict({"i": list(range(50))})
+    # two ranks of two rows, two micro-batches per step
+    args = SimpleNamespace(per_device_train_batch_size=2, gradient_accumulation_steps=2, world_size=2,
+                           output_dir=str(tmp_path))
+    rows_per_step = 8
+    stream = StreamingDataset(data, buffer_size=16, seed=7, batch_size=4)
+    full = batches(stream, 4, 30, num_workers)
+
+    # a checkpoint after 4 steps, then one after 3 more steps of the resumed run
+    checkpoint = save_position(tmp_path, StreamPositionCallback(stream), 0, 4, args)
+    resumed = StreamingDataset(data, buffer_size=16, seed=7, start_position=load_stream_position(checkpoint), batch_size=4)
+    assert resumed.start_position == 4 * rows_per_step
+    assert batches(resumed, 4, 22, num_workers) == full[8:]
+
+    checkpoint = save_position(tmp_path, StreamPositionCallback(resumed), 4, 7, args)
+    resumed = StreamingDataset(data, buffer_size=16, seed=7, start_position=load_stream_position(checkpoint), batch_size=4)
+    assert batches(resumed, 4, 16, num_workers) == full[14:]
+
+
+def test_no_stream_state():
+    assert load_stream_position(None) == 0
+
+
+def test_streaming_max_steps():
+    args = SimpleNamespace(per_device_train_batch_size=2, gradient_accumulation_steps=3, world_size=4)
+    assert streaming_max_steps(100, 2, args) == 9
+    assert streaming_max_steps(96, 1, args) == 4
+
+
+def test_streaming_sft_collator_drops_long_rows(tokenizer):
+    hf = load_script("huggingface-finetune.py")
+    args = SimpleNamespace(training_data="dolly", conversations=False, preprocessing_num_workers=None)
+    loss_mask = hf.sft_loss_mask(tokenizer, args)
+    rows = [{"prompt": "<|user|>" + " the" * n, "context": "", "response": "<|assistant|> fox"} for n in (2, 30, 5, 40)]
+    expected = hf.tokenize_sft(Dataset.from_list(rows), tokenizer, args, loss_mask)
+    lengths = expected["length"]
+    collator = hf.StreamingSFTCollator(hf.LabelPaddingCollator(tokenizer), tokenizer, args, loss_mask, max_length=20)
+    assert lengths[0] <= 20 < lengths[1] and lengths[2] <= 20 < lengths[3]
+
+    batch = collator(rows)
+    assert batch["input_ids"].shape == (2, lengths[2])
+    assert batch["input_ids"][1].tolist() == expected[2]["input_ids"]
+    assert batch["labels"][0, :lengths[0]].tolist() == expected[0]["labels"]
+    assert (collator.rows, collator.dropped) == (4, 2)
+
+    # a micro-batch of only too long rows keeps its shortest one, truncated
+    batch = collator([rows[3], rows[1]])
+    assert batch["input_ids"].tolist() == [expected[1]["input_ids"][:20]]
+    assert (collator.rows, collator.dropped) == (6, 3)
+
+
+def test_streamed_dpo_rows_are_formatted():
+    dpo = load_script("train_dpo.py")
+    data = Dataset.from_dict({"prompt": ["q1", "q2", "q3"], "context": ["", "c2", None],
+                              "accepted_response": ["a1", "a2", "a3"], "rejected_response": ["r1", "r2", "r3"]})
+    stream = StreamingDataset(data.with_transform(partial(dpo.format_dpo_rows, schema=data.features.arrow_schema)),
+                              buffer_size=2, seed=0)
+    formatted = dpo.format_dpo(data)
+    assert sorted(islice(stream, 3), key=lambda row: row["chosen"]) == list(formatted)
@@ -0,0 +1,36 @@
+import pytest
+from trl.trainer.utils import DPODataCollatorWithPadding
+
+from conftest import load_script
+
+dpo = load_script("train_dpo.py")
+
+
+def pairs():
+    words = "the quick brown fox jumps over the lazy dog".split()
+    batch = {"prompt": [], "chosen": [], "rejected": []}
+    for n_prompt in (1, 5, 30):
+        for n_chosen, n_rejected in ((1, 2), (12, 3), (4, 25)):
+            batch["prompt"].append("<|user|>" + " ".join(words * 4)[:6 * n_prompt] + "\n<|assistant|>")
+            batch["chosen"].append(" ".join((words * 4)[:n_chosen]))
+            batch["rejected"].append(" ".join((words * 4)[:n_rejected]))
+    return batch
+
+
+@pytest.mark.parametrize("max_length, prompt_max_length", [(2048, 256), (24, 8), (16, 4), (12, 10)])
+def test_dpo_lengths_follow_the_collator_truncation(tokenizer, max_length, prompt_max_length):
+    batch = pairs()
+    collator = DPODataCollatorWithPadding(tokenizer, max_length=max_length, max_prompt_length=prompt_max_length,
+                                          padding_value=tokenizer.pad_token_id)
+    expected = []
+    for prompt, chosen, rejected in zip(batch["prompt"], batch["chosen"], batch["rejected"]):
+        element = collator.tokenize_batch_element(prompt, chosen, rejected)
+        # chosen and rejected are padded to the longer one and go through the model together
+        expected.append(2 * max(len(element["chosen_input_ids"]), len(element["rejected_input_ids"])))
+    lengths = dpo.dpo_lengths(batch, tokenizer, max_length=max_length, prompt_max_length=prompt_max_length)['length']
+    assert lengths.tolist() == expected
+    assert max(expected) <= 2 * max_length
+
+
+def test_length_bucketing_is_off_by_default():
+    assert dpo.argparser().parse_args([]).length_bucketing is False
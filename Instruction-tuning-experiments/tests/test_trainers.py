@@ -0,0 +1,151 @@
+import gc
+import weakref
+from itertools import islice
+from types import SimpleNamespace
+
+import pytest
+import torch
+from datasets import Dataset
+from transformers import TrainingArguments
+
+from collators import LabelPaddingCollator
+from indexed_dataset import supervised_token_counts
+from packing import example_lengths
+from samplers import TokenBudgetBatchSampler
+from trainers import BucketedTrainer
+from conftest import load_script
+
+
+def training_args(tmp_path, **kwargs):
+    return TrainingArguments(output_dir=str(tmp_path), report_to=[], seed=0, use_cpu=True,
+                             per_device_train_batch_size=1, **kwargs)
+
+
+def sft_dataset(tokenizer, n=24):
+    hf = load_script("huggingface-finetune.py")
+    args = SimpleNamespace(training_data="dolly", conversations=False, preprocessing_num_workers=None)
+    words = "the quick brown fox jumps over the lazy dog".split()
+    rows = [{"prompt": "<|user|>" + " ".join(words[:1 + i % 5]), "context": "",
+             "response": "<|assistant|>" + " ".join((words * 3)[:1 + (7 * i) % 17])} for i in range(n)]
+    return hf.tokenize_sft(Dataset.from_list(rows), tokenizer, args, hf.sft_loss_mask(tokenizer, args))
+
+
+def first_window(trainer):
+    # the indices of the first accumulation window, as the train dataloader's sampler deals them
+    args = trainer.args
+    sampler = TokenBudgetBatchSampler(trainer.length_fn(trainer.train_dataset), trainer.max_tokens,
+                                      window_batches=args.gradient_accumulation_steps * args.world_size,
+                                      supervised=trainer.supervised_fn(trainer.train_dataset), seed=args.seed)
+    return [[i for i, _ in batch] for batch in islice(iter(sampler), args.gradient_accumulation_steps)]
+
+
+def gradients(model):
+    grads = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+    model.zero_grad()
+    return grads
+
+
+def accumulated_gradients(trainer):
+    model = trainer.model
+    model.zero_grad()
+    for batch in islice(trainer.get_train_dataloader(), trainer.args.gradient_accumulation_steps):
+        trainer.training_step(model, batch)
+    return gradients(model)
+
+
+def assert_same_gradients(grads, expected):
+    assert len(grads) == len(expected) > 0
+    for grad, reference in zip(grads, expected):
+        torch.testing.assert_close(grad, reference, atol=1e-6, rtol=1e-4)
+
+
+def test_token_budget_loss_is_the_window_token_mean(tmp_path, tokenizer, tiny_llama):
+    dataset = sft_dataset(tokenizer)
+    collator = LabelPaddingCollator(tokenizer)
+    trainer = BucketedTrainer(model=tiny_llama, args=training_args(tmp_path, gradient_accumulation_steps=3),
+                              train_dataset=dataset, data_collator=collator, tokenizer=tokenizer,
+                              length_fn=example_lengths, max_tokens=48, supervised_fn=supervised_token_counts)
+    grads = accumulated_gradients(trainer)
+
+    window = first_window(trainer)
+    counts = supervised_token_counts(dataset)
+    # batches of different sizes, a mean of the batch means would weigh their tokens differently
+    assert len({int(counts[batch].sum()) for batch in window}) > 1
+    rows = [{k: dataset[i][k] for k in ("input_ids", "labels")} for batch in window for i in batch]
+    tiny_llama(**collator(rows)).loss.backward()
+    assert_same_gradients(grads, gradients(tiny_llama))
+
+
+def test_completion_only_counts(tokenizer):
+    from trl import DataCollatorForCompletionOnlyLM
+    sft = load_script("train_sft.py")
+    collator = DataCollatorForCompletionOnlyLM(instruction_template="<|user|>", response_template="<|assistant|>",
+                                               tokenizer=tokenizer, mlm=False)
+    texts = ["<|user|> the fox\n<|assistant|> jumps over</s>",
+             "<|user|> one\n<|assistant|> two<|user|> three four\n<|assistant|> five six seven</s>",
+             "<|user|> no answer here</s>",
+             "<|user|> the quick brown fox jumps over the lazy dog\n<|assistant|> ok</s>"]
+    dataset = Dataset.from_dict({"input_ids": tokenizer(texts)["input_ids"]})
+    expected = [int((collator([row])["labels"][0, 1:] != -100).sum()) for row in dataset]
+    with pytest.warns(UserWarning):
+        counts = sft.completion_only_counts(dataset, collator, batch_size=3)
+    assert counts.tolist() == expected
+    assert expected[2] == 0 and expected[1] > expected[0] > 0
+
+
+def test_dpo_token_budget_loss_is_the_window_pair_mean(tmp_path, tokenizer, tiny_llama):
+    dpo = load_script("train_dpo.py")
+    words = "the quick brown fox jumps over the lazy dog".split()
+    pairs = Dataset.from_dict({"prompt": ["<|user|>" + " ".join(words[:1 + i % 4]) + "\n<|assistant|>" for i in range(12)],
+                               "chosen": [" ".join((words * 2)[:1 + (5 * i) % 11]) for i in range(12)],
+                               "rejected": [" ".join((words * 2)[:1 + (3 * i) % 7]) for i in range(12)]})
+    pairs = dpo.add_dpo_lengths(pairs, tokenizer)
+    trainer = dpo.BucketedDPOTrainer(model=tiny_llama, ref_model=None,
+                                     args=training_args(tmp_path, gradient_accumulation_steps=2,
+                                                        remove_unused_columns=False),
+                                     beta=0.1, train_dataset=pairs, tokenizer=tokenizer, max_length=64,
+                                     max_prompt_length=16, max_target_length=16,
+                                     padding_value=tokenizer.pad_token_id,
+                                     length_fn=example_lengths, max_tokens=100, supervised_fn=dpo.pair_counts)
+    grads = accumulated_gradients(trainer)
+
+    window = first_window(trainer)
+    assert len({len(batch) for batch in window}) > 1
+    batch = trainer.data_collator([pairs[i] for batch in window for i in batch])
+    loss, _ = trainer.get_batch_metrics(tiny_llama, batch)
+    loss.backward()
+    assert_same_gradients(grads, gradients(tiny_llama))
+
+
+def test_eval_samplers_per_dataset(tmp_path, tokenizer, tiny_llama):
+    dataset = sft_dataset(tokenizer)
+    trainer = BucketedTrainer(model=tiny_llama, args=training_args(tmp_path, per_device_eval_batch_size=4),
+                              eval_dataset=dataset, data_collator=LabelPaddingCollator(tokenizer),
+                              tokenizer=tokenizer, eval_length_fn=example_lengths)
+    trainer.get_eval_dataloader()
+    sampler = trainer.eval_sampler
+    trainer.get_eval_dataloader()
+    assert trainer.eval_sampler is sampler
+    # datasets made and dropped one after another, each gets a sampler of its own
+    for n in range(3, 9):
+        subset = dataset.select(range(n))
+        trainer.get_eval_dataloader(subset)
+        assert len(trainer.eval_sampler) == n
+        # a cached sampler keeps its dataset alive, no other dataset can get its id
+        subset = weakref.ref(subset)
+        gc.collect()
+        assert subset() is not None
+    trainer.get_eval_dataloader()
+    assert trainer.eval_sampler is sampler
+
+
+def test_source_id_only_kept_for_evaluation(tmp_path, tokenizer, tiny_llama):
+    dataset = sft_dataset(tokenizer).add_column("source_id", [i % 2 for i in range(24)])
+    trainer = BucketedTrainer(model=tiny_llama, args=training_args(tmp_path, per_device_eval_batch_size=4),
+                              train_dataset=dataset, eval_dataset=dataset, data_collator=LabelPaddingCollator(tokenizer),
+                              tokenizer=tokenizer, eval_sources=["a", "b"])
+    assert "source_id" not in next(iter(trainer.get_train_dataloader()))
+    assert "source_id" in next(iter(trainer.get_eval_dataloader()))
+    assert "source_id" not in trainer._signature_columns
+    metrics = trainer.evaluate()
+    assert {"eval_loss_a", "eval_loss_b", "eval_token_loss"} <= set(metrics)
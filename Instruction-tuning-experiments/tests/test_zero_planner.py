@@ -0,0 +1,133 @@
+import json
+
+import pytest
+import torch
+from transformers import AutoModelForCausalLM, BloomConfig, LlamaConfig
+
+import zero_planner
+from zero_planner import GB, ModelShape, argparser, configure, plan, zero_settings
+
+
+def llama_config(layers=2):
+    return LlamaConfig(vocab_size=1000, hidden_size=128, intermediate_size=344, num_hidden_layers=layers,
+                       num_attention_heads=4, num_key_value_heads=4)
+
+
+def bloom_config(layers=2):
+    return BloomConfig(vocab_size=1000, hidden_size=128, n_layer=layers, n_head=4)
+
+
+def planner_args(*argv):
+    return argparser().parse_args(["--model", "tiny", *argv])
+
+
+def saved_bytes(model, input_ids):
+    # what autograd keeps for the backward pass, the parameters aside
+    params = {p.data_ptr() for p in model.parameters()}
+    saved = {}
+
+    def pack(tensor):
+        if tensor.data_ptr() not in params:
+            saved.setdefault(tensor.data_ptr(), tensor.numel() * tensor.element_size())
+        return tensor
+
+    model.train()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        model(input_ids=input_ids)
+    return sum(saved.values())
+
+
+@pytest.mark.parametrize("make_config", [llama_config, bloom_config])
+def test_parameter_counts(make_config):
+    from peft import LoraConfig, get_peft_model
+    config = make_config()
+    model = AutoModelForCausalLM.from_config(config)
+    shape = ModelShape(config)
+    assert shape.params == shape.trainable == sum(p.numel() for p in model.parameters())
+
+    lora = ModelShape(config, lora_r=8)
+    peft_model = get_peft_model(model, LoraConfig(r=8, task_type="CAUSAL_LM"))
+    assert lora.trainable == sum(p.numel() for p in peft_model.parameters() if p.requires_grad)
+    assert lora.params == shape.params
+
+
+@pytest.mark.parametrize("make_config", [llama_config, bloom_config])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_layer_activations_match_the_saved_tensors(make_config, dtype):
+    batch, seq_length = 2, 128
+    input_ids = torch.randint(0, 1000, (batch, seq_length), generator=torch.Generator().manual_seed(0))
+    one, two = (saved_bytes(AutoModelForCausalLM.from_config(make_config(layers)).to(dtype), input_ids)
+                for layers in (1, 2))
+    measured = (two - one) / (batch * seq_length)
+    act = torch.tensor([], dtype=dtype).element_size()
+    assert ModelShape(make_config()).layer_activations(seq_length, act) == pytest.approx(measured, rel=0.03)
+
+
+def test_gradient_checkpointing_keeps_one_vector_per_layer():
+    shape = ModelShape(llama_config(layers=8))
+    full = shape.activations(2, 512, 2, checkpointing=False)
+    checkpointed = shape.activations(2, 512, 2, checkpointing=True)
+    layer = shape.layer_activations(512, 2)
+    assert full - checkpointed == 2 * 512 * (8 * layer - (8 * 2 * shape.hidden + layer))
+
+
+def test_configure_copies_and_overrides():
+    base = {"bf16": {"enabled": "auto"}, "zero_optimization": {"stage": 3, "reduce_bucket_size": "auto"}}
+    config = configure(base, zero_stage=2, offload_optimizer="cpu", reduce_bucket_size=1e6)
+    assert base["zero_optimization"] == {"stage": 3, "reduce_bucket_size": "auto"}
+    assert config["zero_optimization"] == {"stage": 2, "reduce_bucket_size": 1e6,
+                                           "offload_optimizer": {"device": "cpu", "pin_memory": True}}
+
+
+def test_zero_settings():
+    zero = zero_settings({"bf16": {"enabled": "auto"},
+                          "zero_optimization": {"stage": 2, "reduce_bucket_size": "auto",
+                                                "offload_param": {"device": "cpu"}}}, hidden=128)
+    # "auto" as the Trainer fills it in, parameters are only offloaded under stage 3
+    assert zero["reduce_bucket_size"] == 128 * 128
+    assert zero["half"] and not zero["offload_param"] and not zero["overlap_comm"]
+    assert not zero_settings({"fp16": {"enabled": False}}, hidden=128)["half"]
+
+
+def test_model_states_are_partitioned_by_stage():
+    shape = ModelShape(llama_config())
+    P, n = shape.params, 4
+    args = planner_args("--world_size", str(n), "--gpus_per_node", str(n))
+    base = {"bf16": {"enabled": True}, "zero_optimization": {"overlap_comm": False}}
+    device = {stage: plan(shape, configure(base, stage), args)[1] for stage in range(4)}
+    # bf16 parameters and gradients, fp32 master weights and two AdamW states
+    assert device[0]["params"] == device[2]["params"] == 2 * P
+    assert device[0]["grads"] == device[1]["grads"] == 2 * P
+    assert device[0]["optimizer"] == 12 * P
+    assert device[1]["optimizer"] == device[3]["optimizer"] == 12 * P / n
+    assert device[2]["grads"] == device[3]["grads"] == 2 * P / n
+    assert device[3]["params"] == 2 * min(P, shape.largest_unit + 5e7) + 2 * P / n
+
+    _, offloaded, host = plan(shape, configure(base, 3, "cpu", "cpu"), args)
+    assert offloaded["optimizer"] == offloaded["grads"] == 0
+    assert offloaded["params"] == device[3]["params"] - 2 * P / n
+    assert host == n * (max((12 + 4) * P / n + 2 * P / n, 2 * P) + args.host_overhead_gb * GB)
+
+
+def test_lora_only_keeps_states_of_the_adapters():
+    config = llama_config()
+    args = planner_args("--world_size", "1")
+    full = plan(ModelShape(config), configure({}, 0), args)[1]
+    lora_shape = ModelShape(config, lora_r=8)
+    lora = plan(lora_shape, configure({}, 0), args)[1]
+    assert lora["params"] == full["params"]
+    assert lora["optimizer"] == 8 * lora_shape.trainable < full["optimizer"]
+
+
+def test_recommends_the_least_offloading_that_fits(tmp_path, monkeypatch):
+    monkeypatch.setattr(zero_planner.AutoConfig, "from_pretrained", lambda *args, **kwargs: llama_config())
+    base = tmp_path / "base.json"
+    base.write_text(json.dumps({"bf16": {"enabled": True}, "zero_optimization": {"stage": 3}}))
+    output = tmp_path / "recommended.json"
+    argv = ["zero_planner.py", "--model", "tiny", "--ds_config", "--base_config", str(base),
+            "--device_overhead_gb", "0", "--host_overhead_gb", "0", "--output", str(output)]
+    assert zero_planner.main(argv) is None
+    assert json.loads(output.read_text())["zero_optimization"]["stage"] == 2
+
+    # without room for the activations nothing fits
+    assert zero_planner.main(argv[:-2] + ["--device_memory_gb", "0.001"]) == 1
@@ -0,0 +1,117 @@
+import os
+import json
+import shutil
+import hashlib
+
+from utils import preprocess_on_main_process, is_preprocessing_process
+
+# Persistent cache of preprocessed (read, formatted, tokenized) DatasetDicts, meant to live on
+# scratch and be shared by resubmitted jobs. An entry is keyed by a fingerprint of everything the
+# result depends on: the contents of the source files, the tokenizer (vocabulary, merges, special
+# tokens) and the formatting settings, model_max_length included. Once the cache grows over its
+# size limit the least recently used entries are deleted.
+
+# bump when a change to the preprocessing code changes its output
+cache_version = 3
+digests_file = "file_digests.json"
+
+
+def file_digest(path, chunk_size=1 << 24):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_digests(paths, cache_dir):
+    # content digests, memoized by size and mtime so unchanged files are hashed only once
+    memo_path = os.path.join(cache_dir, digests_file)
+    memo = {}
+    if os.path.exists(memo_path):
+        with open(memo_path) as f:
+            memo = json.load(f)
+    changed = False
+    digests = []
+    for path in paths:
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        entry = memo.get(path)
+        if entry is None or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+            print("Hashing", path)
+            entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "digest": file_digest(path)}
+            memo[path] = entry
+            changed = True
+        digests.append(entry["digest"])
+    if changed:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{memo_path}.tmp{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(memo, f)
+        os.replace(tmp_path, memo_path)
+    return digests
+
+
+def tokenizer_fingerprint(tokenizer):
+    h = hashlib.blake2b(digest_size=16)
+    if tokenizer.is_fast:
+        # vocabulary, merges, added tokens, normalizer and post-processor
+        h.update(tokenizer.backend_tokenizer.to_str().encode())
+    else:
+        h.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    h.update(json.dumps({
+        "class": type(tokenizer).__name__,
+        "special_tokens": tokenizer.special_tokens_map_extended,
+        "padding_side": tokenizer.padding_side,
+        "truncation_side": tokenizer.truncation_side,
+        "model_max_length": tokenizer.model_max_length,
+    }, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def cache_key(digests, tokenizer, settings):
+    key = {
+        "version": cache_version,
+        "files": digests,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "settings": settings,
+    }
+    return hashlib.blake2b(json.dumps(key, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path)
+               for name in names)
+
+
+def evict(cache_dir, max_bytes, keep):
+    # least recently used first, entries are touched whenever they are loaded
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+               if ".tmp" not in name and os.path.isdir(os.path.join(cache_dir, name))]
+    entries.sort(key=os.path.getmtime)
+    sizes = {entry: dir_size(entry) for entry in entries}
+    total = sum(sizes.values())
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if os.path.abspath(entry) == os.path.abspath(keep):
+            continue
+        print(f"Evicting {entry} ({sizes[entry]/2**30:.1f} GB) from the tokenized cache")
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= sizes[entry]
+
+
+def load_or_build(training_args, build_dataset, cache_dir, source_paths, tokenizer, settings,
+                  max_gb=None, per_node=False):
+    # the main process hashes the source files first, the other ranks then find the digests memoized
+    with training_args.main_process_first(local=per_node, desc="tokenized cache key"):
+        key = cache_key(file_digests(source_paths, cache_dir), tokenizer, settings)
+    path = os.path.join(cache_dir, key)
+    dataset = preprocess_on_main_process(training_args, build_dataset, preprocessed_dir=path,
+                                         per_node=per_node, reuse=True)
+    if is_preprocessing_process(training_args, per_node):
+        os.utime(path)
+        if max_gb is not None:
+            evict(cache_dir, int(max_gb * 2**30), keep=path)
+    return dataset
@@ -2,8 +2,10 @@ import sys
 import os
 import torch
 import numpy as np
+import pyarrow as pa
+from functools import partial
 from logging import warning
-from datasets import DatasetDict
+from datasets import DatasetDict, Value
 from argparse import ArgumentParser
 
 from transformers import (
@@ -17,10 +19,25 @@ from trl import (
 )
 
 # custom classes
-from utils import load_model, get_peft_config
+from utils import load_model, get_peft_config, preprocess_on_main_process, stratified_subsample
 from dpo_finetuning_datasets import read_data_dpo
+from instruction_finetuning_datasets import shuffle_modes
+from arrow_readers import dpo_table
+from packing import example_lengths
+from callbacks import ThroughputCallback
+from trainers import AsyncCheckpointMixin, FastEvalMixin, LengthBucketingMixin, PrefetchMixin, TokenBudgetMixin
+from streaming import (
+    StreamingDataset,
+    StreamPositionCallback,
+    prepare_streaming_args,
+    resolve_checkpoint,
+    load_stream_position
+)
 
 model_max_length = 2048
+# DPOTrainer truncation, max_target_length only applies to encoder-decoder models
+max_prompt_length = 256
+max_target_length = 256
 
 def argparser():
     ap = ArgumentParser()
@@ -41,27 +58,72 @@ def argparser():
     ap.add_argument('--max_examples', type=int, default=None)
     ap.add_argument('--transformers_cache',type=str, default="/scratch/project_462000319/transformers_cache")
     ap.add_argument('--dropout',type=float, default=0.1)
+    ap.add_argument('--data_backend', type=str, default="python", choices=["python", "arrow"])
+    ap.add_argument('--shuffle_mode', type=str, default="sampler", choices=shuffle_modes)
+    ap.add_argument('--preprocessed_dir', type=str, default=None)
+    ap.add_argument('--preprocessing_num_workers', type=int, default=None)
+    ap.add_argument('--streaming', default=False, type=lambda x: (str(x).lower() == 'true'))
+    ap.add_argument('--shuffle_buffer_size', type=int, default=10000)
+    ap.add_argument('--resume_from_checkpoint', type=str, default=None, help="checkpoint path, or true for the latest one")
+    ap.add_argument('--preprocess_per_node', default=False, type=lambda x: (str(x).lower() == 'true'))
+    ap.add_argument('--length_bucketing', default=False, type=lambda x: (str(x).lower() == 'true'), help="micro-batches of examples of similar length, changes the order of the training data")
+    ap.add_argument('--bucket_batches', type=int, default=64, help="micro-batches per length bucket")
+    ap.add_argument('--max_tokens_per_batch', type=int, default=None, help="token budget per micro-batch instead of per_device_batch_size pairs")
+    ap.add_argument('--per_device_eval_batch_size', type=int, default=4)
+    ap.add_argument('--eval_examples', type=int, default=None, help="evaluate on a fixed random subsample of the validation split")
+    ap.add_argument('--eval_time_budget', type=float, default=None, help="seconds per evaluation during training")
+    ap.add_argument('--throughput_log', default=False, type=lambda x: (str(x).lower() == 'true'), help="tokens/sec, padding and step time breakdown in TensorBoard")
+    ap.add_argument('--async_checkpointing', default=False, type=lambda x: (str(x).lower() == 'true'), help="write checkpoints in the background while training goes on (transformers 4.36, not with DeepSpeed ZeRO-3)")
+    ap.add_argument('--dataloader_num_workers', type=int, default=0, help="worker processes that collate the batches, 0 collates in the training process")
+    ap.add_argument('--dataloader_prefetch_factor', type=int, default=2, help="batches every worker keeps ready")
+    ap.add_argument('--dataloader_pin_memory', default=True, type=lambda x: (str(x).lower() == 'true'), help="batches in pinned memory for faster copies to the GPU")
     return ap
 
-def preprocess_dpo(data):  
-    prompts = data['prompt']
-    contexts = data['context']
-    accepted = data['accepted_response']
-    rejected = data['rejected_response']
-    dpo_dataset = {
-        "prompt": [],
-        "chosen": [],
-        "rejected": []
-    }
-    for prompt, context, accepted, rejected in zip(prompts, contexts, accepted, rejected):
-        if not context or context.isspace():
-            combined_prompt = prompt
-        else:
-            combined_prompt = context + "\n" + prompt
-        dpo_dataset["prompt"].append(combined_prompt)
-        dpo_dataset["chosen"].append(accepted)
-        dpo_dataset["rejected"].append(rejected)
-    return dpo_dataset
+class BucketedDPOTrainer(AsyncCheckpointMixin, FastEvalMixin, PrefetchMixin, TokenBudgetMixin, LengthBucketingMixin, DPOTrainer):
+    def supervised_tokens(self, inputs):
+        # the DPO loss is a mean over pairs, a token budget window is normalized by its pairs (pair_counts)
+        return len(inputs["chosen_input_ids"])
+
+def pair_counts(dataset):
+    return np.ones(len(dataset), dtype=np.int64)
+
+def preprocess_dpo(data):
+    # data is a pyarrow Table batch (dataset.with_format("arrow"))
+    return dpo_table(data)
+
+def format_dpo(dataset, num_proc=None):
+    features = dataset.features.copy()
+    features['prompt'] = Value('string')
+    features['chosen'] = Value('string')
+    features['rejected'] = Value('string')
+    return dataset.with_format("arrow").map(
+        preprocess_dpo,
+        batched=True,
+        features=features,
+        num_proc=num_proc,
+    ).with_format(None)
+
+def format_dpo_rows(batch, schema):
+    # format_dpo for the streamed train rows as they are read (Dataset.with_transform)
+    return dpo_table(pa.Table.from_pydict(batch, schema=schema)).to_pydict()
+
+def dpo_lengths(batch, tokenizer, max_length=model_max_length, prompt_max_length=max_prompt_length):
+    # pairs are tokenized in the collator, count the tokens here the way it truncates them
+    # (DPODataCollatorWithPadding.tokenize_batch_element): the responses end in eos, a pair longer than
+    # max_length keeps the last prompt_max_length prompt tokens and then, if still too long, the first
+    # max_length - prompt_max_length response tokens. chosen and rejected are padded to the longer of
+    # the two and both go through the model.
+    prompt, chosen, rejected = [np.array(tokenizer(batch[c], add_special_tokens=False, return_length=True)['length'])
+                                for c in ('prompt', 'chosen', 'rejected')]
+    response = np.maximum(chosen, rejected) + 1
+    prompt = np.where(prompt + response > max_length, np.minimum(prompt, prompt_max_length), prompt)
+    response = np.where(prompt + response > max_length, np.minimum(response, max_length - prompt_max_length), response)
+    return {'length': 2 * np.minimum(prompt + response, max_length)}
+
+def add_dpo_lengths(dataset, tokenizer, num_proc=None):
+    # a length column for the bucketing and the eval order (example_lengths), counted once by the
+    # preprocessing process
+    return dataset.map(dpo_lengths, batched=True, batch_size=10000, fn_kwargs={'tokenizer': tokenizer}, num_proc=num_proc)
 
 def train_dpo(args):
     # https://github.com/huggingface/trl/blob/main/examples/scripts/dpo.py
@@ -83,8 +145,15 @@ def train_dpo(args):
         save_strategy="steps",
         save_steps=100,
         save_total_limit=5,
-        per_device_train_batch_size=1,
-        gradient_accumulation_steps=4,
+        per_device_train_batch_size=args.per_device_batch_size,
+        per_device_eval_batch_size=args.per_device_eval_batch_size,
+        dataloader_num_workers=args.dataloader_num_workers,
+        # the workers stay up between the evaluations
+        dataloader_persistent_workers=args.dataloader_num_workers > 0,
+        dataloader_pin_memory=args.dataloader_pin_memory,
+        # the reward metrics are still logged, only the logits are not gathered
+        prediction_loss_only=True,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
         log_on_each_node=False,
         logging_strategy="steps",
         logging_steps=10,
@@ -117,35 +186,64 @@ def train_dpo(args):
     # model_ref = create_reference_model(model, num_shared_layers=6)
 
     # 2-3. Load training/valid/eval datasets
-    print("load train_data")
-    train_data = read_data_dpo(args.training_data, split="train", lang=args.lang, max_examples=args.max_examples)
-    print("load val_data")
-    val_data = read_data_dpo(args.training_data, split="valid", lang=args.lang, max_examples=args.max_examples)
-    print("load eval_data")
-    eval_data = read_data_dpo(args.training_data, split="eval", lang=args.lang, max_examples=args.max_examples)
-
-    print("Size of training data", len(train_data))
-    print("Size of validation data", len(val_data))
-    print("Size of evaluation data", len(eval_data))
-
-    dataset = DatasetDict({
-        'train': train_data,
-        'validation': val_data,
-        'evaluation': eval_data,
-    })
-
-    dataset = dataset.map(
-        lambda d: preprocess_dpo(d),
-        batched=True
-    )
+    def build_dataset():
+        print("load train_data")
+        train_data = read_data_dpo(args.training_data, split="train", lang=args.lang, max_examples=args.max_examples,
+                                   backend=args.data_backend, shuffle_mode=args.shuffle_mode)
+        print("load val_data")
+        val_data = read_data_dpo(args.training_data, split="valid", lang=args.lang, max_examples=args.max_examples,
+                                   backend=args.data_backend, shuffle_mode=args.shuffle_mode)
+        print("load eval_data")
+        eval_data = read_data_dpo(args.training_data, split="eval", lang=args.lang, max_examples=args.max_examples,
+                                   backend=args.data_backend, shuffle_mode=args.shuffle_mode)
+
+        print("Size of training data", len(train_data))
+        print("Size of validation data", len(val_data))
+        print("Size of evaluation data", len(eval_data))
+
+        dataset = DatasetDict({
+            'train': train_data,
+            'validation': val_data,
+            'evaluation': eval_data,
+        })
+
+        for split in dataset:
+            if split == 'train' and args.streaming:
+                # streamed rows are formatted as they are read (format_dpo_rows) and have no length column
+                continue
+            dataset[split] = add_dpo_lengths(format_dpo(dataset[split], args.preprocessing_num_workers), tokenizer,
+                                             args.preprocessing_num_workers)
+        return dataset
+
+    # read and map once, the other ranks memory-map the result
+    dataset = preprocess_on_main_process(training_args, build_dataset,
+                                         preprocessed_dir=args.preprocessed_dir,
+                                         per_node=args.preprocess_per_node)
 
     # print("Filtering by length")
     # dataset = filter_by_length(dataset, model_max_length)
 
     print("Size of training data", len(dataset['train']))
+    dataset['validation'] = stratified_subsample(dataset['validation'], args.eval_examples, seed=training_args.seed)
+
+    resume_from_checkpoint = resolve_checkpoint(args.resume_from_checkpoint, output_dir)
+    if args.dataloader_num_workers > 0:
+        # the tokenizer has run its threads in this process, the forked workers get none instead of a warning each
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    callbacks = [ThroughputCallback()] if args.throughput_log else []
+    if args.streaming:
+        # pairs are tokenized by the DPO data collator as they are streamed
+        train_data = dataset['train'].with_transform(partial(format_dpo_rows, schema=dataset['train'].features.arrow_schema))
+        dataset['train'] = StreamingDataset(train_data,
+                                            buffer_size=args.shuffle_buffer_size,
+                                            seed=training_args.seed,
+                                            start_position=load_stream_position(resume_from_checkpoint),
+                                            batch_size=training_args.per_device_train_batch_size * training_args.world_size)
+        prepare_streaming_args(training_args, dataset['train'].num_examples, args.num_train_epochs)
+        callbacks.append(StreamPositionCallback(dataset['train']))
 
     # 5. initialize the DPO trainer
-    dpo_trainer = DPOTrainer(
+    dpo_trainer = BucketedDPOTrainer(
         model=model,
         ref_model=None,
         args=training_args,
@@ -154,14 +252,23 @@ def train_dpo(args):
         eval_dataset=dataset['validation'],
         tokenizer=tokenizer,
         max_length=model_max_length,
-        max_target_length=256,
-        max_prompt_length=256,
+        max_target_length=max_target_length,
+        max_prompt_length=max_prompt_length,
         padding_value=tokenizer.pad_token_id,
         peft_config=get_peft_config(args),
+        callbacks=callbacks,
+        length_fn=example_lengths if (args.length_bucketing or args.max_tokens_per_batch) and not args.streaming else None,
+        bucket_batches=args.bucket_batches,
+        max_tokens=args.max_tokens_per_batch,
+        supervised_fn=pair_counts,
+        eval_length_fn=example_lengths,
+        eval_time_budget=args.eval_time_budget,
+        async_checkpointing=args.async_checkpointing,
+        dataloader_prefetch_factor=args.dataloader_prefetch_factor,
     )
 
     # 6. train
-    dpo_trainer.train()
+    dpo_trainer.train(resume_from_checkpoint=resume_from_checkpoint)
 
     base_model_name = os.path.basename(args.model)
     save_directory = os.path.join("../../models/dpo_finetuned/", base_model_name + "-" + args.training_data + "-" + args.lang)
@@ -177,7 +284,10 @@ def train_dpo(args):
     print('Save directory:', save_directory)
 
 def main(argv):
-    args = argparser().parse_args(argv[1:])
+    ap = argparser()
+    args = ap.parse_args(argv[1:])
+    if args.streaming and args.max_tokens_per_batch:
+        ap.error("--max_tokens_per_batch batches by length, it can't be combined with --streaming")
     train_dpo(args)
 
 if __name__ == '__main__':
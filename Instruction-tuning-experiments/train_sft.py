@@ -2,7 +2,7 @@ import sys
 import os
 import torch
 import numpy as np
-from logging import warning
+import pyarrow as pa
 from datasets import DatasetDict, Dataset
 from argparse import ArgumentParser
 
@@ -17,12 +17,15 @@ from trl import (
 )
 
 # custom classes
-from utils import load_model, logits_argmax
-from instruction_finetuning_datasets import read_data_sft
+from utils import load_model, preprocess_on_main_process, stratified_subsample
+from instruction_finetuning_datasets import read_data_sft, parse_data_weights, shuffle_modes
+from arrow_readers import sft_text
+from packing import example_lengths
+from context_budget import ContextBudget
+from callbacks import ThroughputCallback
+from trainers import AsyncCheckpointMixin, EvalMetricsMixin, FastEvalMixin, LengthBucketingMixin, PrefetchMixin, TokenBudgetMixin
 
 model_max_length = 2048
-user_token = "<|user|>"
-assistant_token = "<|assistant|>"
 
 def argparser():
     ap = ArgumentParser()
@@ -42,32 +45,45 @@ def argparser():
     ap.add_argument('--use_lora', default=True, type=lambda x: (str(x).lower() == 'true'))
     ap.add_argument('--transformers_cache',type=str, default="/scratch/project_2007628/transformers_cache")
     ap.add_argument('--dropout',type=float, default=0.1)
+    ap.add_argument('--data_weights', type=str, default=None)
+    ap.add_argument('--data_backend', type=str, default="python", choices=["python", "arrow"])
+    ap.add_argument('--shuffle_mode', type=str, default="sampler", choices=shuffle_modes)
+    ap.add_argument('--preprocessed_dir', type=str, default=None)
+    ap.add_argument('--preprocessing_num_workers', type=int, default=None)
+    ap.add_argument('--preprocess_per_node', default=False, type=lambda x: (str(x).lower() == 'true'))
     ap.add_argument('--prompt_structure', default=False, type=lambda x: (str(x).lower() == 'true'))
+    ap.add_argument('--conversations', default=False, type=lambda x: (str(x).lower() == 'true'))
+    ap.add_argument('--length_bucketing', default=False, type=lambda x: (str(x).lower() == 'true'), help="micro-batches of examples of similar length, changes the order of the training data")
+    ap.add_argument('--bucket_batches', type=int, default=64, help="micro-batches per length bucket")
+    ap.add_argument('--max_tokens_per_batch', type=int, default=None, help="token budget per micro-batch instead of per_device_batch_size rows")
+    ap.add_argument('--context_budget', default=False, type=lambda x: (str(x).lower() == 'true'), help="keep OASST examples longer than model_max_length with their oldest turns dropped, changes the training data (see context_budget.py)")
+    ap.add_argument('--per_device_eval_batch_size', type=int, default=4)
+    ap.add_argument('--eval_examples', type=int, default=None, help="evaluate on a fixed subsample of the validation split, stratified by source")
+    ap.add_argument('--eval_time_budget', type=float, default=None, help="seconds per evaluation during training")
+    ap.add_argument('--throughput_log', default=False, type=lambda x: (str(x).lower() == 'true'), help="tokens/sec, padding and step time breakdown in TensorBoard")
+    ap.add_argument('--async_checkpointing', default=False, type=lambda x: (str(x).lower() == 'true'), help="write checkpoints in the background while training goes on (transformers 4.36, not with DeepSpeed ZeRO-3)")
+    ap.add_argument('--dataloader_num_workers', type=int, default=0, help="worker processes that collate the batches, 0 collates in the training process")
+    ap.add_argument('--dataloader_prefetch_factor', type=int, default=2, help="batches every worker keeps ready")
+    ap.add_argument('--dataloader_pin_memory', default=True, type=lambda x: (str(x).lower() == 'true'), help="batches in pinned memory for faster copies to the GPU")
     return ap
 
-def filter_by_length(datasetdict, max_length):
-    for k in datasetdict:
-        dataset = datasetdict[k]
-        filtered = dataset.filter(lambda e: len(e['input_ids']) <= max_length)
-        orig_length = len(dataset['input_ids'])
-        filt_length = len(filtered['input_ids'])
-        if filt_length < orig_length:
-            warning(
-                f'filtered {k} from {orig_length} to {filt_length} '
-                f'({filt_length/orig_length:.1%}) by max_length {max_length}'
-            )
-            datasetdict[k] = filtered
-    return datasetdict
-
-def formatting_prompts_func(example):
-    output_texts = []
-    for i in range(len(example['prompt'])):
-        if not example['context'] or example['context'].isspace():
-            text = example['prompt']
-        else:
-            text = example['context'] + '\n' + example['prompt']
-        output_texts.append(text)
-    return output_texts
+class BucketedSFTTrainer(AsyncCheckpointMixin, EvalMetricsMixin, FastEvalMixin, PrefetchMixin, TokenBudgetMixin, LengthBucketingMixin, SFTTrainer):
+    pass
+
+def formatting_prompts_func(example, end_of_text):
+    # example is a batch of rows as column lists, one training text per row
+    batch = pa.table({col: example[col] for col in ('prompt', 'context', 'response')})
+    return sft_text(batch, '\n', end_of_text).to_pylist()
+
+
+def completion_only_counts(dataset, collator, batch_size=1000):
+    # label tokens per example of the tokenized train set, as the collator masks them (it finds the
+    # templates per batch, see TokenBudgetMixin), without the first one which nothing predicts
+    counts = []
+    for batch in dataset.select_columns(['input_ids']).iter(batch_size=batch_size):
+        labels = collator([{'input_ids': ids} for ids in batch['input_ids']])['labels']
+        counts.append((labels[:, 1:] != -100).sum(dim=1).numpy())
+    return np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
 
 
 def train_sft(args):
@@ -86,9 +102,14 @@ def train_sft(args):
         evaluation_strategy="steps",
         eval_steps=100,
         learning_rate=args.learning_rate,
-        per_device_train_batch_size=1,
-        gradient_accumulation_steps=4,
-        per_device_eval_batch_size=1,
+        per_device_train_batch_size=args.per_device_batch_size,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        per_device_eval_batch_size=args.per_device_eval_batch_size,
+        dataloader_num_workers=args.dataloader_num_workers,
+        # the workers stay up between the evaluations
+        dataloader_persistent_workers=args.dataloader_num_workers > 0,
+        dataloader_pin_memory=args.dataloader_pin_memory,
+        prediction_loss_only=True,
         log_on_each_node=False,
         logging_strategy="steps",
         logging_steps=10,
@@ -128,21 +149,38 @@ def train_sft(args):
     #     tokenizer.add_special_tokens({'sep_token': '<|endofprompt|>'})
     # model.resize_token_embeddings(len(tokenizer))
 
-    train_data = read_data_sft(args.training_data, split="train", lang=args.lang)
-    val_data = read_data_sft(args.training_data, split="valid", lang=args.lang)
-    eval_data = read_data_sft(args.training_data, split="eval", lang=args.lang)
-
-    print("Size of training data", len(train_data))
-    print("Size of validation data", len(val_data))
-    print("Size of evaluation data", len(eval_data))
-
-    dataset = DatasetDict({
-        'train': train_data,
-        'validation': val_data,
-        'evaluation': eval_data,
-    })
+    # formatting_prompts_func joins the prompt and the response with "\n"
+    context_budget = ContextBudget(tokenizer, model_max_length, '\n', tokenizer.eos_token) if args.context_budget else None
+
+    def build_dataset():
+        data_weights = parse_data_weights(args.data_weights)
+        train_data = read_data_sft(args.training_data, split="train", lang=args.lang, conversations=args.conversations,
+                                   backend=args.data_backend,
+                                   weights=data_weights, shuffle_mode=args.shuffle_mode, context_budget=context_budget)
+        val_data = read_data_sft(args.training_data, split="valid", lang=args.lang, conversations=args.conversations,
+                                   backend=args.data_backend,
+                                   weights=data_weights, shuffle_mode=args.shuffle_mode, context_budget=context_budget)
+        eval_data = read_data_sft(args.training_data, split="eval", lang=args.lang, conversations=args.conversations,
+                                   backend=args.data_backend,
+                                   weights=data_weights, shuffle_mode=args.shuffle_mode, context_budget=context_budget)
+
+        print("Size of training data", len(train_data))
+        print("Size of validation data", len(val_data))
+        print("Size of evaluation data", len(eval_data))
+
+        return DatasetDict({
+            'train': train_data,
+            'validation': val_data,
+            'evaluation': eval_data,
+        })
+
+    # read once, the other ranks memory-map the result
+    dataset = preprocess_on_main_process(training_args, build_dataset,
+                                         preprocessed_dir=args.preprocessed_dir,
+                                         per_node=args.preprocess_per_node)
 
     print("Size of training data", len(dataset['train']))
+    dataset['validation'] = stratified_subsample(dataset['validation'], args.eval_examples, seed=training_args.seed)
 
     instruction_template = "<|user|>"
     response_template = "<|assistant|>"
@@ -150,15 +188,29 @@ def train_sft(args):
                                                response_template=response_template,
                                                tokenizer=tokenizer,
                                                mlm=False)
-    trainer = SFTTrainer(
+    if args.dataloader_num_workers > 0:
+        # the tokenizer has run its threads in this process, the forked workers get none instead of a warning each
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    callbacks = [ThroughputCallback()] if args.throughput_log else []
+    trainer = BucketedSFTTrainer(
         model=model,
         args=training_args,
         train_dataset=dataset['train'],
         eval_dataset=dataset['validation'],
         data_collator=collator,
         tokenizer=tokenizer,
-        formatting_func=formatting_prompts_func,
-        #preprocess_logits_for_metrics=logits_argmax,
+        callbacks=callbacks,
+        formatting_func=lambda e: formatting_prompts_func(e, tokenizer.eos_token),
+        dataset_num_proc=args.preprocessing_num_workers,
+        # SFTTrainer tokenizes the train set, the sampler reads the lengths from it
+        length_fn=example_lengths if args.length_bucketing or args.max_tokens_per_batch else None,
+        bucket_batches=args.bucket_batches,
+        max_tokens=args.max_tokens_per_batch,
+        supervised_fn=lambda dataset: completion_only_counts(dataset, collator),
+        eval_length_fn=example_lengths,
+        eval_time_budget=args.eval_time_budget,
+        async_checkpointing=args.async_checkpointing,
+        dataloader_prefetch_factor=args.dataloader_prefetch_factor,
     )
 
     trainer.train()
@@ -0,0 +1,364 @@
+import os
+import time
+import shutil
+import datasets
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+import transformers
+from transformers import Trainer
+from transformers.integrations import is_deepspeed_zero3_enabled
+from transformers.trainer import TRAINER_STATE_NAME
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR, seed_worker
+
+from checkpointing import AsyncCheckpointWriter
+from samplers import LengthBucketedSampler, EvalSampler, TokenBudgetBatchSampler, WindowTokensDataset, WindowTokensCollator
+
+# Trainer extensions shared by the training scripts. They are mixins so that the same behaviour
+# can be put in front of Trainer, trl's SFTTrainer and DPOTrainer:
+#   class BucketedSFTTrainer(AsyncCheckpointMixin, EvalMetricsMixin, FastEvalMixin, PrefetchMixin, TokenBudgetMixin, LengthBucketingMixin, SFTTrainer): pass
+
+
+class LengthBucketingMixin:
+    # length_fn(train_dataset) -> array of example lengths, None keeps the Trainer's random sampler
+    def __init__(self, *args, length_fn=None, bucket_batches=64, **kwargs):
+        self.length_fn = length_fn
+        self.bucket_batches = bucket_batches
+        super().__init__(*args, **kwargs)
+
+    def _get_train_sampler(self):
+        if self.length_fn is None:
+            return super()._get_train_sampler()
+        sampler = LengthBucketedSampler(self.length_fn(self.train_dataset),
+                                        self._train_batch_size,
+                                        bucket_batches=self.bucket_batches,
+                                        seed=self.args.seed)
+        if self.args.should_log:
+            sampler.report()
+        return sampler
+
+
+class TokenBudgetMixin:
+    # Micro-batches of up to max_tokens padded tokens instead of per_device_train_batch_size rows,
+    # lengths from length_fn. With supervised_fn(train_dataset) -> label tokens per example, the
+    # loss is normalized by the supervised tokens of the whole accumulation window (all ranks)
+    # rather than averaged per micro-batch, so that every token weighs the same. A trainer whose
+    # loss is a mean over something else counts that in supervised_fn and supervised_tokens(inputs).
+    def __init__(self, *args, max_tokens=None, supervised_fn=None, **kwargs):
+        self.max_tokens = max_tokens
+        self.supervised_fn = supervised_fn
+        super().__init__(*args, **kwargs)
+
+    def get_train_dataloader(self):
+        if self.max_tokens is None or isinstance(self.train_dataset, torch.utils.data.IterableDataset):
+            return super().get_train_dataloader()
+        if self.length_fn is None:
+            raise ValueError("token budget batching needs the example lengths (length_fn)")
+        train_dataset = self.train_dataset
+        data_collator = self.data_collator
+        sampler = TokenBudgetBatchSampler(self.length_fn(train_dataset),
+                                          self.max_tokens,
+                                          window_batches=self.args.gradient_accumulation_steps * self.args.world_size,
+                                          supervised=self.supervised_fn(train_dataset) if self.supervised_fn else None,
+                                          seed=self.args.seed)
+        if self.args.should_log:
+            sampler.report()
+        if isinstance(train_dataset, datasets.Dataset):
+            train_dataset = self._remove_unused_columns(train_dataset, description="training")
+        else:
+            data_collator = self._get_collator_with_removed_columns(data_collator, description="training")
+        if self.supervised_fn is not None:
+            train_dataset = WindowTokensDataset(train_dataset)
+            data_collator = WindowTokensCollator(data_collator)
+        dataloader = DataLoader(train_dataset,
+                                batch_sampler=sampler,
+                                collate_fn=data_collator,
+                                num_workers=self.args.dataloader_num_workers,
+                                pin_memory=self.args.dataloader_pin_memory,
+                                persistent_workers=self.args.dataloader_persistent_workers,
+                                worker_init_fn=seed_worker)
+        # the batches have no fixed size, the sampler already gives every rank the same number of them
+        even_batches = self.accelerator.even_batches
+        self.accelerator.even_batches = False
+        try:
+            return self.accelerator.prepare(dataloader)
+        finally:
+            self.accelerator.even_batches = even_batches
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        window_tokens = inputs.pop("window_tokens", None)
+        if window_tokens is None:
+            return super().compute_loss(model, inputs, return_outputs)
+        loss, outputs = super().compute_loss(model, inputs, return_outputs=True)
+        # the model's loss is the mean over this batch's label tokens, make it the sum over the
+        # window's; backward divides by the accumulation steps and the ranks average their gradients
+        scale = self.args.gradient_accumulation_steps * self.args.world_size / window_tokens
+        loss = loss * self.supervised_tokens(inputs) * scale
+        return (loss, outputs) if return_outputs else loss
+
+    def supervised_tokens(self, inputs):
+        # what supervised_fn counts per example, for a batch
+        return (inputs["labels"][..., 1:] != -100).sum()
+
+
+class PrefetchMixin:
+    # Collation in the dataloader_num_workers worker processes, each keeping
+    # dataloader_prefetch_factor batches ready (TrainingArguments only has that from transformers
+    # 4.37 on). It comes after FastEvalMixin and before TokenBudgetMixin so that it gets the
+    # DataLoaders of both, the workers read the attribute when an iteration starts them.
+    def __init__(self, *args, dataloader_prefetch_factor=None, **kwargs):
+        self.dataloader_prefetch_factor = dataloader_prefetch_factor
+        super().__init__(*args, **kwargs)
+
+    def with_prefetch(self, dataloader):
+        if self.dataloader_prefetch_factor is not None and self.args.dataloader_num_workers > 0:
+            dataloader.prefetch_factor = self.dataloader_prefetch_factor
+        return dataloader
+
+    def get_train_dataloader(self):
+        return self.with_prefetch(super().get_train_dataloader())
+
+    def get_eval_dataloader(self, eval_dataset=None):
+        return self.with_prefetch(super().get_eval_dataloader(eval_dataset))
+
+
+class FastEvalMixin:
+    # Eval batches of similar lengths in a fixed order (EvalSampler), lengths from
+    # eval_length_fn(eval_dataset). With eval_time_budget (seconds) the evaluations during training
+    # stop after the batch that runs over it; the trainer.evaluate() after training runs in full.
+    def __init__(self, *args, eval_length_fn=None, eval_time_budget=None, **kwargs):
+        self.eval_length_fn = eval_length_fn
+        self.eval_time_budget = eval_time_budget
+        # id(eval dataset) -> (eval dataset, sampler), the lengths of DPO pairs are tokenized to
+        # measure them. The dataset is kept so that its id can't be reused by another one.
+        self.eval_samplers = {}
+        self.eval_sampler = None
+        super().__init__(*args, **kwargs)
+
+    def _get_eval_sampler(self, eval_dataset):
+        if self.eval_sampler is None:
+            return super()._get_eval_sampler(eval_dataset)
+        return self.eval_sampler
+
+    def get_eval_dataloader(self, eval_dataset=None):
+        # the sampler is made from the dataset as given, the Trainer drops the length column
+        # before it asks for one
+        dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
+        self.eval_sampler = None
+        if self.eval_length_fn is not None and not isinstance(dataset, torch.utils.data.IterableDataset):
+            if id(dataset) not in self.eval_samplers:
+                sampler = EvalSampler(self.eval_length_fn(dataset), self.args.eval_batch_size, seed=self.args.seed)
+                if self.args.should_log:
+                    sampler.report()
+                self.eval_samplers[id(dataset)] = (dataset, sampler)
+            self.eval_sampler = self.eval_samplers[id(dataset)][1]
+        dataloader = super().get_eval_dataloader(eval_dataset)
+        if self.eval_time_budget is None or not self.is_in_train:
+            return dataloader
+        return TimeBudgetDataLoader(dataloader, self.eval_time_budget, self.accelerator)
+
+
+class TimeBudgetDataLoader:
+    # Ends the iteration after the batch that runs over budget seconds. The ranks agree on the
+    # stop after every batch (an all-reduce of one flag), they all run the same forward passes
+    # and gathers, which ZeRO-3 and the loss gather of the evaluation loop wait on.
+    def __init__(self, dataloader, budget, accelerator):
+        self.dataloader = dataloader
+        self.budget = budget
+        self.accelerator = accelerator
+
+    def __getattr__(self, name):
+        return getattr(self.dataloader, name)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        start = time.perf_counter()
+        batches = 0
+        for batch in self.dataloader:
+            yield batch
+            batches += 1
+            over = torch.tensor(float(time.perf_counter() - start > self.budget), device=self.accelerator.device)
+            if batches < len(self.dataloader) and self.accelerator.reduce(over).item() > 0:
+                # accelerate only unregisters a dataloader that ran to the end
+                if hasattr(self.dataloader, "end"):
+                    self.dataloader.end()
+                if self.accelerator.is_main_process:
+                    print(f"Evaluation stopped by the {self.budget:g}s time budget after "
+                          f"{batches} of {len(self.dataloader)} batches")
+                return
+
+
+class EvalMetricsMixin:
+    # Eval loss, token accuracy and loss per source as running sums on the device. prediction_step
+    # adds every batch to them and returns no logits, nothing per token outlives its batch. With
+    # eval_sources, the source names behind the source_id column of the eval rows, the loss is
+    # also reported per source. Batches without labels (DPO pairs) are left to the Trainer.
+    def __init__(self, *args, eval_sources=None, **kwargs):
+        self.eval_sources = list(eval_sources or [])
+        # (1 + sources) x (loss, tokens, correct tokens), the first row is the total
+        self.eval_sums = None
+        super().__init__(*args, **kwargs)
+
+    def with_source_id(self, remove_columns, data, description):
+        # the eval rows keep their source_id for prediction_step, the training rows are filtered as
+        # usual (the model takes no source_id). A copy, the collator keeps the list it is given.
+        if description != "evaluation":
+            return remove_columns(data, description)
+        self._set_signature_columns_if_needed()
+        columns = self._signature_columns
+        self._signature_columns = columns + ["source_id"]
+        try:
+            return remove_columns(data, description)
+        finally:
+            self._signature_columns = columns
+
+    def _remove_unused_columns(self, dataset, description=None):
+        return self.with_source_id(super()._remove_unused_columns, dataset, description)
+
+    def _get_collator_with_removed_columns(self, data_collator, description=None):
+        return self.with_source_id(super()._get_collator_with_removed_columns, data_collator, description)
+
+    def prediction_step(self, model, inputs, prediction_loss_only, ignore_keys=None):
+        source_ids = inputs.pop("source_id", None)
+        if "labels" not in inputs or self.eval_sums is None:
+            return super().prediction_step(model, inputs, prediction_loss_only, ignore_keys)
+        inputs = self._prepare_inputs(inputs)
+        labels = inputs.pop("labels")
+        with torch.no_grad():
+            with self.compute_loss_context_manager():
+                logits = model(**inputs).logits
+        # the shift of the models' own loss, the logits at t predict token t + 1. Only the
+        # supervised positions are scored.
+        labels = labels[:, 1:]
+        supervised = labels != -100
+        logits = logits[:, :-1][supervised].float()
+        targets = labels[supervised]
+        token_losses = torch.nn.functional.cross_entropy(logits, targets, reduction="none")
+        correct = (logits.argmax(dim=-1) == targets).double()
+        rows = supervised.nonzero()[:, 0]
+        example_sums = torch.zeros(len(labels), 3, dtype=torch.float64, device=labels.device)
+        example_sums.index_add_(0, rows, torch.stack([token_losses.double(), torch.ones_like(correct), correct], dim=1))
+        self.eval_sums[0] += example_sums.sum(dim=0)
+        if source_ids is not None and self.eval_sources:
+            self.eval_sums.index_add_(0, source_ids.to(labels.device) + 1, example_sums)
+        # a batch without supervised tokens counts as 0 rather than the NaN mean of nothing
+        loss = example_sums[:, 0].sum() / example_sums[:, 1].sum().clamp(min=1)
+        return loss.float().detach(), None, None
+
+    def evaluation_loop(self, dataloader, description, prediction_loss_only=None, ignore_keys=None, metric_key_prefix="eval"):
+        self.eval_sums = torch.zeros(1 + len(self.eval_sources), 3, dtype=torch.float64, device=self.args.device)
+        try:
+            output = super().evaluation_loop(dataloader, description, prediction_loss_only, ignore_keys, metric_key_prefix)
+            sums = self.accelerator.reduce(self.eval_sums).tolist()
+        finally:
+            self.eval_sums = None
+        loss, tokens, correct = sums[0]
+        if tokens:
+            output.metrics[f"{metric_key_prefix}_token_loss"] = loss / tokens
+            output.metrics[f"{metric_key_prefix}_token_accuracy"] = correct / tokens
+        for name, (loss, tokens, _) in zip(self.eval_sources, sums[1:]):
+            if tokens:
+                output.metrics[f"{metric_key_prefix}_loss_{name}"] = loss / tokens
+        return output
+
+
+class AsyncCheckpointMixin:
+    # With async_checkpointing, saves hold training up only for the copy of the state to host
+    # memory (AsyncCheckpointWriter), the files are written to tmp-checkpoint-N in the background.
+    # Once every rank has written its files, which the ranks check after every step, the main
+    # process renames the directory to checkpoint-N and rotates out the old checkpoints, also in
+    # the background, so that a checkpoint-N is always complete. A save first waits for the last
+    # one, the end of training for the last one. _save_checkpoint follows the Trainer's private
+    # one of transformers 4.36 (the version setup-venv-*.sh installs), other versions are refused,
+    # and so is ZeRO-3, whose 16-bit weights are gathered by collectives that the deferred saves
+    # have not been verified with.
+    def __init__(self, *args, async_checkpointing=False, **kwargs):
+        self.checkpoint_writer = AsyncCheckpointWriter() if async_checkpointing else None
+        # run_dir, staging_dir, output_dir of the checkpoint being written
+        self.pending_checkpoint = None
+        super().__init__(*args, **kwargs)
+        if self.checkpoint_writer is not None:
+            if not transformers.__version__.startswith("4.36."):
+                raise ValueError(f"async checkpointing needs transformers 4.36, found {transformers.__version__}")
+            if is_deepspeed_zero3_enabled():
+                raise ValueError("async checkpointing does not support DeepSpeed ZeRO-3, use a stage 2 config")
+
+    def _save_checkpoint(self, model, trial, metrics=None):
+        if self.checkpoint_writer is None or self.args.push_to_hub:
+            return super()._save_checkpoint(model, trial, metrics)
+        self.finish_checkpoint(wait=True)
+        checkpoint_folder = f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}"
+        if self.hp_search_backend is None and trial is None:
+            self.store_flos()
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, checkpoint_folder)
+        staging_dir = os.path.join(run_dir, f"tmp-{checkpoint_folder}")
+        # left behind by a run that stopped while writing it
+        if self.args.should_save and os.path.exists(staging_dir):
+            shutil.rmtree(staging_dir)
+        self.accelerator.wait_for_everyone()
+        with self.checkpoint_writer.capture():
+            self.save_model(staging_dir, _internal_call=True)
+            if not self.args.save_only_model:
+                self._save_optimizer_and_scheduler(staging_dir)
+                self._save_rng_state(staging_dir)
+        if metrics is not None and self.args.metric_for_best_model is not None:
+            metric_to_check = self.args.metric_for_best_model
+            if not metric_to_check.startswith("eval_"):
+                metric_to_check = f"eval_{metric_to_check}"
+            operator = np.greater if self.args.greater_is_better else np.less
+            if (self.state.best_metric is None or self.state.best_model_checkpoint is None
+                    or operator(metrics[metric_to_check], self.state.best_metric)):
+                self.state.best_metric = metrics[metric_to_check]
+                self.state.best_model_checkpoint = output_dir
+        if self.args.should_save:
+            self.state.save_to_json(os.path.join(staging_dir, TRAINER_STATE_NAME))
+        self.pending_checkpoint = (run_dir, staging_dir, output_dir)
+
+    def _maybe_log_save_evaluate(self, *args, **kwargs):
+        self.finish_checkpoint()
+        super()._maybe_log_save_evaluate(*args, **kwargs)
+
+    def train(self, *args, **kwargs):
+        output = super().train(*args, **kwargs)
+        if self.checkpoint_writer is not None:
+            # the logging callbacks are closed by now, the last write is only printed
+            self.finish_checkpoint(wait=True, log=False)
+            self.checkpoint_writer.wait()
+        return output
+
+    def finish_checkpoint(self, wait=False, log=True):
+        if self.pending_checkpoint is None:
+            return
+        writer = self.checkpoint_writer
+        if wait:
+            writer.wait()
+        # ranks done, write seconds and bytes summed over the ranks
+        stats = torch.tensor([float(writer.done()), writer.write_seconds, writer.bytes],
+                             dtype=torch.float64, device=self.args.device)
+        done, seconds, size = self.accelerator.reduce(stats).tolist()
+        if done < self.args.world_size:
+            return
+        writer.wait()
+        run_dir, staging_dir, output_dir = self.pending_checkpoint
+        self.pending_checkpoint = None
+        if self.args.should_save:
+            writer.submit(self.publish_checkpoint, run_dir, staging_dir, output_dir)
+        metrics = {"checkpoint_write_seconds": seconds / self.args.world_size, "checkpoint_gb": size / 2**30}
+        if log:
+            self.log(metrics)
+        elif self.args.should_log:
+            print(f"{os.path.basename(output_dir)}: {metrics['checkpoint_gb']:.2f} GB written in "
+                  f"{metrics['checkpoint_write_seconds']:.1f}s in the background")
+
+    def publish_checkpoint(self, run_dir, staging_dir, output_dir):
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.replace(staging_dir, output_dir)
+        self._rotate_checkpoints(use_mtime=True, output_dir=run_dir)
+
+
+class BucketedTrainer(AsyncCheckpointMixin, EvalMetricsMixin, FastEvalMixin, PrefetchMixin, TokenBudgetMixin, LengthBucketingMixin, Trainer):
+    pass
@@ -1,8 +1,13 @@
 import sys
+import os
+import shutil
+import socket
 from functools import wraps
 from time import time
 from logging import warning
+import numpy as np
 import torch
+from datasets import load_from_disk
 from transformers import AutoModelForCausalLM
 from peft import (
     get_peft_config,
@@ -12,6 +17,8 @@ from peft import (
     TaskType
 )
 
+from indexed_dataset import token_lengths
+
 def timed(f):
     @wraps(f)
     def timed_f(*args, **kwargs):
@@ -22,10 +29,6 @@ def timed(f):
         return result
     return timed_f
 
-def logits_argmax(logits):
-    # https://github.com/huggingface/transformers/issues/15466
-    return logits.argmax(axis=-1)
-
 
 def load_model(model_name, transformers_cache, use_lora=False, ignore_bias_buffers=False, lora_r=16):
     print("load_model")
@@ -66,15 +69,99 @@ def get_peft_config(model_args):
     return peft_config
 
 def filter_by_length(datasetdict, max_length):
+    # a numpy mask over the example lengths (the length column of the tokenized data), the token
+    # lists are never read into Python
     for k in datasetdict:
         dataset = datasetdict[k]
-        filtered = dataset.filter(lambda e: len(e['input_ids']) <= max_length)
-        orig_length = len(dataset['input_ids'])
-        filt_length = len(filtered['input_ids'])
-        if filt_length < orig_length:
-            warning(
-                f'filtered {k} from {orig_length} to {filt_length} '
-                f'({filt_length/orig_length:.1%}) by max_length {max_length}'
-            )
-            datasetdict[k] = filtered
+        lengths = token_lengths(dataset)
+        keep = lengths <= max_length
+        if keep.all():
+            continue
+        warning(
+            f'filtered {k} from {len(keep)} to {keep.sum()} ({keep.mean():.1%}) by max_length {max_length}, '
+            f'dropped {lengths[~keep].sum()} of {lengths.sum()} tokens'
+        )
+        if 'source' in dataset.column_names:
+            report_dropped_by_source(dataset.with_format("arrow")['source'], lengths, keep)
+        datasetdict[k] = dataset.select(np.flatnonzero(keep))
     return datasetdict
+
+def report_dropped_by_source(sources, lengths, keep):
+    names, source_ids = np.unique(sources.to_numpy(), return_inverse=True)
+    examples = np.bincount(source_ids, minlength=len(names))
+    dropped = np.bincount(source_ids, weights=~keep, minlength=len(names)).astype(np.int64)
+    tokens = np.bincount(source_ids, weights=lengths, minlength=len(names)).astype(np.int64)
+    dropped_tokens = np.bincount(source_ids, weights=lengths * ~keep, minlength=len(names)).astype(np.int64)
+    for name, n, d, t, dt in zip(names, examples, dropped, tokens, dropped_tokens):
+        if d:
+            warning(f'  {name}: dropped {d} of {n} examples ({d/n:.1%}), {dt} of {t} tokens ({dt/t:.1%})')
+
+def dataset_sources(dataset):
+    # source names and the index of every example's source in them
+    if 'source' not in dataset.column_names:
+        return np.array([], dtype=str), None
+    return np.unique(dataset.with_format("arrow")['source'].to_numpy(), return_inverse=True)
+
+def add_source_ids(dataset):
+    # an integer source_id column for the eval loss per source (EvalMetricsMixin) and the names
+    names, source_ids = dataset_sources(dataset)
+    if not len(names):
+        return dataset, []
+    return dataset.add_column('source_id', source_ids), names.tolist()
+
+def stratified_subsample(dataset, max_examples, seed=42):
+    # a fixed random subsample of max_examples in which every source keeps its share of the dataset
+    # (largest remainders get the rounding), the examples stay in dataset order
+    if max_examples is None or len(dataset) <= max_examples:
+        return dataset
+    names, source_ids = dataset_sources(dataset)
+    if not len(names):
+        names, source_ids = np.array(['all']), np.zeros(len(dataset), dtype=np.int64)
+    counts = np.bincount(source_ids, minlength=len(names))
+    quota = counts * max_examples / len(dataset)
+    take = np.floor(quota).astype(np.int64)
+    take[np.argsort(take - quota, kind="stable")[:max_examples - take.sum()]] += 1
+    rng = np.random.default_rng(seed)
+    indices = np.sort(np.concatenate([rng.choice(np.flatnonzero(source_ids == s), take[s], replace=False)
+                                      for s in range(len(names))]))
+    print(f"Evaluating on {max_examples} of {len(dataset)} examples: " +
+          ", ".join(f"{name} {t}/{n}" for name, t, n in zip(names, take, counts)))
+    return dataset.select(indices)
+
+
+def preprocessed_data_dir(training_args, preprocessed_dir=None, per_node=False):
+    path = preprocessed_dir or os.path.join(training_args.output_dir, "preprocessed_data")
+    if per_node:
+        # node-local filesystems: every node builds its own copy
+        path = os.path.join(path, socket.gethostname())
+    return path
+
+
+def is_preprocessing_process(training_args, per_node=False):
+    if per_node:
+        return training_args.local_process_index == 0
+    return training_args.process_index == 0
+
+
+def preprocess_on_main_process(training_args, build_dataset, preprocessed_dir=None, per_node=False, reuse=False):
+    # Only the main process (of the job, or of every node with per_node=True) reads, maps and
+    # filters the data. It saves the Arrow files and all ranks, the main one included, memory-map
+    # them with load_from_disk, so the other ranks never hold a copy of the data in RAM.
+    # With reuse=True an already saved dataset in preprocessed_dir is loaded as is.
+    path = preprocessed_data_dir(training_args, preprocessed_dir, per_node)
+    is_main_process = is_preprocessing_process(training_args, per_node)
+    with training_args.main_process_first(local=per_node, desc="dataset preprocessing"):
+        if is_main_process and reuse and os.path.exists(os.path.join(path, "dataset_dict.json")):
+            print("Loading preprocessed data from", path)
+        elif is_main_process:
+            print("Preprocessing data into", path)
+            dataset = build_dataset()
+            tmp_path = f"{path}.tmp{os.getpid()}"
+            dataset.save_to_disk(tmp_path)
+            del dataset
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.replace(tmp_path, path)
+        else:
+            print("Loading preprocessed data from", path)
+        return load_from_disk(path)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+import sys
+import os
+import copy
+import json
+import glob
+from argparse import ArgumentParser
+
+from transformers import AutoConfig, AutoModelForCausalLM
+from accelerate import init_empty_weights
+from peft.utils import TRANSFORMERS_MODELS_TO_LORA_TARGET_MODULES_MAPPING
+
+# Memory plan of a DeepSpeed ZeRO config before the job is queued: per device parameters,
+# gradients, optimizer states, communication buckets and activations, per node the offloaded
+# states and the model loading. The model is built on the meta device from its config, so the
+# parameter counts are exact for any architecture and nothing is downloaded but the config.
+#
+#   python zero_planner.py --model LumiOpen/Poro-34B --lora_r 16 --world_size 32
+#
+# evaluates every config in ds-configs and the stage/offload variants of --base_config, prints
+# the table and recommends the fastest one that fits (least offloading, then lowest stage);
+# --output writes it. --zero_stage, --offload_* and the bucket sizes override every config.
+#
+# Model states follow the ZeRO paper: bf16/fp16 parameters and gradients (2 bytes) and an fp32
+# master copy with the optimizer states (4 + 4 per state), partitioned over the ranks from
+# stage 1 (optimizer), 2 (+ gradients) and 3 (+ parameters). With overlap_comm DeepSpeed keeps
+# 4.5x the bucket sizes in flight. Activations are bytes per token per decoder layer as measured
+# with saved_tensors_hooks on Llama and BLOOM (transformers 4.36):
+#   act * (8h + 4I) for gated MLPs, act * (8h + 2I) for plain ones,
+#   with LoRA act * (8h + 3I) and act * (7h + I) (frozen linears keep no inputs) + act * r per target,
+#   + 8h with RMSNorms that keep fp32 copies (Llama), + heads * seq * (4 + act) with eager attention.
+# Gradient checkpointing keeps one h-vector per layer and recomputes one layer at a time. The
+# loss keeps the log-softmax of the logits, in fp32 for models that upcast them.
+
+GB = 2 ** 30
+# compute the loss on fp32 logits and keep fp32 copies in their RMSNorms
+upcast_model_types = ("llama", "mistral", "mixtral")
+
+
+def argparser():
+    ap = ArgumentParser()
+    ap.add_argument('--model', type=str, help="model name or path, only the config is read")
+    ap.add_argument('--transformers_cache', type=str, default=None)
+    ap.add_argument('--lora_r', type=int, default=0, help="LoRA rank, 0 for full finetuning")
+    ap.add_argument('--ds_config', type=str, nargs='*', default=None, help="configs to evaluate, ds-configs/*.json by default")
+    ap.add_argument('--base_config', type=str, default="./ds-configs/oa_zero3_config_sft.json", help="config the stage/offload variants are made from")
+    ap.add_argument('--zero_stage', type=int, default=None, choices=[0, 1, 2, 3])
+    ap.add_argument('--offload_optimizer', type=str, default=None, choices=["none", "cpu"])
+    ap.add_argument('--offload_param', type=str, default=None, choices=["none", "cpu"])
+    ap.add_argument('--reduce_bucket_size', type=float, default=None)
+    ap.add_argument('--allgather_bucket_size', type=float, default=None)
+    ap.add_argument('--prefetch_bucket_size', type=float, default=None)
+    ap.add_argument('--optimizer_states', type=int, default=2, help="fp32 states per trainable parameter, 2 for AdamW, 1 for RMSprop")
+    ap.add_argument('--world_size', type=int, default=8)
+    ap.add_argument('--gpus_per_node', type=int, default=8)
+    ap.add_argument('--micro_batch', type=int, default=1, help="per_device_batch_size")
+    ap.add_argument('--seq_length', type=int, default=2048)
+    ap.add_argument('--gradient_checkpointing', default=True, type=lambda x: (str(x).lower() == 'true'))
+    ap.add_argument('--device_memory_gb', type=float, default=64, help="per device, 64 for a LUMI MI250X GCD")
+    ap.add_argument('--host_memory_gb', type=float, default=480, help="per node")
+    ap.add_argument('--device_overhead_gb', type=float, default=1.5, help="runtime context and allocator fragmentation")
+    ap.add_argument('--host_overhead_gb', type=float, default=4, help="per rank: Python, the Trainer, the data")
+    ap.add_argument('--checkpoint_shard_gb', type=float, default=10, help="largest checkpoint file, loaded whole by every rank under ZeRO-3")
+    ap.add_argument('--output', type=str, default=None, help="write the recommended config here")
+    return ap
+
+
+class ModelShape:
+    def __init__(self, config, lora_r=0):
+        with init_empty_weights():
+            model = AutoModelForCausalLM.from_config(config)
+        # not tied on the meta device yet
+        model.tie_weights()
+        self.model_type = config.model_type
+        self.hidden = config.hidden_size
+        self.heads = config.num_attention_heads
+        self.layers = config.num_hidden_layers
+        self.vocab = config.vocab_size
+        self.intermediate = (getattr(config, 'intermediate_size', None) or getattr(config, 'n_inner', None)
+                             or 4 * self.hidden)
+        self.upcast = self.model_type in upcast_model_types
+        self.eager_attention = model.config._attn_implementation == "eager"
+        names = [name for name, _ in model.named_modules()]
+        self.gated = any(name.endswith(("gate_proj", ".w1")) for name in names)
+        # tied embeddings are counted once
+        self.params = sum(p.numel() for p in model.parameters())
+        # the biggest unit ZeRO-3 gathers whole: a decoder layer, the embeddings or the output layer
+        blocks = max((m for m in model.modules() if m.__class__.__name__ == "ModuleList"),
+                     key=lambda m: sum(p.numel() for p in m.parameters()))
+        units = [sum(p.numel() for p in layer.parameters()) for layer in blocks]
+        units += [p.numel() for p in model.get_input_embeddings().parameters()]
+        units += [p.numel() for p in model.get_output_embeddings().parameters()]
+        self.largest_unit = max(units)
+        self.lora_r = lora_r
+        self.lora_targets = 0
+        self.trainable = self.params
+        if lora_r:
+            # peft's default target modules, as load_model and get_peft_config use them
+            targets = TRANSFORMERS_MODELS_TO_LORA_TARGET_MODULES_MAPPING[self.model_type]
+            linears = [m for name, m in model.named_modules()
+                       if name.split('.')[-1] in targets and hasattr(m, "in_features")]
+            self.trainable = sum(lora_r * (m.in_features + m.out_features) for m in linears)
+            self.lora_targets = len(linears) / self.layers
+
+    def layer_activations(self, seq_length, act):
+        # bytes per token of one decoder layer in training
+        h, I = self.hidden, self.intermediate
+        if self.lora_r:
+            layer = act * ((8 * h + 3 * I) if self.gated else (7 * h + I)) + self.lora_targets * act * self.lora_r
+        else:
+            layer = act * (8 * h + (4 if self.gated else 2) * I)
+        if self.upcast:
+            layer += 4 * 2 * h
+        if self.eager_attention:
+            layer += self.heads * seq_length * (4 + (act if act < 4 else 0))
+        return layer
+
+    def activations(self, micro_batch, seq_length, act, checkpointing):
+        # peak bytes of a micro-batch: the stored activations, the layer being recomputed and the loss
+        tokens = micro_batch * seq_length
+        layer = self.layer_activations(seq_length, act)
+        logits = 4 if self.upcast else act
+        loss = self.vocab * (logits + act + logits)
+        if checkpointing:
+            return tokens * (self.layers * act * self.hidden + layer + loss)
+        return tokens * (self.layers * layer + loss)
+
+
+def load_config(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def configure(ds_config, zero_stage=None, offload_optimizer=None, offload_param=None,
+              reduce_bucket_size=None, allgather_bucket_size=None, prefetch_bucket_size=None):
+    # a copy with the given zero_optimization settings
+    ds_config = copy.deepcopy(ds_config)
+    zero = ds_config.setdefault("zero_optimization", {})
+    if zero_stage is not None:
+        zero["stage"] = zero_stage
+    for key, device in (("offload_optimizer", offload_optimizer), ("offload_param", offload_param)):
+        if device is not None:
+            zero[key] = {"device": device, "pin_memory": True}
+    for key, size in (("reduce_bucket_size", reduce_bucket_size),
+                      ("allgather_bucket_size", allgather_bucket_size),
+                      ("stage3_prefetch_bucket_size", prefetch_bucket_size)):
+        if size is not None:
+            zero[key] = size
+    return ds_config
+
+
+def zero_settings(ds_config, hidden):
+    zero = ds_config.get("zero_optimization", {})
+    stage = int(zero.get("stage", 0))
+    # the values the Trainer fills in for "auto"
+    auto = {"reduce_bucket_size": hidden * hidden,
+            "stage3_prefetch_bucket_size": 0.9 * hidden * hidden}
+
+    def size(key, default):
+        value = zero.get(key, default)
+        return int(float(auto[key] if value == "auto" else value))
+
+    def offload(key):
+        return (zero.get(key) or {}).get("device", "none") not in ("none", None)
+
+    return {
+        "stage": stage,
+        "offload_optimizer": offload("offload_optimizer") and stage >= 1,
+        "offload_param": offload("offload_param") and stage == 3,
+        "overlap_comm": bool(zero.get("overlap_comm", stage == 3)),
+        "reduce_bucket_size": size("reduce_bucket_size", 5e8),
+        "allgather_bucket_size": size("allgather_bucket_size", 5e8),
+        "prefetch_bucket_size": size("stage3_prefetch_bucket_size", 5e7),
+        # "auto" is what the Trainer makes of bf16=True
+        "half": any(str((ds_config.get(key) or {}).get("enabled", False)).lower() != "false" for key in ("bf16", "fp16")),
+    }
+
+
+def plan(shape, ds_config, args):
+    zero = zero_settings(ds_config, shape.hidden)
+    stage, n = zero["stage"], args.world_size
+    P, T = shape.params, shape.trainable
+    half = 2 if zero["half"] else 4
+    # fp32 master weights with half precision, and the optimizer states
+    optimizer_bytes = (4 if zero["half"] else 0) + 4 * args.optimizer_states
+    device = {}
+    if stage == 3:
+        gathered = half * min(P, shape.largest_unit + zero["prefetch_bucket_size"])
+        device["params"] = gathered + (0 if zero["offload_param"] else half * P / n)
+    else:
+        device["params"] = half * P
+    if stage >= 2:
+        device["grads"] = 0 if zero["offload_optimizer"] else half * T / n
+    else:
+        device["grads"] = half * T
+    if stage == 0:
+        device["optimizer"] = optimizer_bytes * T
+    else:
+        device["optimizer"] = 0 if zero["offload_optimizer"] else optimizer_bytes * T / n
+    in_flight = 4.5 if zero["overlap_comm"] else 1
+    buckets = min(zero["reduce_bucket_size"], T) * in_flight
+    if stage == 3:
+        buckets += min(zero["prefetch_bucket_size"], P)
+    elif stage >= 1:
+        buckets += min(zero["allgather_bucket_size"], P) * in_flight
+    device["buffers"] = half * buckets if stage else 0
+    device["activations"] = shape.activations(args.micro_batch, args.seq_length, half, args.gradient_checkpointing)
+    device["overhead"] = args.device_overhead_gb * GB
+
+    host = 0
+    if zero["offload_optimizer"]:
+        # CPU Adam: fp32 master weights, states and gradients of the rank's partition
+        host += (optimizer_bytes + 4) * T / n
+    if zero["offload_param"]:
+        host += half * P / n
+    # from_pretrained in bf16: the whole model on every rank, ZeRO-3 partitions it shard by shard
+    loading = min(2 * P, args.checkpoint_shard_gb * GB) if stage == 3 else 2 * P
+    ranks_per_node = min(args.gpus_per_node, n)
+    host_per_node = ranks_per_node * (max(host, loading) + args.host_overhead_gb * GB)
+    return zero, device, host_per_node
+
+
+def variants(base):
+    # from least to most offloading
+    return [
+        ("stage2", configure(base, 2, "none", "none")),
+        ("stage2+offload_optimizer", configure(base, 2, "cpu", "none")),
+        ("stage3", configure(base, 3, "none", "none")),
+        ("stage3+offload_optimizer", configure(base, 3, "cpu", "none")),
+        ("stage3+offload_all", configure(base, 3, "cpu", "cpu")),
+    ]
+
+
+def report(shape, args):
+    print(f"{args.model}: {shape.params/1e9:.2f}B parameters, {shape.trainable/1e6:.1f}M trainable"
+          f"{f' (LoRA r={shape.lora_r})' if shape.lora_r else ''}, largest gathered unit {shape.largest_unit/1e6:.0f}M")
+    for half, precision in ((2, "bf16"), (4, "fp32")):
+        with_ckpt = shape.activations(args.micro_batch, args.seq_length, half, True) / GB
+        without = shape.activations(args.micro_batch, args.seq_length, half, False) / GB
+        print(f"activations {precision}, micro-batch {args.micro_batch} x {args.seq_length}: "
+              f"{with_ckpt:.1f} GB with gradient checkpointing, {without:.1f} GB without")
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    config = AutoConfig.from_pretrained(args.model, cache_dir=args.transformers_cache)
+    shape = ModelShape(config, args.lora_r)
+    report(shape, args)
+
+    overrides = dict(zero_stage=args.zero_stage, offload_optimizer=args.offload_optimizer,
+                     offload_param=args.offload_param, reduce_bucket_size=args.reduce_bucket_size,
+                     allgather_bucket_size=args.allgather_bucket_size, prefetch_bucket_size=args.prefetch_bucket_size)
+    paths = args.ds_config if args.ds_config is not None else sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ds-configs", "*.json")))
+    candidates = [(os.path.basename(path), configure(load_config(path), **overrides)) for path in paths]
+    if not any(value is not None for value in overrides.values()) and os.path.exists(args.base_config):
+        candidates += [(f"{name} ({os.path.basename(args.base_config)})", ds_config)
+                       for name, ds_config in variants(load_config(args.base_config))]
+
+    print(f"\n{'config':<52} {'zero':>5} {'params':>7} {'grads':>7} {'optim':>7} {'buffers':>7} {'activ':>7} "
+          f"{'device':>8} {'host/node':>10}  (GB, world_size {args.world_size}, {args.gpus_per_node} per node)")
+    fitting = []
+    for name, ds_config in candidates:
+        zero, device, host = plan(shape, ds_config, args)
+        total = sum(device.values())
+        fits = total <= args.device_memory_gb * GB and host <= args.host_memory_gb * GB
+        offload = "".join(flag for flag, on in (("o", zero["offload_optimizer"]), ("p", zero["offload_param"])) if on)
+        print(f"{name:<52} {str(zero['stage']) + offload:>5} "
+              + " ".join(f"{device[key]/GB:7.1f}" for key in ("params", "grads", "optimizer", "buffers", "activations"))
+              + f" {total/GB:8.1f} {host/GB:10.1f}  {'fits' if fits else 'OOM'}")
+        if fits:
+            # fastest first: no offloading, then the lower stage, then the most headroom
+            fitting.append(((zero["offload_param"], zero["offload_optimizer"], zero["stage"], total), name, ds_config))
+
+    if not fitting:
+        print(f"\nNothing fits {args.device_memory_gb:g} GB per device and {args.host_memory_gb:g} GB per node, "
+              "try gradient checkpointing, a smaller micro-batch or more ranks")
+        return 1
+    _, name, ds_config = min(fitting, key=lambda item: item[0])
+    print("\nRecommended:", name)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(ds_config, f, indent=2)
+        print("Wrote", args.output)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))